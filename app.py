@@ -8,6 +8,8 @@ import pandas as pd
 import os
 from pathlib import Path
 import time
+import queue
+import threading
 from datetime import datetime
 
 # Must be first Streamlit command
@@ -449,6 +451,7 @@ def initialize_session_state():
         st.session_state.chat_history = []
         st.session_state.data_loaded = False
         st.session_state.current_data = None
+        st.session_state.query_job = None  # Query running on a worker thread, polled by each script run
         st.session_state.dark_mode = False  # Dark mode toggle
 
 
@@ -480,6 +483,8 @@ def initialize_system():
                     st.session_state.memory_manager
                 )
                 st.session_state.knowledge_base = KnowledgeBase()
+                # A persisted schema catalog means the data is already loaded
+                st.session_state.data_loaded = bool(st.session_state.db_manager.schema_info)
                 st.session_state.initialized = True
                 logger.info("System initialized successfully")
         except Exception as e:
@@ -554,15 +559,41 @@ def render_sidebar():
         # Data Management Section
         st.markdown("### 📂 Data Management")
         
-        data_dir = st.text_input(
-            "Data Directory",
-            value="data",
-            help="Path to directory containing CSV files",
-            label_visibility="collapsed"
-        )
+        if config.database.replica_role == 'reader':
+            # Readers serve the writer's published snapshots and pick up new ones on their own
+            db = st.session_state.db_manager
+            snapshot = db.replicas.latest() if db and db.replicas else None
+            if snapshot:
+                st.caption(f"Read-only replica · snapshot {snapshot['sequence']} published {snapshot['published_at'][:19]}")
+        else:
+            data_dir = st.text_input(
+                "Data Directory",
+                value="data",
+                help="Path to directory containing CSV files",
+                label_visibility="collapsed"
+            )
+            
+            force_rebuild = st.checkbox(
+                "Force full rebuild",
+                value=False,
+                help="Ignore cached snapshots and re-ingest every CSV file"
+            )
+            
+            if st.button("🔄 Load/Reload Data", use_container_width=True, type="primary"):
+                load_data(Path(data_dir), force_reload=force_rebuild)
         
-        if st.button("🔄 Load/Reload Data", use_container_width=True, type="primary"):
-            load_data(Path(data_dir))
+        job = st.session_state.get('query_job')
+        if job and st.button("⏹️ Cancel Running Query", use_container_width=True):
+            # The query runs on the job's worker thread, so it is still running while this rerun cancels it
+            job['stop'].set()
+            cancelled = st.session_state.db_manager.cancel_session_queries() if st.session_state.db_manager else 0
+            st.caption(f"Cancelled {cancelled} running quer{'y' if cancelled == 1 else 'ies'}")
+        
+        st.session_state.approximate = st.checkbox(
+            "⚡ Fast approximate answers",
+            value=st.session_state.get('approximate', False),
+            help="Estimate totals and averages from a sample of large tables, with confidence intervals"
+        )
         
         if st.session_state.data_loaded and st.session_state.db_manager:
             st.markdown("<br>", unsafe_allow_html=True)
@@ -581,6 +612,54 @@ def render_sidebar():
                         </div>
                     </div>
                     """, unsafe_allow_html=True)
+            
+            with st.expander("⏱️ Query Performance", expanded=False):
+                shapes = st.session_state.db_manager.get_query_shape_stats(limit=10)
+                if shapes.empty:
+                    st.caption("No queries logged yet")
+                else:
+                    st.caption("Latency by query shape, costliest first")
+                    st.dataframe(shapes[['shape', 'executions', 'p50_ms', 'p95_ms', 'rollup_hits']],
+                                 use_container_width=True, hide_index=True)
+                
+                slow = st.session_state.db_manager.get_slow_queries(limit=10)
+                if not slow.empty:
+                    st.caption(f"Slow queries (over {config.database.slow_query_ms} ms)")
+                    st.dataframe(slow[['logged_at', 'elapsed_ms', 'sql']], use_container_width=True, hide_index=True)
+                
+                llm_cache = st.session_state.agent_system.get_llm_cache_stats() if st.session_state.agent_system else {}
+                if llm_cache:
+                    st.caption(f"LLM response cache: {llm_cache['hit_ratio']:.0%} hit ratio "
+                               f"({llm_cache['hits']} hits, {llm_cache['misses']} misses), "
+                               f"{llm_cache['latency_saved_s']:.1f}s saved, {llm_cache['entries']} entries")
+                
+                semantic = st.session_state.agent_system.get_semantic_cache_stats() if st.session_state.agent_system else {}
+                if semantic:
+                    st.caption(f"Similar-question SQL: {semantic['reused']} reused, {semantic['hinted']} hinted, "
+                               f"{semantic['missed']} missed, {semantic['entries']} questions stored")
+                
+                linking = st.session_state.agent_system.get_schema_linking_stats() if st.session_state.agent_system else {}
+                if linking and linking['questions']:
+                    st.caption(f"Schema linking: ~{linking['linked_tokens']:,} of ~{linking['full_tokens']:,} schema tokens sent "
+                               f"({linking['saved_ratio']:.0%} saved over {linking['questions']} questions)")
+            
+            tokens = st.session_state.agent_system.get_session_token_summary() if st.session_state.agent_system else {}
+            if tokens and tokens['calls']:
+                with st.expander("🔢 Token Usage", expanded=False):
+                    st.caption(f"This session: {tokens['prompt_tokens']:,} prompt + {tokens['completion_tokens']:,} "
+                               f"completion tokens over {tokens['calls']} calls, "
+                               f"{tokens['cached_tokens']:,} tokens saved by {tokens['cached_calls']} cached calls")
+                    agents = pd.DataFrame([{'agent': agent, **totals} for agent, totals in tokens['by_agent'].items()])
+                    st.dataframe(agents[['agent', 'calls', 'prompt_tokens', 'completion_tokens', 'cached_calls']],
+                                 use_container_width=True, hide_index=True)
+                    sections = pd.DataFrame([
+                        {'agent': agent, 'section': section, 'tokens': count}
+                        for agent, counts in tokens['by_section'].items() for section, count in counts.items()
+                    ])
+                    if not sections.empty:
+                        st.caption("Prompt tokens by section, largest first")
+                        st.dataframe(sections.sort_values('tokens', ascending=False),
+                                     use_container_width=True, hide_index=True)
         
         st.markdown("---")
         
@@ -590,6 +669,10 @@ def render_sidebar():
         col1, col2 = st.columns(2)
         with col1:
             if st.button("🗑️ Clear Chat", use_container_width=True):
+                if st.session_state.db_manager:
+                    for message in st.session_state.chat_history:
+                        if message.get('result_id'):
+                            st.session_state.db_manager.release_result(message['result_id'])
                 st.session_state.chat_history = []
                 st.session_state.memory_manager.clear_history() if st.session_state.memory_manager else None
                 st.rerun()
@@ -641,7 +724,7 @@ def render_sidebar():
                 st.rerun()
 
 
-def load_data(data_dir: Path):
+def load_data(data_dir: Path, force_reload: bool = False):
     """Load CSV data into database with professional feedback"""
     try:
         with st.spinner("📊 Loading data... Please wait"):
@@ -654,7 +737,8 @@ def load_data(data_dir: Path):
                 """, unsafe_allow_html=True)
                 return
             
-            loaded_tables = st.session_state.db_manager.load_csv_data(data_dir)
+            loaded_tables = st.session_state.db_manager.load_csv_data(data_dir, force_reload=force_reload)
+            load_sources = st.session_state.db_manager.load_sources
             
             if loaded_tables:
                 st.session_state.data_loaded = True
@@ -673,7 +757,7 @@ def load_data(data_dir: Path):
                         st.markdown(f"""
                         <div style="background: var(--surface-color); padding: 0.75rem; border-radius: 0.5rem; margin-bottom: 0.5rem; border-left: 3px solid #10b981;">
                             <div style="font-weight: 600;">{table}</div>
-                            <div style="color: var(--text-secondary); font-size: 0.875rem;">{count:,} rows loaded</div>
+                            <div style="color: var(--text-secondary); font-size: 0.875rem;">{count:,} rows loaded · {load_sources.get(table, 'csv')}</div>
                         </div>
                         """, unsafe_allow_html=True)
                 
@@ -739,8 +823,8 @@ def render_chat_interface():
     
     with chat_container:
         # Display chat history
-        for message in st.session_state.chat_history:
-            render_message(message)
+        for index, message in enumerate(st.session_state.chat_history):
+            render_message(message, index)
     
     # Spacer
     st.markdown("<br>", unsafe_allow_html=True)
@@ -800,9 +884,12 @@ def render_chat_interface():
     if send_button and user_input:
         process_query(user_input)
         st.rerun()
+    
+    # Follow a query still running on its worker thread, including across reruns
+    poll_query_job()
 
 
-def render_message(message: dict):
+def render_message(message: dict, index: int = 0):
     """Render a chat message with professional styling"""
     role = message['role']
     content = message['content']
@@ -831,8 +918,12 @@ def render_message(message: dict):
         # Render content with markdown support
         st.markdown(content)
         
-        # Render data table if available
-        if 'data' in message and message['data'] is not None:
+        # Render data table if available: stored results are paged from the server
+        if message.get('result_id'):
+            st.markdown("<br>", unsafe_allow_html=True)
+            with st.expander("📊 View Data Table", expanded=False):
+                render_result_table(message, index)
+        elif 'data' in message and message['data'] is not None:
             st.markdown("<br>", unsafe_allow_html=True)
             with st.expander("📊 View Data Table", expanded=False):
                 st.dataframe(
@@ -840,6 +931,13 @@ def render_message(message: dict):
                     use_container_width=True,
                     height=min(400, (len(message['data']) + 1) * 35)
                 )
+                # Only results someone opens are written out whole for paging
+                if message.get('truncated') and message.get('sql_query') and not message.get('approximate'):
+                    total = message.get('total_rows')
+                    label = f"📑 Browse all {total:,} rows" if total is not None else "📑 Browse all rows"
+                    if st.button(label, key=f"browse_{index}"):
+                        browse_full_result(message)
+                        st.rerun()
         
         # Render visualization if available
         if 'visualization' in message and message['visualization'] is not None:
@@ -856,14 +954,96 @@ def render_message(message: dict):
             with st.expander("🔍 View SQL Query", expanded=False):
                 st.code(message['sql_query'], language='sql', line_numbers=True)
         
+        usage = message.get('token_usage')
+        if usage and usage['calls']:
+            st.caption(f"🔢 {usage['prompt_tokens']:,} prompt + {usage['completion_tokens']:,} completion tokens "
+                       f"over {usage['calls']} LLM calls ({usage['cached_calls']} cached)")
+        
+        # Estimated answers can be re-run exactly against the full tables
+        if message.get('approximate') and message.get('sql_query'):
+            if st.button("🎯 Run exact query", key=f"exact_{index}",
+                         help="Re-run this query over every row instead of a sample"):
+                run_exact_query(message)
+                st.rerun()
+        
         st.markdown("</div></div>", unsafe_allow_html=True)
 
 
+def render_result_table(message: dict, index: int):
+    """Show one sorted page of a stored result, fetching only that page from the database"""
+    db = st.session_state.db_manager
+    info = db.get_result_info(message['result_id']) if db else None
+    if info is None:
+        st.info("This result is no longer stored. Ask the question again to browse its rows.")
+        return
+    
+    sort_col, order_col, size_col, page_col = st.columns([3, 2, 2, 2])
+    with sort_col:
+        sort_by = st.selectbox("Sort by", ["(query order)"] + info['columns'], key=f"sort_{index}")
+    with order_col:
+        descending = st.radio("Order", ["Ascending", "Descending"], horizontal=True,
+                              key=f"order_{index}") == "Descending"
+    with size_col:
+        page_size = st.selectbox("Rows per page", [25, 100, 500],
+                                 index=[25, 100, 500].index(100), key=f"page_size_{index}")
+    page_count = max(1, -(-info['row_count'] // page_size))
+    with page_col:
+        page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1, key=f"page_{index}")
+    
+    page_df = db.get_result_page(message['result_id'], page=page - 1, page_size=page_size,
+                                 sort_by=None if sort_by == "(query order)" else sort_by, descending=descending)
+    if page_df is None:
+        st.info("This result is no longer stored. Ask the question again to browse its rows.")
+        return
+    
+    first_row = (page - 1) * page_size
+    st.dataframe(page_df, use_container_width=True, hide_index=True,
+                 height=min(400, (len(page_df) + 1) * 35))
+    st.caption(f"Rows {first_row + 1:,}–{first_row + len(page_df):,} of {info['row_count']:,} · page {page} of {page_count}")
+
+
+def browse_full_result(message: dict):
+    """Write a truncated answer's full result to the server so its table can be paged"""
+    with st.spinner("📑 Preparing all rows..."):
+        result_id = st.session_state.db_manager.store_result(message['sql_query'])
+    
+    if result_id is None:
+        st.error("❌ The full result could not be stored; only the first rows can be shown.")
+        return
+    
+    message['result_id'] = result_id
+    message['data'] = None
+
+
+def run_exact_query(message: dict):
+    """Replace an approximate answer's data with the exact result of its SQL query"""
+    with st.spinner("🎯 Running the exact query..."):
+        result = st.session_state.db_manager.run_query(message['sql_query'])
+    
+    if result.error:
+        st.error(f"❌ Exact query failed: {result.error}")
+        return
+    
+    if message.get('result_id'):
+        st.session_state.db_manager.release_result(message['result_id'])
+    # The released id must not stay on the message when the exact result is not stored
+    message['result_id'] = result.result_id
+    message['data'] = None if result.result_id else result.data
+    message['approximate'] = False
+    message['truncated'] = result.truncated
+    message['total_rows'] = result.total_rows
+    message['content'] += f"\n\n**Exact result:** re-ran over all rows in {result.elapsed:.2f}s; the data table now holds exact values."
+    logger.info(f"Approximate answer upgraded to exact: {len(result.data)} rows")
+
+
 def process_query(user_query: str):
-    """Process user query through agent system"""
+    """Start processing a user query on a worker thread"""
     if not st.session_state.data_loaded:
         st.warning("⚠️ Please load data first before querying.")
         return
+    if st.session_state.get('query_job'):
+        st.warning("⏳ Please wait for the current query to finish or cancel it.")
+        return
     
     # Add user message
     user_message = {
@@ -873,30 +1053,128 @@ def process_query(user_query: str):
     }
     st.session_state.chat_history.append(user_message)
     
-    # Process with agent system
-    try:
-        with st.spinner("🤔 Analyzing your query..."):
-            response = st.session_state.agent_system.process_query(user_query)
-            
-            # Prepare assistant message
-            assistant_message = {
-                'role': 'assistant',
-                'content': response.get('answer', response.get('response', 'I apologize, but I encountered an issue processing your request.')),
-                'timestamp': datetime.now().strftime("%H:%M:%S"),
-                'data': response.get('data'),
-                'visualization': response.get('visualization'),
-                'sql_query': response.get('sql_query')
-            }
-            
-            st.session_state.chat_history.append(assistant_message)
-            logger.info(f"Query processed: {user_query[:50]}...")
-            
-    except Exception as e:
-        error_str = str(e)
+    # The worker only reads the agent system and queues events; every st call stays on the script thread
+    events = queue.Queue()
+    stop = threading.Event()
+    agent_system = st.session_state.agent_system
+    approximate = st.session_state.get('approximate', False)
+    
+    def run():
+        try:
+            for event in agent_system.stream_query(user_query, approximate=approximate):
+                if stop.is_set():
+                    events.put({'type': 'cancelled'})
+                    return
+                events.put(event)
+        except Exception as e:
+            events.put({'type': 'error', 'error': e})
+    
+    st.session_state.query_job = {
+        'query': user_query,
+        'events': events,
+        'stop': stop,
+        'thread': threading.Thread(target=run, name="chat-query", daemon=True),
+        'status': "Analyzing your query...",
+        'sql_query': None,
+        'rows': None,
+        'answer': "",
+        'outcome': None
+    }
+    st.session_state.query_job['thread'].start()
+
+
+def poll_query_job():
+    """Show a running query's SQL, rows and answer as they arrive, then add its reply to the chat"""
+    job = st.session_state.get('query_job')
+    if not job:
+        return
+    
+    status = st.empty()
+    sql_area = st.empty()
+    rows_area = st.empty()
+    answer_area = st.empty()
+    
+    while job['outcome'] is None:
+        finished = not job['thread'].is_alive()
+        try:
+            while True:
+                event = job['events'].get_nowait()
+                if event['type'] == 'status':
+                    job['status'] = event['message']
+                elif event['type'] == 'sql':
+                    job['sql_query'] = event['sql_query']
+                elif event['type'] == 'rows':
+                    job['rows'] = event
+                elif event['type'] == 'answer_chunk':
+                    job['answer'] += event['text']
+                elif event['type'] in ('done', 'cancelled', 'error'):
+                    job['outcome'] = event
+        except queue.Empty:
+            pass
+        if job['outcome'] is None and finished:
+            job['outcome'] = {'type': 'cancelled'}
         
-        # Check if it's a rate limit error
-        if "rate limit" in error_str.lower() or "429" in error_str or "resource exhausted" in error_str.lower():
-            error_content = """⏳ **API Rate Limit Reached**
+        # Re-render everything received so far, which also restores it after a rerun
+        status.info(f"🤔 {job['status']}")
+        if job['sql_query']:
+            sql_area.code(job['sql_query'], language='sql')
+        if job['rows'] is not None:
+            rows = job['rows']
+            total = rows['total_rows'] if rows['total_rows'] is not None else rows['row_count']
+            with rows_area.container():
+                st.caption(f"📊 {total:,} rows")
+                st.dataframe(rows['data'].head(10), use_container_width=True, hide_index=True)
+        if job['answer']:
+            answer_area.markdown(job['answer'] + "▌")
+        
+        if job['outcome'] is None:
+            time.sleep(0.1)
+    
+    for area in (status, sql_area, rows_area, answer_area):
+        area.empty()
+    st.session_state.query_job = None
+    st.session_state.chat_history.append(query_job_message(job))
+    st.rerun()
+
+
+def query_job_message(job: dict) -> dict:
+    """Build the assistant message for a finished, cancelled or failed query job"""
+    outcome = job['outcome']
+    user_query = job['query']
+    
+    if outcome['type'] == 'done':
+        response = outcome['response']
+        
+        # Prepare assistant message; a stored result stays on the server and only its id is kept here
+        result_id = response.get('metadata', {}).get('result_id')
+        logger.info(f"Query processed: {user_query[:50]}...")
+        return {
+            'role': 'assistant',
+            'content': response.get('answer', response.get('response', 'I apologize, but I encountered an issue processing your request.')),
+            'timestamp': datetime.now().strftime("%H:%M:%S"),
+            'data': None if result_id else response.get('data'),
+            'result_id': result_id,
+            'visualization': response.get('visualization'),
+            'sql_query': response.get('sql_query'),
+            'approximate': response.get('metadata', {}).get('approximate', False),
+            'truncated': response.get('metadata', {}).get('truncated', False),
+            'total_rows': response.get('metadata', {}).get('total_rows'),
+            'token_usage': response.get('metadata', {}).get('token_usage')
+        }
+    
+    if outcome['type'] == 'cancelled':
+        logger.info(f"Query cancelled: {user_query[:50]}...")
+        return {
+            'role': 'assistant',
+            'content': "⏹️ **Query cancelled.**",
+            'timestamp': datetime.now().strftime("%H:%M:%S")
+        }
+    
+    error_str = str(outcome['error'])
+    
+    # Check if it's a rate limit error
+    if "rate limit" in error_str.lower() or "429" in error_str or "resource exhausted" in error_str.lower():
+        error_content = """⏳ **API Rate Limit Reached**
             
 I've hit the Google Gemini API rate limit (free tier). This happens when making multiple queries quickly.
 
@@ -908,16 +1186,15 @@ I've hit the Google Gemini API rate limit (free tier). This happens when making
 Your question: "{}"
 
 I'll be ready to answer in a moment! 😊""".format(user_query)
-        else:
-            error_content = f"❌ **Error:** {error_str}\n\nPlease try rephrasing your question or contact support if this persists."
-        
-        error_message = {
-            'role': 'assistant',
-            'content': error_content,
-            'timestamp': datetime.now().strftime("%H:%M:%S")
-        }
-        st.session_state.chat_history.append(error_message)
-        logger.error(f"Query processing error: {e}")
+    else:
+        error_content = f"❌ **Error:** {error_str}\n\nPlease try rephrasing your question or contact support if this persists."
+    
+    logger.error(f"Query processing error: {outcome['error']}")
+    return {
+        'role': 'assistant',
+        'content': error_content,
+        'timestamp': datetime.now().strftime("%H:%M:%S")
+    }
 
 
 def render_metrics_dashboard():
@@ -3,8 +3,12 @@ Agent Orchestration System
 Coordinates multiple agents to handle complex queries
 """
 
-from typing import Dict, Any, List, Optional
+import uuid
+from typing import Dict, Any, Iterator, List, Optional
 import pandas as pd
+from src.agents.llm_cache import get_response_cache
+from src.agents.semantic_cache import get_semantic_cache
+from src.agents.token_usage import get_token_tracker, usage_scope
 from src.agents.base_agents import (
     BaseAgent, AgentType, AgentResponse,
     OrchestratorAgent, SQLAnalystAgent, DataAnalystAgent,
@@ -37,12 +41,13 @@ class AgentSystem:
         
         logger.info(f"Agent system initialized with {len(self.agents)} agents")
     
-    def process_query(self, user_query: str) -> Dict[str, Any]:
+    def process_query(self, user_query: str, approximate: bool = False) -> Dict[str, Any]:
         """
         Process user query through the agent system
         
         Args:
             user_query: User's natural language query
+            approximate: Estimate aggregates from table samples for a faster answer
             
         Returns:
             Dictionary with response and metadata
@@ -52,34 +57,80 @@ class AgentSystem:
         # Add user message to memory
         self.memory_manager.add_message('user', user_query)
         
-        try:
-            # Determine query intent and route to appropriate agents
-            intent = self._classify_query(user_query)
-            
-            # Execute appropriate workflow
-            if intent == 'data_query':
-                response = self._handle_data_query(user_query)
-            elif intent == 'translation':
-                response = self._handle_translation(user_query)
-            elif intent == 'knowledge':
-                response = self._handle_knowledge_query(user_query)
-            else:
-                response = self._handle_general_query(user_query)
-            
-            # Add assistant response to memory
-            self.memory_manager.add_message('assistant', response['answer'])
-            
-            return response
-            
-        except Exception as e:
-            logger.error(f"Error processing query: {e}")
-            error_response = {
-                'answer': f"I encountered an error processing your query: {str(e)}",
-                'metadata': {'error': str(e)},
-                'success': False
-            }
-            self.memory_manager.add_message('assistant', error_response['answer'])
-            return error_response
+        # Every LLM call made for this question is charged to it and to the session
+        question_id = uuid.uuid4().hex[:12]
+        with usage_scope(self.memory_manager.session_id, question_id):
+            try:
+                # Determine query intent and route to appropriate agents
+                intent = self._classify_query(user_query)
+                
+                # Execute appropriate workflow
+                if intent == 'data_query':
+                    response = self._handle_data_query(user_query, approximate)
+                elif intent == 'translation':
+                    response = self._handle_translation(user_query)
+                elif intent == 'knowledge':
+                    response = self._handle_knowledge_query(user_query)
+                else:
+                    response = self._handle_general_query(user_query)
+            except Exception as e:
+                response = self._error_response(e)
+        
+        return self._finish_query(response, question_id)
+    
+    def stream_query(self, user_query: str, approximate: bool = False) -> Iterator[Dict[str, Any]]:
+        """
+        Process user query, yielding events as each step finishes
+        
+        Each event is a dictionary with a 'type':
+            status: 'message' describes the step that is starting
+            sql: 'sql_query' about to run; a retry with rewritten SQL sends another
+            rows: the result's 'data', 'row_count', 'total_rows', 'result_id' and 'execution_time'
+            answer_chunk: the next piece of 'text' of the answer as the model writes it
+            done: the final 'response', as process_query returns it
+        
+        Args:
+            user_query: User's natural language query
+            approximate: Estimate aggregates from table samples for a faster answer
+        """
+        logger.info(f"Streaming query: {user_query[:100]}")
+        self.memory_manager.add_message('user', user_query)
+        
+        question_id = uuid.uuid4().hex[:12]
+        with usage_scope(self.memory_manager.session_id, question_id):
+            try:
+                intent = self._classify_query(user_query)
+                if intent == 'data_query':
+                    response = yield from self._stream_data_query(user_query, approximate)
+                elif intent == 'translation':
+                    yield {'type': 'status', 'message': "Translating..."}
+                    response = self._handle_translation(user_query)
+                else:
+                    response = yield from self._stream_knowledge_query(user_query)
+            except Exception as e:
+                response = self._error_response(e)
+        
+        yield {'type': 'done', 'response': self._finish_query(response, question_id)}
+    
+    def _error_response(self, error: Exception) -> Dict[str, Any]:
+        """Response for a query that failed outside the agents' own error handling"""
+        logger.error(f"Error processing query: {error}")
+        return {
+            'answer': f"I encountered an error processing your query: {str(error)}",
+            'metadata': {'error': str(error)},
+            'success': False
+        }
+    
+    def _finish_query(self, response: Dict[str, Any], question_id: str) -> Dict[str, Any]:
+        """Add the answer to memory and attach the question's id and token usage"""
+        self.memory_manager.add_message('assistant', response['answer'])
+        
+        metadata = response.setdefault('metadata', {})
+        metadata['question_id'] = question_id
+        tracker = get_token_tracker()
+        if tracker:
+            metadata['token_usage'] = tracker.question_usage(question_id)
+        return response
     
     def _classify_query(self, query: str) -> str:
         """Classify the type of query"""
@@ -102,17 +153,91 @@ class AgentSystem:
         
         return 'general'
     
-    def _handle_data_query(self, query: str) -> Dict[str, Any]:
+    def _handle_data_query(self, query: str, approximate: bool = False) -> Dict[str, Any]:
         """Handle data-related queries"""
         logger.info("Handling data query")
         
         # Step 1: Generate and execute SQL
-        sql_response = self.agents[AgentType.SQL_ANALYST].execute(query)
+        sql_response = self.agents[AgentType.SQL_ANALYST].execute(query, context={'approximate': approximate})
+        early_response = self._sql_outcome(sql_response)
+        if early_response:
+            return early_response
         
+        # Step 2: Analyze results
+        analysis_response = self.agents[AgentType.DATA_ANALYST].execute(query, context=self._analysis_context(sql_response))
+        analysis = analysis_response.content if analysis_response.success else "Analysis not available."
+        return self._data_answer(sql_response, analysis)
+    
+    def _stream_data_query(self, query: str, approximate: bool) -> Iterator[Dict[str, Any]]:
+        """Data query workflow yielding the SQL and rows as soon as they exist, then the analysis as it is written"""
+        yield {'type': 'status', 'message': "Writing SQL..."}
+        steps = self.agents[AgentType.SQL_ANALYST].steps(query, context={'approximate': approximate})
+        while True:
+            try:
+                sql_query = next(steps)
+            except StopIteration as finished:
+                sql_response = finished.value
+                break
+            yield {'type': 'sql', 'sql_query': sql_query}
+            yield {'type': 'status', 'message': "Running the query..."}
+        early_response = self._sql_outcome(sql_response)
+        if early_response:
+            return early_response
+        
+        result_df = sql_response.metadata['result']
+        yield {'type': 'rows', 'data': result_df, 'row_count': len(result_df),
+               'total_rows': sql_response.metadata.get('total_rows'), 'result_id': sql_response.metadata.get('result_id'),
+               'execution_time': sql_response.metadata.get('execution_time')}
+        
+        yield {'type': 'status', 'message': "Analyzing the results..."}
+        chunks = []
+        try:
+            for text in self.agents[AgentType.DATA_ANALYST].stream(query, self._analysis_context(sql_response)):
+                chunks.append(text)
+                yield {'type': 'answer_chunk', 'text': text}
+            analysis = "".join(chunks)
+        except Exception as e:
+            # The rows are still worth returning; keep whatever analysis arrived before the failure
+            logger.error(f"Data Analyst error: {e}")
+            analysis = "".join(chunks) or "Analysis not available."
+        return self._data_answer(sql_response, analysis)
+    
+    def _stream_knowledge_query(self, query: str) -> Iterator[Dict[str, Any]]:
+        """Knowledge query workflow yielding the answer as it is written"""
+        logger.info("Handling knowledge query")
+        yield {'type': 'status', 'message': "Looking that up..."}
+        chunks = []
+        try:
+            for text in self.agents[AgentType.KNOWLEDGE_EXPERT].stream(query):
+                chunks.append(text)
+                yield {'type': 'answer_chunk', 'text': text}
+        except Exception as e:
+            logger.error(f"Knowledge Expert error: {e}")
+            return {
+                'answer': f"Knowledge lookup failed: {e}",
+                'metadata': {},
+                'success': False
+            }
+        return {
+            'answer': "".join(chunks),
+            'metadata': {},
+            'success': True
+        }
+    
+    def _sql_outcome(self, sql_response: AgentResponse) -> Optional[Dict[str, Any]]:
+        """The final response when the SQL step failed or found no rows, None when there is data to analyze"""
         if not sql_response.success:
+            error_type = sql_response.metadata.get('error_type')
+            if error_type in ('timeout', 'cancelled'):
+                answer = f"The query was stopped before it finished ({sql_response.error}). Try narrowing the question, for example to a date range or category."
+            elif error_type == 'rejected':
+                answer = f"The query was too expensive to run ({sql_response.error}). Try narrowing the question, for example to a date range or category."
+            else:
+                answer = f"I couldn't generate a valid SQL query. Error: {sql_response.error}"
             return {
-                'answer': f"I couldn't generate a valid SQL query. Error: {sql_response.error}",
-                'metadata': {'error': sql_response.error},
+                'answer': answer,
+                'sql_query': sql_response.metadata.get('sql_query'),
+                'metadata': {'error': sql_response.error, 'error_type': error_type},
                 'success': False
             }
         
@@ -127,22 +252,57 @@ class AgentSystem:
                 'metadata': {},
                 'success': True
             }
-        
-        # Step 2: Analyze results
-        analysis_response = self.agents[AgentType.DATA_ANALYST].execute(
-            query,
-            context={'result_df': result_df, 'sql_query': sql_query}
-        )
-        
-        analysis = analysis_response.content if analysis_response.success else "Analysis not available."
+        return None
+    
+    def _analysis_context(self, sql_response: AgentResponse) -> Dict[str, Any]:
+        """Context the data analyst needs for a query result"""
+        result_df = sql_response.metadata['result']
+        return {
+            'result_df': result_df,
+            'sql_query': sql_response.metadata.get('sql_query'),
+            'column_stats': self.db_manager.get_result_column_stats(result_df.columns.tolist()),
+            'sample_fraction': sql_response.metadata.get('sample_fraction')
+        }
+    
+    def _data_answer(self, sql_response: AgentResponse, analysis: str) -> Dict[str, Any]:
+        """Format the answer to a data query from its result and analysis"""
+        result_df = sql_response.metadata['result']
+        sql_query = sql_response.metadata.get('sql_query')
         
         # Format response
+        truncated = sql_response.metadata.get('truncated', False)
+        total_rows = sql_response.metadata.get('total_rows')
+        result_id = sql_response.metadata.get('result_id')
+        if truncated and result_id:
+            rows_line = f"- Returned {total_rows} rows (the first {len(result_df)} were analyzed; all can be browsed below)"
+        elif truncated:
+            total_text = f"{total_rows}" if total_rows is not None else "more"
+            rows_line = f"- Returned the first {len(result_df)} of {total_text} rows (result truncated)"
+        else:
+            rows_line = f"- Returned {len(result_df)} rows"
+        
         answer_parts = [
             f"**Analysis:**\n{analysis}",
             f"\n**Query Details:**",
-            f"- Returned {len(result_df)} rows",
+            rows_line,
             f"- SQL Query: `{sql_query}`"
         ]
+        similar_question = sql_response.metadata.get('similar_question')
+        if similar_question:
+            answer_parts.append(
+                f"- Reused the SQL of a similar earlier question ({sql_response.metadata['similarity']:.0%} similar): "
+                f"\"{similar_question}\""
+            )
+        rollup = sql_response.metadata.get('rollup')
+        if rollup:
+            answer_parts.append(f"- Answered from pre-aggregated rollup `{rollup}`")
+        sample_fraction = sql_response.metadata.get('sample_fraction')
+        confidence = sql_response.metadata.get('confidence')
+        if sample_fraction:
+            answer_parts.append(
+                f"- Approximate: estimated from a {sample_fraction:.1%} sample, with "
+                f"{confidence:.0%} confidence intervals in the `_ci_low` / `_ci_high` columns"
+            )
         
         return {
             'answer': '\n'.join(answer_parts),
@@ -151,7 +311,14 @@ class AgentSystem:
             'analysis': analysis,
             'metadata': {
                 'row_count': len(result_df),
-                'columns': result_df.columns.tolist()
+                'columns': result_df.columns.tolist(),
+                'truncated': truncated,
+                'total_rows': total_rows,
+                'result_id': result_id,
+                'rollup': rollup,
+                'approximate': bool(sample_fraction),
+                'sample_fraction': sample_fraction,
+                'confidence': confidence
             },
             'success': True
         }
@@ -212,6 +379,35 @@ class AgentSystem:
         # Use knowledge expert for general queries
         return self._handle_knowledge_query(query)
     
+    def get_llm_cache_stats(self) -> Dict[str, Any]:
+        """Get the LLM response cache's hit ratio and latency saved"""
+        cache = get_response_cache()
+        return cache.stats() if cache else {}
+    
+    def get_semantic_cache_stats(self) -> Dict[str, Any]:
+        """Get how often similar questions reused or were hinted with cached SQL"""
+        cache = get_semantic_cache()
+        return cache.stats() if cache else {}
+    
+    def get_schema_linking_stats(self) -> Dict[str, Any]:
+        """Get how much schema linking shrank the SQL prompts"""
+        linker = self.agents[AgentType.SQL_ANALYST].schema_linker
+        return linker.stats() if linker else {}
+    
+    def get_token_usage(self, session_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Get tokens spent per agent and prompt section
+        
+        Args:
+            session_id: Only count this session (defaults to every session in the process)
+        """
+        tracker = get_token_tracker()
+        return tracker.summary(session_id) if tracker else {}
+    
+    def get_session_token_summary(self) -> Dict[str, Any]:
+        """Get tokens spent in the current conversation session"""
+        return self.get_token_usage(self.memory_manager.session_id)
+    
     def get_conversation_history(self) -> List[Dict[str, str]]:
         """Get formatted conversation history"""
         messages = self.memory_manager.get_messages()
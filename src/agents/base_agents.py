@@ -4,11 +4,15 @@ Implements specialized agents for different tasks
 """
 
 import google.generativeai as genai
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, Generator, Iterator, List, Optional, Tuple
 from enum import Enum
 from dataclasses import dataclass
 import time
 from src.config import config
+from src.agents.llm_cache import get_response_cache, response_cache_key
+from src.agents.semantic_cache import SemanticMatch, get_semantic_cache
+from src.agents.schema_linker import SchemaLinker
+from src.agents.token_usage import TokenUsage, count_tokens, current_usage_scope, get_token_tracker
 from src.logger import get_logger
 from src.database import DatabaseManager
 from src.memory import MemoryManager
@@ -45,23 +49,49 @@ class BaseAgent:
     def __init__(self, agent_type: AgentType, system_prompt: str):
         self.agent_type = agent_type
         self.system_prompt = system_prompt
+        self.model_name = config.llm.default_model
+        self.generation_config = {
+            'temperature': config.llm.temperature,
+            'max_output_tokens': config.llm.max_tokens,
+        }
         self.model = genai.GenerativeModel(
-            model_name=config.llm.default_model,
-            generation_config={
-                'temperature': config.llm.temperature,
-                'max_output_tokens': config.llm.max_tokens,
-            }
+            model_name=self.model_name,
+            generation_config=self.generation_config
         )
+        self.response_cache = get_response_cache()
+        self.token_tracker = get_token_tracker()
     
     def execute(self, query: str, context: Optional[Dict] = None) -> AgentResponse:
         """Execute agent task"""
         raise NotImplementedError("Subclasses must implement execute method")
     
-    def _call_llm(self, prompt: str, max_retries: int = 3) -> str:
-        """Call LLM with prompt and automatic retry on rate limits"""
+    def _call_llm(self, prompt: str, max_retries: int = 3, scope: str = "",
+                  sections: Optional[Dict[str, str]] = None) -> str:
+        """
+        Call LLM with prompt and automatic retry on rate limits
+        
+        Repeated prompts are answered from the response cache. Prompts that
+        embed the schema pass the data version as scope, so their responses
+        are not reused once the data changes. The tokens of every call are
+        recorded, with the named prompt sections counted separately.
+        """
+        cache_key = None
+        if self.response_cache:
+            cache_key = response_cache_key(self.model_name, self.generation_config, prompt, scope)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"{self.agent_type.value} response served from cache")
+                self._record_usage(prompt, cached, None, sections, cached=True)
+                return cached
+        
         for attempt in range(max_retries):
             try:
+                start = time.perf_counter()
                 response = self.model.generate_content(prompt)
+                if cache_key:
+                    self.response_cache.put(cache_key, response.text, self.model_name, scope,
+                                            time.perf_counter() - start)
+                self._record_usage(prompt, response.text, response, sections)
                 return response.text
             except Exception as e:
                 error_msg = str(e)
@@ -83,6 +113,90 @@ class BaseAgent:
                     raise
         
         raise Exception("Failed to get response from AI model")
+    
+    def _stream_llm(self, prompt: str, max_retries: int = 3, scope: str = "",
+                    sections: Optional[Dict[str, str]] = None) -> Iterator[str]:
+        """
+        Call LLM with prompt, yielding the response text as it is generated
+        
+        Uses the same response cache and token accounting as _call_llm; a
+        cached response is yielded whole. Rate limits are retried only
+        before the first chunk arrives, since text already shown cannot be
+        taken back.
+        """
+        cache_key = None
+        if self.response_cache:
+            cache_key = response_cache_key(self.model_name, self.generation_config, prompt, scope)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"{self.agent_type.value} response served from cache")
+                self._record_usage(prompt, cached, None, sections, cached=True)
+                yield cached
+                return
+        
+        for attempt in range(max_retries):
+            chunks: List[str] = []
+            try:
+                start = time.perf_counter()
+                response = self.model.generate_content(prompt, stream=True)
+                for chunk in response:
+                    text = chunk.text
+                    if text:
+                        chunks.append(text)
+                        yield text
+                
+                full_text = "".join(chunks)
+                if cache_key:
+                    self.response_cache.put(cache_key, full_text, self.model_name, scope,
+                                            time.perf_counter() - start)
+                self._record_usage(prompt, full_text, response, sections)
+                return
+            except Exception as e:
+                error_msg = str(e)
+                
+                if ("429" in error_msg or "Resource exhausted" in error_msg) and not chunks:
+                    if attempt < max_retries - 1:
+                        wait_time = 2 ** (attempt + 1)
+                        logger.warning(f"Rate limit hit. Retrying in {wait_time} seconds... (Attempt {attempt + 1}/{max_retries})")
+                        time.sleep(wait_time)
+                        continue
+                    logger.error(f"Rate limit exceeded after {max_retries} attempts")
+                    raise Exception("⏳ API rate limit exceeded. Please wait a moment and try again.")
+                logger.error(f"LLM stream failed: {e}")
+                raise
+        
+        raise Exception("Failed to get response from AI model")
+    
+    def _record_usage(self, prompt: str, text: str, response: Any, sections: Optional[Dict[str, str]],
+                      cached: bool = False):
+        """Record a call's tokens, preferring the counts the API reports over local estimates"""
+        if not self.token_tracker:
+            return
+        try:
+            usage = getattr(response, 'usage_metadata', None)
+            prompt_tokens = getattr(usage, 'prompt_token_count', None)
+            completion_tokens = getattr(usage, 'candidates_token_count', None)
+            source = 'api' if prompt_tokens else 'estimate'
+            if not prompt_tokens:
+                prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(text)
+            session_id, question_id = current_usage_scope()
+            self.token_tracker.record(TokenUsage(
+                agent=self.agent_type.value,
+                session_id=session_id,
+                question_id=question_id,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens or 0,
+                cached=cached,
+                source=source,
+                sections={name: count_tokens(part) for name, part in (sections or {}).items() if part},
+            ))
+        except Exception as e:
+            logger.warning(f"Could not record token usage: {e}")
+    
+    def _forget_llm_response(self, prompt: str, scope: str = ""):
+        """Drop a cached response that turned out to be unusable, so the prompt is asked again"""
+        if self.response_cache:
+            self.response_cache.invalidate(response_cache_key(self.model_name, self.generation_config, prompt, scope))
 
 
 class OrchestratorAgent(BaseAgent):
@@ -114,7 +228,7 @@ Analyze the user query and respond in JSON format:
         """Route query to appropriate agents"""
         try:
             prompt = f"{self.system_prompt}\n\nUser Query: {query}"
-            response = self._call_llm(prompt)
+            response = self._call_llm(prompt, sections={'instructions': self.system_prompt, 'question': query})
             
             return AgentResponse(
                 agent_type=self.agent_type,
@@ -142,7 +256,8 @@ class SQLAnalystAgent(BaseAgent):
 Your job is to generate accurate, efficient SQL queries for DuckDB based on user questions.
 
 Guidelines:
-1. Use proper JOIN operations when combining tables
+1. Start from the order_facts table, which already joins orders, items, products, categories, customers and sellers; JOIN other tables only for columns it lacks
+   For locations, JOIN zip_centroids (one row per zip code prefix) rather than the raw geolocation table
 2. Include appropriate WHERE clauses for filtering
 3. Use aggregate functions (COUNT, SUM, AVG) for analytics
 4. Format dates properly
@@ -153,49 +268,128 @@ Guidelines:
 Return ONLY the SQL query without any explanation or markdown formatting."""
         super().__init__(AgentType.SQL_ANALYST, system_prompt)
         self.db_manager = db_manager
+        self.semantic_cache = get_semantic_cache()
+        self.schema_linker = None
+        if config.llm.enable_schema_linking:
+            self.schema_linker = SchemaLinker(db_manager, config.llm.schema_link_max_tables,
+                                              config.llm.schema_link_max_columns,
+                                              self.semantic_cache.embedder if self.semantic_cache else None)
     
     def execute(self, query: str, context: Optional[Dict] = None) -> AgentResponse:
         """Generate and execute SQL query"""
+        steps = self.steps(query, context)
+        while True:
+            try:
+                next(steps)
+            except StopIteration as finished:
+                return finished.value
+    
+    def steps(self, query: str, context: Optional[Dict] = None) -> Generator[str, None, AgentResponse]:
+        """Generate and execute SQL query, yielding each SQL query just before it runs"""
         try:
-            # Get schema information
-            schema_desc = self.db_manager.get_schema_description()
+            # Get schema information, cut down to the tables and columns the question needs
+            linked = self.schema_linker.link(query) if self.schema_linker else None
+            schema_desc = linked.description if linked else self.db_manager.get_schema_description()
+            
+            # SQL that answered a similar question is reused when close enough, otherwise offered as an example
+            match = self._semantic_match(query)
+            example = ""
+            if match and not match.reusable:
+                example = f"""
+A similar earlier question was answered with the SQL below; adapt it if it fits:
+Question: {match.question}
+SQL: {match.sql}
+"""
             
             prompt = f"""{self.system_prompt}
 
 Database Schema:
 {schema_desc}
-
+{example}
 User Question: {query}
 
 Generate the SQL query:"""
+            sections = {'instructions': self.system_prompt, 'schema': schema_desc, 'example': example, 'question': query}
             
-            # Get SQL query from LLM
-            sql_query = self._call_llm(prompt).strip()
+            reused = match if match and match.reusable else None
+            if reused:
+                logger.info(f"Reusing SQL of a similar question ({reused.similarity:.2f}): {reused.question}")
+                sql_query = reused.sql
+            else:
+                sql_query = self._generate_sql(prompt, sections)
+            approximate = bool(context and context.get('approximate'))
             
-            # Clean up the SQL query
-            sql_query = sql_query.replace('```sql', '').replace('```', '').strip()
+            # Execute query; a truncated result is only written out whole if the user opens it
+            yield sql_query
+            result = self.db_manager.run_query(sql_query, approximate=approximate)
             
-            logger.info(f"Generated SQL: {sql_query}")
+            # Reused SQL that fails is dropped from the cache and the question goes to the model
+            if reused and result.error:
+                logger.warning(f"Reused SQL failed ({result.error_type}), generating new SQL")
+                self.semantic_cache.remove(reused.question)
+                reused = None
+                sql_query = self._generate_sql(prompt, sections)
+                yield sql_query
+                result = self.db_manager.run_query(sql_query, approximate=approximate)
             
-            # Execute query
-            result_df, error = self.db_manager.execute_query(sql_query)
+            # A query that ran out of time or was rejected as too costly gets one retry with a cheaper rewrite
+            if result.error_type in ('timeout', 'rejected'):
+                logger.warning(f"SQL query {result.error_type}, asking for a cheaper rewrite")
+                self._forget_llm_response(prompt, self.db_manager.data_version)
+                problem = "timed out" if result.error_type == 'timeout' else f"was rejected as too costly ({result.error})"
+                retry_request = f"""The previous query {problem}:
+{sql_query}
+
+Rewrite it to be much cheaper: filter early, aggregate before joining, avoid joins that multiply rows, and add a LIMIT."""
+                retry_prompt = f"""{prompt}
+
+{retry_request}
+
+Generate the SQL query:"""
+                prompt = retry_prompt
+                sql_query = self._generate_sql(retry_prompt, {**sections, 'retry': retry_request})
+                yield sql_query
+                result = self.db_manager.run_query(sql_query, approximate=approximate)
             
-            if error:
+            if result.error:
+                # SQL that failed is not served again for the same question
+                self._forget_llm_response(prompt, self.db_manager.data_version)
                 return AgentResponse(
                     agent_type=self.agent_type,
                     content="",
-                    metadata={'sql_query': sql_query},
+                    metadata={'sql_query': sql_query, 'error_type': result.error_type},
                     success=False,
-                    error=error
+                    error=result.error
                 )
             
+            if self.semantic_cache and not reused:
+                try:
+                    self.semantic_cache.add(query, sql_query, self.db_manager.data_version)
+                except Exception as e:
+                    logger.warning(f"Could not add SQL to the semantic cache: {e}")
+            
             return AgentResponse(
                 agent_type=self.agent_type,
                 content=sql_query,
                 metadata={
                     'sql_query': sql_query,
-                    'result': result_df,
-                    'row_count': len(result_df)
+                    'result': result.data,
+                    'row_count': len(result.data),
+                    'query_id': result.query_id,
+                    'execution_time': result.elapsed,
+                    'from_cache': result.from_cache,
+                    'truncated': result.truncated,
+                    'total_rows': result.total_rows,
+                    'result_id': result.result_id,
+                    'similar_question': reused.question if reused else None,
+                    'similarity': reused.similarity if reused else None,
+                    'schema_tables': linked.tables if linked else None,
+                    'schema_tokens_full': linked.full_tokens if linked else None,
+                    'schema_tokens_linked': linked.linked_tokens if linked else None,
+                    'rollup': result.rollup,
+                    'approximate': result.approximate,
+                    'sample_fraction': result.sample_fraction,
+                    'confidence': result.confidence
                 },
                 success=True
             )
@@ -211,6 +405,36 @@ Generate the SQL query:"""
             )
 
 
+    def _semantic_match(self, query: str) -> Optional[SemanticMatch]:
+        """Find SQL cached for a similar question, dropping it if it no longer binds to the schema"""
+        if not self.semantic_cache:
+            return None
+        try:
+            match = self.semantic_cache.lookup(query)
+        except Exception as e:
+            logger.warning(f"Semantic SQL cache lookup failed: {e}")
+            return None
+        
+        if match and match.data_version != self.db_manager.data_version:
+            error = self.db_manager.validate_query(match.sql)
+            if error:
+                logger.info(f"Cached SQL for '{match.question}' no longer fits the schema: {error}")
+                self.semantic_cache.remove(match.question)
+                return None
+            self.semantic_cache.confirm(match.question, self.db_manager.data_version)
+        return match
+    
+    def _generate_sql(self, prompt: str, sections: Optional[Dict[str, str]] = None) -> str:
+        """Ask the LLM for SQL and strip any markdown fences"""
+        sql_query = self._call_llm(prompt, scope=self.db_manager.data_version, sections=sections).strip()
+        
+        # Clean up the SQL query
+        sql_query = sql_query.replace('```sql', '').replace('```', '').strip()
+        
+        logger.info(f"Generated SQL: {sql_query}")
+        return sql_query
+
+
 class DataAnalystAgent(BaseAgent):
     """
     Data Analyst Agent - Analyzes query results and provides insights
@@ -235,7 +459,6 @@ Be concise but thorough in your analysis."""
         """Analyze data and provide insights"""
         try:
             result_df = context.get('result_df') if context else None
-            sql_query = context.get('sql_query', '') if context else ''
             
             if result_df is None or result_df.empty:
                 return AgentResponse(
@@ -246,28 +469,8 @@ Be concise but thorough in your analysis."""
                     error="No data provided"
                 )
             
-            # Prepare context for analysis
-            data_summary = f"""
-Query: {query}
-SQL Query: {sql_query}
-
-Data Shape: {result_df.shape[0]} rows, {result_df.shape[1]} columns
-Columns: {', '.join(result_df.columns.tolist())}
-
-Sample Data:
-{result_df.head(10).to_string()}
-
-Statistical Summary:
-{result_df.describe().to_string() if len(result_df) > 0 else 'No numeric data'}
-"""
-            
-            prompt = f"""{self.system_prompt}
-
-{data_summary}
-
-Provide your analysis and insights:"""
-            
-            analysis = self._call_llm(prompt)
+            prompt, sections = self._build_prompt(query, context)
+            analysis = self._call_llm(prompt, sections=sections)
             
             return AgentResponse(
                 agent_type=self.agent_type,
@@ -288,6 +491,61 @@ Provide your analysis and insights:"""
                 success=False,
                 error=str(e)
             )
+    
+    def stream(self, query: str, context: Dict) -> Iterator[str]:
+        """Yield the analysis of a non-empty result as it is generated"""
+        prompt, sections = self._build_prompt(query, context)
+        yield from self._stream_llm(prompt, sections=sections)
+    
+    def _build_prompt(self, query: str, context: Dict) -> Tuple[str, Dict[str, str]]:
+        """Analysis prompt for a result, with its sections named for token accounting"""
+        result_df = context['result_df']
+        sql_query = context.get('sql_query', '')
+        
+        # Prepare context for analysis
+        sample_rows = result_df.head(10).to_string()
+        summary_stats = result_df.describe().to_string() if len(result_df) > 0 else 'No numeric data'
+        data_summary = f"""
+Query: {query}
+SQL Query: {sql_query}
+
+Data Shape: {result_df.shape[0]} rows, {result_df.shape[1]} columns
+Columns: {', '.join(result_df.columns.tolist())}
+
+Sample Data:
+{sample_rows}
+
+Statistical Summary:
+{summary_stats}
+"""
+        sections = {'instructions': self.system_prompt, 'question': query, 'sql': sql_query,
+                    'sample_rows': sample_rows, 'summary_stats': summary_stats}
+        
+        # Whole-table statistics put the result's values in context
+        column_stats = context.get('column_stats')
+        if column_stats:
+            lines = [
+                f"- {column} ({stats['table']}): range {stats.get('min')} to {stats.get('max')}, "
+                f"~{stats['distinct_count']} distinct, {stats['null_fraction']:.0%} null"
+                for column, stats in column_stats.items()
+            ]
+            sections['column_stats'] = "\n".join(lines)
+            data_summary += "\nFull-Table Column Statistics:\n" + sections['column_stats'] + "\n"
+        
+        sample_fraction = context.get('sample_fraction')
+        if sample_fraction:
+            data_summary += (
+                f"\nThese figures are estimates from a {sample_fraction:.1%} sample. Columns ending in "
+                f"_ci_low and _ci_high bound each estimate; mention the uncertainty and avoid "
+                f"ranking groups whose intervals overlap.\n"
+            )
+        
+        prompt = f"""{self.system_prompt}
+
+{data_summary}
+
+Provide your analysis and insights:"""
+        return prompt, sections
 
 
 class KnowledgeExpertAgent(BaseAgent):
@@ -313,13 +571,8 @@ Be informative and educational in your responses."""
     def execute(self, query: str, context: Optional[Dict] = None) -> AgentResponse:
         """Provide knowledge and context"""
         try:
-            prompt = f"""{self.system_prompt}
-
-User Query: {query}
-
-Provide relevant knowledge and context:"""
-            
-            knowledge = self._call_llm(prompt)
+            knowledge = self._call_llm(self._build_prompt(query),
+                                       sections={'instructions': self.system_prompt, 'question': query})
             
             return AgentResponse(
                 agent_type=self.agent_type,
@@ -337,6 +590,19 @@ Provide relevant knowledge and context:"""
                 success=False,
                 error=str(e)
             )
+    
+    def stream(self, query: str, context: Optional[Dict] = None) -> Iterator[str]:
+        """Yield the answer as it is generated"""
+        yield from self._stream_llm(self._build_prompt(query),
+                                    sections={'instructions': self.system_prompt, 'question': query})
+    
+    def _build_prompt(self, query: str) -> str:
+        """Knowledge prompt for a question"""
+        return f"""{self.system_prompt}
+
+User Query: {query}
+
+Provide relevant knowledge and context:"""
 
 
 class TranslatorAgent(BaseAgent):
@@ -372,7 +638,7 @@ Translate the following text to {target_lang}:
 
 Translation:"""
             
-            translation = self._call_llm(prompt)
+            translation = self._call_llm(prompt, sections={'instructions': self.system_prompt, 'text': text})
             
             return AgentResponse(
                 agent_type=self.agent_type,
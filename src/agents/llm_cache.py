@@ -0,0 +1,157 @@
+"""
+LLM Response Cache
+Disk-backed cache of model responses keyed on model, generation settings, scope and prompt
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, Optional
+from src.config import config
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+_cache: Optional["LLMResponseCache"] = None
+_cache_lock = threading.Lock()
+
+
+def response_cache_key(model_name: str, generation_config: Dict[str, Any], prompt: str, scope: str = "") -> str:
+    """Hash everything that determines a response into the cache key"""
+    settings = json.dumps(generation_config, sort_keys=True, default=str)
+    digest = hashlib.sha256()
+    for part in (model_name, settings, scope, prompt):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Model responses persisted in SQLite so they survive restarts
+    
+    Entries expire after ttl_seconds. Past max_bytes of stored responses
+    the least recently used entries are evicted. Each entry keeps the
+    latency of the call that produced it, so hits report the time saved.
+    SQLite's WAL mode lets several app processes share one cache file.
+    """
+    
+    def __init__(self, cache_path: Optional[Path], ttl_seconds: float, max_bytes: int):
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self._lock = threading.Lock()
+        
+        target = str(cache_path) if cache_path else ':memory:'
+        if cache_path:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(target, check_same_thread=False, timeout=10)
+        if cache_path:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_responses (
+                cache_key TEXT PRIMARY KEY,
+                model TEXT,
+                scope TEXT,
+                response TEXT,
+                size_bytes INTEGER,
+                latency_s REAL,
+                created_at REAL,
+                last_used_at REAL,
+                hit_count INTEGER DEFAULT 0
+            )
+        """)
+        self._conn.commit()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Look up a fresh response, counting the hit or miss"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, latency_s FROM llm_responses WHERE cache_key = ? AND created_at >= ?",
+                (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE llm_responses SET last_used_at = ?, hit_count = hit_count + 1 WHERE cache_key = ?",
+                (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            self.latency_saved += row[1] or 0.0
+        return row[0]
+    
+    def put(self, key: str, response: str, model: str, scope: str, latency: float):
+        """Store a response, then drop expired entries and evict past the size limit"""
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_responses "
+                "(cache_key, model, scope, response, size_bytes, latency_s, created_at, last_used_at, hit_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                (key, model, scope, response, size, latency, now, now)
+            )
+            self._conn.execute("DELETE FROM llm_responses WHERE created_at < ?", (now - self.ttl_seconds,))
+            total = self._conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM llm_responses").fetchone()[0]
+            if total > self.max_bytes:
+                # Keep the most recently used entries that fit in the budget
+                self._conn.execute("""
+                    DELETE FROM llm_responses WHERE cache_key IN (
+                        SELECT cache_key FROM (
+                            SELECT cache_key, SUM(size_bytes) OVER (ORDER BY last_used_at DESC, created_at DESC) AS kept
+                            FROM llm_responses
+                        ) WHERE kept > ?
+                    )
+                """, (self.max_bytes,))
+            self._conn.commit()
+    
+    def invalidate(self, key: str):
+        """Forget a response that turned out to be unusable"""
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_responses WHERE cache_key = ?", (key,))
+            self._conn.commit()
+    
+    def clear(self):
+        """Drop every cached response"""
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_responses")
+            self._conn.commit()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Hit ratio and latency saved in this process, with the stored entries"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM llm_responses"
+            ).fetchone()
+            lookups = self.hits + self.misses
+            return {
+                'entries': entries,
+                'bytes': size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'latency_saved_s': round(self.latency_saved, 3),
+            }
+
+
+def get_response_cache() -> Optional[LLMResponseCache]:
+    """Get the process-wide response cache, None when caching is disabled"""
+    global _cache
+    if not config.llm.enable_response_cache:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMResponseCache(config.llm.response_cache_path, config.llm.response_cache_ttl_seconds,
+                                      config.llm.response_cache_max_bytes)
+        return _cache
@@ -0,0 +1,287 @@
+"""
+Schema Linker
+Picks the tables and columns a question needs so SQL prompts carry only that part of the schema
+"""
+
+import re
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Any, List, Optional, Set, Tuple
+import numpy as np
+from src.agents.token_usage import count_tokens
+from src.database import DatabaseManager
+from src.database.olist_schema import OLIST_JOINS, OLIST_ZIP_JOINS
+from src.database.order_facts import ORDER_FACTS_TABLE, ORDER_FACTS_JOINS, SOURCE_TABLES
+from src.database.zip_centroids import ZIP_CENTROIDS_TABLE, GEOLOCATION_TABLE, ZIP_CENTROIDS_JOINS
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Share of the best table's score another table needs to be sent
+MIN_RELATIVE_SCORE = 0.25
+
+_STOPWORDS = {
+    'a', 'an', 'and', 'are', 'by', 'each', 'for', 'from', 'how', 'in', 'is', 'it', 'me', 'most', 'of', 'on',
+    'or', 'per', 'show', 'than', 'that', 'the', 'to', 'top', 'what', 'which', 'with', 'give', 'list', 'all',
+}
+
+# Question words mapped to the words column names use for the same idea
+_SYNONYMS = {
+    'revenue': {'price', 'payment', 'value', 'total'},
+    'sale': {'price', 'item', 'total'},
+    'sold': {'item', 'price'},
+    'spend': {'payment', 'value', 'price'},
+    'spent': {'payment', 'value', 'price'},
+    'money': {'payment', 'value', 'price'},
+    'rating': {'review', 'score'},
+    'satisfaction': {'review', 'score'},
+    'late': {'delay', 'late', 'estimated', 'delivery'},
+    'delay': {'delay', 'late', 'estimated', 'delivery'},
+    'ship': {'freight', 'carrier', 'delivery'},
+    'shipping': {'freight', 'carrier', 'delivery'},
+    'deliver': {'delivered', 'delivery'},
+    'where': {'city', 'state'},
+    'region': {'state', 'city'},
+    'location': {'city', 'state', 'lat', 'lng', 'zip'},
+    'distance': {'lat', 'lng', 'zip'},
+    'month': {'purchase', 'month', 'timestamp'},
+    'year': {'purchase', 'timestamp'},
+    'trend': {'purchase', 'month', 'timestamp'},
+    'date': {'purchase', 'timestamp', 'date'},
+    'buyer': {'customer'},
+    'client': {'customer'},
+    'vendor': {'seller'},
+    'merchant': {'seller'},
+    'pay': {'payment', 'type'},
+    'installment': {'installments', 'payment'},
+    'categorie': {'category'},
+}
+
+
+def _stem(word: str) -> str:
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def _tokens(text: str) -> Set[str]:
+    """Lowercased, singular word tokens without stopwords; underscores split words"""
+    return {_stem(word) for word in re.findall(r'[a-z0-9]+', text.lower().replace('_', ' ')) if word not in _STOPWORDS}
+
+
+@dataclass
+class LinkedSchema:
+    """The part of the schema sent for one question"""
+    description: str
+    tables: List[str]
+    columns: Dict[str, List[str]]
+    join_paths: List[str] = field(default_factory=list)
+    full_tokens: int = 0  # Estimated tokens of the whole schema description
+    linked_tokens: int = 0  # Estimated tokens of the description actually sent
+
+
+class SchemaLinker:
+    """
+    Ranks tables and columns by their relevance to a question
+    
+    Question words (with a few domain synonyms) are matched against table
+    names, column names and the frequent values of text columns; when a
+    sentence embedder is available, similarity between the question and
+    each table's column list adds to the score. The best tables are
+    connected along the known join graph, wide tables are cut down to the
+    matching columns and join keys, and the join paths are listed with the
+    schema. Questions that match nothing get the full schema.
+    """
+    
+    def __init__(self, db_manager: DatabaseManager, max_tables: int = 4, max_columns: int = 12,
+                 embedder: Optional[Callable[[List[str]], np.ndarray]] = None):
+        self.db_manager = db_manager
+        self.max_tables = max_tables
+        self.max_columns = max_columns
+        self.embedder = embedder
+        self.key_joins = OLIST_JOINS + ORDER_FACTS_JOINS
+        self.zip_joins = OLIST_ZIP_JOINS + ZIP_CENTROIDS_JOINS
+        self.totals = {'questions': 0, 'pruned': 0, 'full_tokens': 0, 'linked_tokens': 0}
+        self._table_vectors: Dict[str, np.ndarray] = {}
+        self._vectors_version: Optional[str] = None
+        self._lock = threading.Lock()
+    
+    def link(self, question: str) -> LinkedSchema:
+        """Build the schema description for a question, recording its size against the full one"""
+        full = self.db_manager.get_schema_description()
+        scores = self._score(question)
+        tables = self._select_tables(scores)
+        
+        if tables:
+            columns = self._select_columns(tables, scores)
+            joins = self._joins_between(tables)
+            description = self.db_manager.get_schema_description(tables, columns)
+            if joins:
+                description += "\n\n## Join paths\n" + "\n".join(f"  - {join}" for join in joins)
+            linked = LinkedSchema(description, tables, columns, joins)
+        else:
+            linked = LinkedSchema(full, list(self.db_manager.schema_info), {})
+        
+        linked.full_tokens = count_tokens(full)
+        linked.linked_tokens = count_tokens(linked.description)
+        with self._lock:
+            self.totals['questions'] += 1
+            self.totals['pruned'] += bool(tables)
+            self.totals['full_tokens'] += linked.full_tokens
+            self.totals['linked_tokens'] += linked.linked_tokens
+        logger.info(f"Schema linked to {linked.tables}: ~{linked.full_tokens} -> ~{linked.linked_tokens} tokens")
+        return linked
+    
+    def _score(self, question: str) -> Dict[str, Dict[str, float]]:
+        """Relevance of every column, with the table's own score under the empty name"""
+        words = _tokens(question)
+        terms = set(words)
+        for word in words:
+            terms |= _SYNONYMS.get(word, set())
+        similarities = self._table_similarities(question)
+        
+        # A word in many table names ('order') says little about which of them is meant
+        table_words = {table: _tokens(table) for table in self.db_manager.schema_info}
+        spread: Dict[str, int] = {}
+        for table_tokens in table_words.values():
+            for word in table_tokens:
+                spread[word] = spread.get(word, 0) + 1
+        
+        scores: Dict[str, Dict[str, float]] = {}
+        for table, info in self.db_manager.schema_info.items():
+            table_stats = self.db_manager.statistics.get(table, {})
+            column_scores = {}
+            for col in info['columns']:
+                name = col['column_name']
+                # Column prefixes repeating the table name ('product_' in products) are not matched
+                score = float(len(terms & (_tokens(name) - table_words[table])))
+                # Values like 'credit_card' or 'delivered' point at the column holding them
+                top_values = table_stats.get(name, {}).get('top_values') or []
+                if any(isinstance(value, str) and _tokens(value) and _tokens(value) <= words for value in top_values):
+                    score += 2
+                column_scores[name] = score
+            table_score = sum(2 / spread[word] for word in terms & table_words[table]) + sum(sorted(column_scores.values(), reverse=True)[:3])
+            column_scores[''] = table_score + 3 * similarities.get(table, 0.0)
+            scores[table] = column_scores
+        return scores
+    
+    def _table_similarities(self, question: str) -> Dict[str, float]:
+        """Cosine similarity between the question and each table's name and columns, when an embedder is set"""
+        if not self.embedder:
+            return {}
+        try:
+            with self._lock:
+                if self._vectors_version != self.db_manager.data_version:
+                    tables = list(self.db_manager.schema_info)
+                    texts = [f"{table}: " + ", ".join(col['column_name'] for col in self.db_manager.schema_info[table]['columns'])
+                             for table in tables]
+                    self._table_vectors = dict(zip(tables, self.embedder(texts))) if tables else {}
+                    self._vectors_version = self.db_manager.data_version
+                table_vectors = dict(self._table_vectors)
+            vector = self.embedder([question])[0]
+            return {table: max(0.0, float(table_vector @ vector)) for table, table_vector in table_vectors.items()}
+        except Exception as e:
+            logger.warning(f"Schema linking without embeddings: {e}")
+            return {}
+    
+    def _select_tables(self, scores: Dict[str, Dict[str, float]]) -> List[str]:
+        """The best-scoring tables, preferring order_facts over the source tables it already joins"""
+        best = max((columns[''] for columns in scores.values()), default=0.0)
+        if best < 1:
+            return []
+        # Tables far behind the best match are incidental hits on a single column name
+        ranked = sorted((table for table, columns in scores.items() if columns[''] >= max(1.0, best * MIN_RELATIVE_SCORE)),
+                        key=lambda table: scores[table][''], reverse=True)[:self.max_tables]
+        if GEOLOCATION_TABLE in ranked and ZIP_CENTROIDS_TABLE in scores:
+            ranked = [table for table in ranked if table != GEOLOCATION_TABLE]
+            if ZIP_CENTROIDS_TABLE not in ranked:
+                ranked.append(ZIP_CENTROIDS_TABLE)
+        
+        if ORDER_FACTS_TABLE in scores and any(table in SOURCE_TABLES for table in ranked):
+            fact_columns = set(scores[ORDER_FACTS_TABLE]) - {''}
+            if ORDER_FACTS_TABLE not in ranked:
+                ranked.append(ORDER_FACTS_TABLE)
+            # A source table only stays if it has a matching column the fact table lacks
+            ranked = [table for table in ranked if table not in SOURCE_TABLES or any(
+                score > 0 and name not in fact_columns for name, score in scores[table].items() if name)]
+        return self._connect(ranked)
+    
+    def _connect(self, tables: List[str]) -> List[str]:
+        """Add the tables on the shortest key-join paths between the selected ones"""
+        key_graph = self._graph(self.key_joins)
+        # Location tables only connect through the zip code of a customer or seller
+        zip_graph = self._graph(self.key_joins + self.zip_joins)
+        
+        connected = [tables[0]]
+        for table in tables[1:]:
+            if table in connected:
+                continue
+            path = self._shortest_path(key_graph, table, set(connected)) or \
+                self._shortest_path(zip_graph, table, set(connected))
+            connected += [step for step in path if step not in connected] if path else [table]
+        return connected
+    
+    def _graph(self, joins: List[Tuple[str, str, str, str]]) -> Dict[str, Set[str]]:
+        """Adjacency of the loaded tables along the given joins"""
+        graph: Dict[str, Set[str]] = {}
+        for left, _, right, _ in joins:
+            if left in self.db_manager.schema_info and right in self.db_manager.schema_info:
+                graph.setdefault(left, set()).add(right)
+                graph.setdefault(right, set()).add(left)
+        return graph
+    
+    @staticmethod
+    def _shortest_path(graph: Dict[str, Set[str]], start: str, targets: Set[str]) -> Optional[List[str]]:
+        """Breadth-first path from start to the nearest target, excluding the target itself"""
+        previous = {start: None}
+        queue = deque([start])
+        while queue:
+            node = queue.popleft()
+            if node in targets:
+                path = []
+                node = previous[node]
+                while node is not None:
+                    path.append(node)
+                    node = previous[node]
+                return path
+            for neighbour in graph.get(node, ()):
+                if neighbour not in previous:
+                    previous[neighbour] = node
+                    queue.append(neighbour)
+        return None
+    
+    def _join_edges(self, tables: List[str]) -> List[Tuple[str, str, str, str]]:
+        selected = set(tables)
+        return [join for join in self.key_joins + self.zip_joins if join[0] in selected and join[2] in selected]
+    
+    def _joins_between(self, tables: List[str]) -> List[str]:
+        """Join conditions among the selected tables"""
+        return [f"{left}.{left_col} = {right}.{right_col}" for left, left_col, right, right_col in self._join_edges(tables)]
+    
+    def _select_columns(self, tables: List[str], scores: Dict[str, Dict[str, float]]) -> Dict[str, List[str]]:
+        """Matching columns and join keys of wide tables; narrow tables are listed whole"""
+        join_keys: Dict[str, Set[str]] = {}
+        for left, left_col, right, right_col in self._join_edges(tables):
+            join_keys.setdefault(left, set()).add(left_col)
+            join_keys.setdefault(right, set()).add(right_col)
+        
+        columns = {}
+        for table in tables:
+            names = [col['column_name'] for col in self.db_manager.schema_info[table]['columns']]
+            if len(names) <= self.max_columns:
+                continue
+            keep = {name for name in names if scores[table].get(name, 0) > 0} | join_keys.get(table, set())
+            keep.add(names[0])
+            columns[table] = [name for name in names if name in keep]
+        return columns
+    
+    def stats(self) -> Dict[str, Any]:
+        """Questions linked and the estimated prompt tokens saved"""
+        with self._lock:
+            totals = dict(self.totals)
+        saved = totals['full_tokens'] - totals['linked_tokens']
+        return {**totals, 'tokens_saved': saved,
+                'saved_ratio': saved / totals['full_tokens'] if totals['full_tokens'] else 0.0}
@@ -0,0 +1,201 @@
+"""
+Semantic SQL Cache
+Past questions embedded with a local sentence model, mapped to the SQL that answered them
+"""
+
+import importlib.util
+import json
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Any, List, Optional
+import numpy as np
+from src.config import config
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+_cache: Optional["SemanticSQLCache"] = None
+_cache_unavailable = False
+_cache_lock = threading.Lock()
+
+EMBEDDINGS_FILE = "embeddings.npy"
+ENTRIES_FILE = "entries.json"
+
+
+@dataclass
+class SemanticMatch:
+    """The cached question closest to a new one"""
+    question: str
+    sql: str
+    data_version: str
+    similarity: float
+    reusable: bool  # Close enough to run the cached SQL as-is; otherwise only a hint
+
+
+class SentenceEmbedder:
+    """Local sentence-transformers model, loaded on first use"""
+    
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+    
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+                self._model = SentenceTransformer(self.model_name)
+                logger.info(f"Loaded sentence embedding model {self.model_name}")
+        return np.asarray(self._model.encode(texts, normalize_embeddings=True), dtype=np.float32)
+
+
+class SemanticSQLCache:
+    """
+    Question embeddings mapped to SQL that ran successfully
+    
+    New questions are compared by cosine similarity against every stored
+    question. At reuse_threshold the cached SQL is run directly; between
+    hint_threshold and reuse_threshold it is shown to the model as an
+    example. The index is a NumPy matrix and a JSON list beside it, saved
+    after every change and capped at max_entries, dropping the least
+    recently used questions.
+    """
+    
+    def __init__(self, index_dir: Optional[Path], embedder: Callable[[List[str]], np.ndarray],
+                 reuse_threshold: float, hint_threshold: float, max_entries: int):
+        self.index_dir = index_dir
+        self.embedder = embedder
+        self.reuse_threshold = reuse_threshold
+        self.hint_threshold = hint_threshold
+        self.max_entries = max_entries
+        self.entries: List[Dict[str, Any]] = []
+        self.embeddings: Optional[np.ndarray] = None
+        self.counts = {'reused': 0, 'hinted': 0, 'missed': 0}
+        self._lock = threading.Lock()
+        self._load()
+    
+    def _load(self):
+        """Read the persisted index, starting empty if it is missing or inconsistent"""
+        if not self.index_dir or not (self.index_dir / ENTRIES_FILE).exists():
+            return
+        try:
+            with open(self.index_dir / ENTRIES_FILE, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            embeddings = np.load(self.index_dir / EMBEDDINGS_FILE)
+            if len(entries) == len(embeddings):
+                self.entries, self.embeddings = entries, embeddings
+                logger.info(f"Semantic SQL cache loaded with {len(entries)} questions")
+        except Exception as e:
+            logger.warning(f"Could not load semantic SQL cache: {e}")
+    
+    def _save(self):
+        """Write the matrix and entries through temporary files so a crash leaves the previous index"""
+        if not self.index_dir:
+            return
+        try:
+            self.index_dir.mkdir(parents=True, exist_ok=True)
+            tmp_embeddings = self.index_dir / f"{EMBEDDINGS_FILE}.tmp"
+            with open(tmp_embeddings, 'wb') as f:
+                np.save(f, self.embeddings if self.embeddings is not None else np.zeros((0, 0), dtype=np.float32))
+            tmp_entries = self.index_dir / f"{ENTRIES_FILE}.tmp"
+            with open(tmp_entries, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, indent=2)
+            tmp_embeddings.replace(self.index_dir / EMBEDDINGS_FILE)
+            tmp_entries.replace(self.index_dir / ENTRIES_FILE)
+        except Exception as e:
+            logger.error(f"Error saving semantic SQL cache: {e}")
+    
+    def lookup(self, question: str) -> Optional[SemanticMatch]:
+        """Find the most similar cached question above the hint threshold"""
+        if not self.entries:
+            with self._lock:
+                self.counts['missed'] += 1
+            return None
+        vector = self.embedder([question])[0]
+        with self._lock:
+            if not self.entries:
+                self.counts['missed'] += 1
+                return None
+            similarities = self.embeddings @ vector
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.hint_threshold:
+                self.counts['missed'] += 1
+                return None
+            
+            entry = self.entries[best]
+            entry['last_used_at'] = time.time()
+            reusable = similarity >= self.reuse_threshold
+            self.counts['reused' if reusable else 'hinted'] += 1
+            return SemanticMatch(entry['question'], entry['sql'], entry['data_version'], similarity, reusable)
+    
+    def add(self, question: str, sql: str, data_version: str):
+        """Remember the SQL that answered a question, replacing an earlier answer to the same question"""
+        vector = self.embedder([question])[0]
+        with self._lock:
+            self._remove(question)
+            entry = {'question': question, 'sql': sql, 'data_version': data_version,
+                     'created_at': time.time(), 'last_used_at': time.time()}
+            self.entries.append(entry)
+            row = vector.reshape(1, -1).astype(np.float32)
+            self.embeddings = row if self.embeddings is None or not len(self.embeddings) \
+                else np.vstack([self.embeddings, row])
+            
+            if len(self.entries) > self.max_entries:
+                keep = sorted(range(len(self.entries)), key=lambda i: self.entries[i]['last_used_at'])
+                keep = sorted(keep[-self.max_entries:])
+                self.entries = [self.entries[i] for i in keep]
+                self.embeddings = self.embeddings[keep]
+            self._save()
+    
+    def confirm(self, question: str, data_version: str):
+        """Record that a question's SQL is still valid for a newer data version"""
+        with self._lock:
+            for entry in self.entries:
+                if entry['question'] == question:
+                    entry['data_version'] = data_version
+            self._save()
+    
+    def remove(self, question: str):
+        """Forget a question whose SQL no longer works"""
+        with self._lock:
+            if self._remove(question):
+                self._save()
+    
+    def _remove(self, question: str) -> bool:
+        """Drop a question's entry and embedding, returning False if it was not cached"""
+        keep = [i for i, entry in enumerate(self.entries) if entry['question'] != question]
+        if len(keep) == len(self.entries):
+            return False
+        self.entries = [self.entries[i] for i in keep]
+        self.embeddings = self.embeddings[keep]
+        return True
+    
+    def stats(self) -> Dict[str, Any]:
+        """Stored questions and how lookups were answered in this process"""
+        with self._lock:
+            lookups = sum(self.counts.values())
+            return {
+                'entries': len(self.entries),
+                **self.counts,
+                'reuse_ratio': self.counts['reused'] / lookups if lookups else 0.0,
+            }
+
+
+def get_semantic_cache() -> Optional[SemanticSQLCache]:
+    """Get the process-wide semantic SQL cache, None when disabled or sentence-transformers is not installed"""
+    global _cache, _cache_unavailable
+    if not config.llm.enable_semantic_sql_cache or _cache_unavailable:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            if importlib.util.find_spec('sentence_transformers') is None:
+                logger.warning("sentence-transformers is not installed, semantic SQL cache disabled")
+                _cache_unavailable = True
+                return None
+            _cache = SemanticSQLCache(config.llm.semantic_cache_dir, SentenceEmbedder(config.llm.semantic_cache_model),
+                                      config.llm.semantic_reuse_threshold, config.llm.semantic_hint_threshold,
+                                      config.llm.semantic_cache_max_entries)
+        return _cache
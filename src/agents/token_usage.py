@@ -0,0 +1,190 @@
+"""
+Token Usage
+Prompt and completion tokens of every LLM call, attributed to agent, session and question
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+from src.config import config
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+_tracker: Optional["TokenUsageTracker"] = None
+_tracker_lock = threading.Lock()
+
+_encoding = None
+_encoding_unavailable = False
+
+# Rough characters per token when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+
+# Session and question the LLM calls of the current request are charged to
+_usage_scope: ContextVar[Tuple[Optional[str], Optional[str]]] = ContextVar('token_usage_scope', default=(None, None))
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens of a text with tiktoken's cl100k_base encoding
+    
+    Gemini tokenizes differently, so this is an estimate; it is only used
+    when the API response carries no usage metadata, and for prompt
+    sections, which the API does not break down.
+    """
+    global _encoding, _encoding_unavailable
+    if not text:
+        return 0
+    if _encoding is None and not _encoding_unavailable:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"tiktoken unavailable, estimating tokens from length: {e}")
+            _encoding_unavailable = True
+    if _encoding is None:
+        return max(1, len(text) // CHARS_PER_TOKEN)
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+@contextmanager
+def usage_scope(session_id: Optional[str], question_id: Optional[str]) -> Iterator[None]:
+    """Charge the LLM calls made inside the block to a session and question"""
+    token = _usage_scope.set((session_id, question_id))
+    try:
+        yield
+    finally:
+        _usage_scope.reset(token)
+
+
+def current_usage_scope() -> Tuple[Optional[str], Optional[str]]:
+    """Session and question id of the LLM calls being made now"""
+    return _usage_scope.get()
+
+
+@dataclass
+class TokenUsage:
+    """Tokens of one LLM call"""
+    agent: str
+    session_id: Optional[str]
+    question_id: Optional[str]
+    prompt_tokens: int
+    completion_tokens: int
+    cached: bool  # Answered from the response cache, so no tokens were spent
+    source: str  # 'api' when the model reported usage, 'estimate' when counted locally
+    sections: Dict[str, int] = field(default_factory=dict)  # Estimated tokens of each named prompt section
+    recorded_at: float = field(default_factory=time.time)
+
+
+def _empty_totals() -> Dict[str, int]:
+    return {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached_calls': 0, 'cached_tokens': 0}
+
+
+class TokenUsageTracker:
+    """
+    In-process totals of tokens spent per agent, session and prompt section
+    
+    Totals per (session, agent) and per (session, agent, section) are kept
+    for the life of the process; the individual calls are kept for the
+    most recent max_records, which is enough to break down a question.
+    Responses served from the cache count as cached calls and their
+    tokens as saved, not spent.
+    """
+    
+    def __init__(self, max_records: int = 5000):
+        self.records: "deque[TokenUsage]" = deque(maxlen=max_records)
+        self._totals: Dict[Tuple[Optional[str], str], Dict[str, int]] = {}
+        self._sections: Dict[Tuple[Optional[str], str, str], int] = {}
+        self._lock = threading.Lock()
+    
+    def record(self, usage: TokenUsage):
+        """Add one call to the totals"""
+        with self._lock:
+            self.records.append(usage)
+            totals = self._totals.setdefault((usage.session_id, usage.agent), _empty_totals())
+            totals['calls'] += 1
+            if usage.cached:
+                totals['cached_calls'] += 1
+                totals['cached_tokens'] += usage.prompt_tokens + usage.completion_tokens
+                return
+            totals['prompt_tokens'] += usage.prompt_tokens
+            totals['completion_tokens'] += usage.completion_tokens
+            for section, tokens in usage.sections.items():
+                key = (usage.session_id, usage.agent, section)
+                self._sections[key] = self._sections.get(key, 0) + tokens
+    
+    def summary(self, session_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Tokens spent overall and per agent and prompt section
+        
+        Args:
+            session_id: Only count this session's calls (defaults to every session)
+        """
+        with self._lock:
+            by_agent: Dict[str, Dict[str, int]] = {}
+            for (session, agent), totals in self._totals.items():
+                if session_id is None or session == session_id:
+                    agent_totals = by_agent.setdefault(agent, _empty_totals())
+                    for name, value in totals.items():
+                        agent_totals[name] += value
+            by_section: Dict[str, Dict[str, int]] = {}
+            for (session, agent, section), tokens in self._sections.items():
+                if session_id is None or session == session_id:
+                    agent_sections = by_section.setdefault(agent, {})
+                    agent_sections[section] = agent_sections.get(section, 0) + tokens
+        
+        overall = _empty_totals()
+        for totals in by_agent.values():
+            for name, value in totals.items():
+                overall[name] += value
+        overall['total_tokens'] = overall['prompt_tokens'] + overall['completion_tokens']
+        return {'session_id': session_id, **overall, 'by_agent': by_agent, 'by_section': by_section}
+    
+    def question_usage(self, question_id: str) -> Dict[str, Any]:
+        """Tokens spent answering one question, from the recent calls"""
+        with self._lock:
+            calls = [usage for usage in self.records if usage.question_id == question_id]
+        spent = [usage for usage in calls if not usage.cached]
+        by_agent: Dict[str, int] = {}
+        for usage in spent:
+            by_agent[usage.agent] = by_agent.get(usage.agent, 0) + usage.prompt_tokens + usage.completion_tokens
+        return {
+            'calls': len(calls),
+            'cached_calls': len(calls) - len(spent),
+            'prompt_tokens': sum(usage.prompt_tokens for usage in spent),
+            'completion_tokens': sum(usage.completion_tokens for usage in spent),
+            'by_agent': by_agent,
+        }
+    
+    def sessions(self) -> List[str]:
+        """Sessions with recorded calls"""
+        with self._lock:
+            return sorted({session for session, _ in self._totals if session is not None})
+    
+    def recent(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """The most recent calls, newest first"""
+        with self._lock:
+            calls = list(self.records)[-limit:]
+        return [asdict(usage) for usage in reversed(calls)]
+    
+    def reset(self):
+        """Drop every recorded call and total"""
+        with self._lock:
+            self.records.clear()
+            self._totals.clear()
+            self._sections.clear()
+
+
+def get_token_tracker() -> Optional[TokenUsageTracker]:
+    """Get the process-wide token usage tracker, None when token accounting is disabled"""
+    global _tracker
+    if not config.llm.enable_token_accounting:
+        return None
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = TokenUsageTracker(config.llm.token_usage_max_records)
+        return _tracker
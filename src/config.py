@@ -31,6 +31,21 @@ class LLMConfig(BaseModel):
     default_model: str = Field(default="gemini-2.0-flash")
     temperature: float = Field(default=0.1)
     max_tokens: int = Field(default=4096)
+    enable_response_cache: bool = Field(default=True)  # Answer repeated prompts from a disk cache
+    response_cache_path: Optional[Path] = Field(default=DATA_DIR / "llm_cache.sqlite")  # None keeps the cache in memory
+    response_cache_ttl_seconds: int = Field(default=7 * 24 * 3600)
+    response_cache_max_bytes: int = Field(default=64 * 1024 * 1024)  # Least recently used responses are evicted past this
+    enable_semantic_sql_cache: bool = Field(default=True)  # Reuse SQL of similar past questions (needs sentence-transformers)
+    semantic_cache_model: str = Field(default="all-MiniLM-L6-v2")
+    semantic_cache_dir: Optional[Path] = Field(default=DATA_DIR / "semantic_sql_cache")  # None keeps the index in memory
+    semantic_reuse_threshold: float = Field(default=0.92)  # Similarity at which cached SQL runs without asking the model
+    semantic_hint_threshold: float = Field(default=0.75)  # Similarity at which cached SQL is shown to the model as an example
+    semantic_cache_max_entries: int = Field(default=2000)
+    enable_schema_linking: bool = Field(default=True)  # Send only the tables and columns relevant to the question
+    schema_link_max_tables: int = Field(default=4)  # Best-matching tables kept before join paths are added
+    schema_link_max_columns: int = Field(default=12)  # Wider tables are cut down to matching columns and join keys
+    enable_token_accounting: bool = Field(default=True)  # Count prompt and completion tokens of every LLM call
+    token_usage_max_records: int = Field(default=5000)  # Individual calls kept for per-question breakdowns
 
 
 class DatabaseConfig(BaseModel):
@@ -38,6 +53,40 @@ class DatabaseConfig(BaseModel):
     database_path: Path = Field(default=DATA_DIR / "ecommerce.db")
     max_query_results: int = Field(default=1000)
     query_timeout: int = Field(default=30)
+    count_truncated_results: bool = Field(default=False)  # Run a COUNT(*) to report the size of truncated results
+    read_only: bool = Field(default=False)  # Open the shared engine read-only (disables loading); queries are always read-only
+    connection_pool_size: int = Field(default=8)  # Queries that may run at once across all sessions
+    threads: Optional[int] = Field(default=None)  # DuckDB worker threads, None for one per core
+    memory_limit: Optional[str] = Field(default=None)  # DuckDB memory limit such as '4GB'
+    parallel_ingest: bool = Field(default=True)
+    enable_snapshots: bool = Field(default=True)
+    snapshot_dir: Optional[Path] = Field(default=None)  # Defaults to <db name>_snapshots beside the database
+    replica_role: str = Field(default='standalone')  # 'writer' publishes snapshots after each load, 'reader' serves the latest
+    replica_dir: Optional[Path] = Field(default=None)  # Defaults to <db name>_replicas beside the database
+    replica_keep_versions: int = Field(default=3)  # Published snapshots kept for readers still on an older one
+    replica_poll_seconds: float = Field(default=5.0)  # How often readers check for a newer snapshot
+    partitioned_storage: bool = Field(default=False)  # Keep order tables as month-partitioned Parquet behind views
+    partition_dir: Optional[Path] = Field(default=None)  # Defaults to <db name>_partitions beside the database
+    enable_query_cache: bool = Field(default=True)
+    enable_column_stats: bool = Field(default=True)  # Compute per-column statistics at ingest
+    enable_rollups: bool = Field(default=True)  # Build rollup tables and route matching aggregates to them
+    enable_sampling: bool = Field(default=True)  # Keep table samples for approximate queries
+    approx_sample_rate: float = Field(default=0.1)  # Share of rows kept in each table sample
+    approx_min_table_rows: int = Field(default=100_000)  # Smaller tables are always queried exactly
+    approx_confidence: float = Field(default=0.95)  # Confidence level of approximate answers' intervals
+    query_cache_max_bytes: int = Field(default=256 * 1024 * 1024)
+    enable_query_log: bool = Field(default=True)  # Keep a persistent log of query timings beside the database
+    profile_queries: bool = Field(default=False)  # Collect DuckDB operator profiles for every query
+    slow_query_ms: int = Field(default=1000)  # Slower queries are kept with their plan in the slow-query log
+    enable_cost_governor: bool = Field(default=True)  # Classify queries by their EXPLAIN estimates before running them
+    heavy_query_rows: int = Field(default=5_000_000)  # Estimated rows scanned or produced that make a query heavy
+    reject_query_rows: int = Field(default=1_000_000_000)  # Estimated operator output that gets a query rejected
+    heavy_query_policy: str = Field(default='queue')  # 'run', 'approximate' (from a sample when possible) or 'queue'
+    heavy_query_concurrency: int = Field(default=1)  # Heavy queries that may run at once when queued
+    enable_result_store: bool = Field(default=True)  # Keep full results server-side for paging in the UI
+    max_stored_results: int = Field(default=50)  # Least recently used results past this are deleted
+    result_dir: Optional[Path] = Field(default=None)  # Parent of the result directory, None for the system temp dir
+    result_page_size: int = Field(default=100)  # Rows per page of a stored result
 
 
 class MemoryConfig(BaseModel):
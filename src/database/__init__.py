@@ -2,6 +2,7 @@
 Database package initialization
 """
 
-from src.database.db_manager import DatabaseManager
+from src.database.db_manager import DatabaseManager, QueryResult
+from src.database.query_control import QueryHandle, QueryTimeoutError, QueryCancelledError
 
-__all__ = ['DatabaseManager']
+__all__ = ['DatabaseManager', 'QueryResult', 'QueryHandle', 'QueryTimeoutError', 'QueryCancelledError']
@@ -0,0 +1,155 @@
+"""
+Cost Governor
+Pre-execution cost estimates from DuckDB's EXPLAIN plan, and the policy applied to heavy queries
+"""
+
+import json
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Any, Iterator, List, Optional
+import duckdb
+from src.database.query_control import QueryTimeoutError
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+CHEAP, HEAVY, PATHOLOGICAL = 'cheap', 'heavy', 'pathological'
+
+# Actions taken on a query after classification
+RUN, APPROXIMATE, QUEUE, REJECT = 'run', 'approximate', 'queue', 'reject'
+
+# Operators that read a base relation, and joins that pair every row of one side with every row of the other
+_SCAN_OPERATORS = {'SEQ_SCAN', 'TABLE_SCAN', 'READ_PARQUET', 'READ_CSV', 'READ_CSV_AUTO', 'PARQUET_SCAN'}
+_CROSS_OPERATORS = {'CROSS_PRODUCT', 'NESTED_LOOP_JOIN', 'BLOCKWISE_NL_JOIN'}
+
+
+class QueryRejectedError(Exception):
+    """Raised when a query's estimated cost is past the reject threshold"""
+    
+    def __init__(self, reason: str, cost: Optional["CostEstimate"] = None):
+        super().__init__(reason)
+        self.reason = reason
+        self.cost = cost
+
+
+@dataclass
+class CostEstimate:
+    """Planner estimates for one query and the class they put it in"""
+    cost_class: str
+    scanned_rows: int  # Rows of the base relations the plan reads
+    peak_rows: int  # Largest estimated operator output
+    tables: List[str] = field(default_factory=list)
+    cross_joins: int = 0
+    action: str = RUN
+    
+    def reason(self) -> str:
+        """Explanation of the class, phrased so the SQL can be rewritten to avoid it"""
+        parts = [f"estimated {self.peak_rows:,} intermediate rows from {self.scanned_rows:,} scanned rows"]
+        if self.cross_joins:
+            parts.append(f"{self.cross_joins} join(s) without an equality condition multiply the row counts")
+        if self.tables:
+            parts.append(f"tables read: {', '.join(self.tables)}")
+        return "; ".join(parts)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class CostGovernor:
+    """
+    Classifies queries by their EXPLAIN estimates before they run
+    
+    Queries whose largest operator or total scan stays under heavy_rows
+    run normally. Heavy queries are estimated from a sample, queued behind
+    a small number of concurrent heavy slots, or run anyway, depending on
+    the policy. Queries whose largest operator reaches reject_rows
+    (typically a join missing its condition) are rejected with a reason.
+    """
+    
+    def __init__(self, heavy_rows: int, reject_rows: int, heavy_policy: str, heavy_concurrency: int):
+        if heavy_policy not in (RUN, APPROXIMATE, QUEUE):
+            raise ValueError(f"Unknown heavy query policy: {heavy_policy}")
+        self.heavy_rows = heavy_rows
+        self.reject_rows = reject_rows
+        self.heavy_policy = heavy_policy
+        self._heavy_slots = threading.BoundedSemaphore(max(1, heavy_concurrency))
+        self.decisions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    def estimate(self, cursor: duckdb.DuckDBPyConnection, query: str,
+                 row_counts: Optional[Dict[str, int]] = None) -> CostEstimate:
+        """
+        Estimate a query's cost from its physical plan without running it
+        
+        Args:
+            cursor: Cursor to plan the query on
+            query: SQL to estimate, as it will be executed
+            row_counts: Known table sizes, used for scans instead of their post-filter estimates
+        """
+        plan = json.loads(cursor.execute(f"EXPLAIN (FORMAT JSON) {query}").fetchall()[0][1])
+        row_counts = row_counts or {}
+        totals = {'scanned': 0, 'peak': 0, 'cross': 0, 'tables': []}
+        
+        def visit(node: Dict[str, Any]) -> int:
+            children = [visit(child) for child in node.get('children', [])]
+            name = node.get('name', '').strip().upper()
+            info = node.get('extra_info') or {}
+            estimate = info.get('Estimated Cardinality') if isinstance(info, dict) else None
+            
+            if name in _CROSS_OPERATORS and len(children) == 2:
+                totals['cross'] += 1
+                rows = children[0] * children[1]
+            elif estimate is not None:
+                rows = int(estimate)
+            else:
+                rows = max(children, default=0)
+            
+            if name in _SCAN_OPERATORS:
+                table = str(info.get('Table', info.get('Function', name))).split('.')[-1]
+                totals['tables'].append(table)
+                totals['scanned'] += row_counts.get(table, rows)
+            totals['peak'] = max(totals['peak'], rows)
+            return rows
+        
+        for root in plan:
+            visit(root)
+        
+        peak, scanned = totals['peak'], totals['scanned']
+        if peak >= self.reject_rows:
+            cost_class = PATHOLOGICAL
+        elif max(peak, scanned) >= self.heavy_rows:
+            cost_class = HEAVY
+        else:
+            cost_class = CHEAP
+        return CostEstimate(cost_class, scanned, peak, sorted(set(totals['tables'])), totals['cross'])
+    
+    def decide(self, cost: CostEstimate, can_approximate: bool) -> str:
+        """Choose the action for a classified query and count it"""
+        if cost.cost_class == PATHOLOGICAL:
+            action = REJECT
+        elif cost.cost_class == HEAVY:
+            action = self.heavy_policy
+            if action == APPROXIMATE and not can_approximate:
+                action = QUEUE
+        else:
+            action = RUN
+        cost.action = action
+        with self._lock:
+            self.decisions[action] = self.decisions.get(action, 0) + 1
+        return action
+    
+    @contextmanager
+    def heavy_slot(self, timeout: float) -> Iterator[None]:
+        """Wait for one of the heavy-query slots, giving up at the query's deadline"""
+        if not self._heavy_slots.acquire(timeout=timeout):
+            raise QueryTimeoutError(timeout)
+        try:
+            yield
+        finally:
+            self._heavy_slots.release()
+    
+    def stats(self) -> Dict[str, int]:
+        """Count of queries per action taken"""
+        with self._lock:
+            return dict(self.decisions)
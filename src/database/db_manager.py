@@ -3,114 +3,850 @@ Database Manager for E-Commerce Data
 Handles data loading, schema management, and SQL query execution
 """
 
+import asyncio
+import functools
+import re
+import threading
+import time
+import uuid
+import weakref
 import duckdb
 import pandas as pd
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Dict, List, Optional, Tuple, Any, Union
 from datetime import datetime
 from src.config import config
+from src.database.cost_governor import CostEstimate, CostGovernor, QueryRejectedError, CHEAP, HEAVY, APPROXIMATE, QUEUE, REJECT
+from src.database.engine import DuckDBEngine, get_engine, release_engine
+from src.database.order_facts import (
+    ORDER_FACTS_TABLE, ORDER_FACTS_DESCRIPTION, SOURCE_TABLES, INCREMENTAL_SOURCES,
+    build_order_facts, refresh_order_facts,
+)
+from src.database.partitions import PartitionStore, PARTITIONED_TABLES, PARTITION_NOTE
+from src.database.olist_schema import OLIST_TABLES, OLIST_TIMESTAMP_FORMAT, TYPE_MAP_VERSION, TableSpec, baseline_type
+from src.database.query_control import QueryHandle, QueryTimeoutError, QueryCancelledError
+from src.database.query_cache import QueryResultCache, normalize_sql, is_cacheable
+from src.database.query_log import QueryLog, enable_profiling, disable_profiling, read_profile
+from src.database.replicas import ReplicaStore, REPLICA_ROLES, READER, WRITER
+from src.database.result_store import ResultStore
+from src.database.rollups import RollupManager
+from src.database.sampling import SampleManager
+from src.database.schema_catalog import SchemaCatalog
+from src.database.snapshot_cache import SnapshotCache
+from src.database.sql_ast import sql_literal
+from src.database.statistics import StatisticsCatalog
+from src.database.table_delta import TableDelta, fetch_arrow
+from src.database.zip_centroids import (
+    ZIP_CENTROIDS_TABLE, ZIP_CENTROIDS_DESCRIPTION, GEOLOCATION_NOTE, GEOLOCATION_TABLE, build_zip_centroids,
+)
 from src.logger import get_logger
 
 logger = get_logger(__name__)
 
 
+def _arrow_reader(result: duckdb.DuckDBPyConnection, batch_rows: int) -> pa.RecordBatchReader:
+    """Stream a query result as Arrow record batches across DuckDB versions"""
+    if hasattr(result, 'to_arrow_reader'):
+        return result.to_arrow_reader(batch_rows)
+    return result.fetch_record_batch(batch_rows)
+
+
+# Statements that can be wrapped in an outer SELECT to push the row cap into the plan
+_ROW_SOURCE_PATTERN = re.compile(r"^\(*\s*(select|with|from|values)\b", re.IGNORECASE)
+_LEADING_COMMENTS_PATTERN = re.compile(r"^(\s*(--[^\n]*(\n|$)|/\*.*?\*/))*\s*", re.DOTALL)
+_TRAILING_NOISE_PATTERN = re.compile(r"(\s|;)+$")
+
+
+def _cap_query(query: str, row_limit: int) -> Optional[str]:
+    """
+    Wrap a row-returning query in an outer LIMIT so DuckDB stops early
+    
+    Returns None for statements that cannot be wrapped (PRAGMA, SHOW, ...).
+    The query is closed on its own line so a trailing line comment cannot
+    swallow the wrapper.
+    """
+    body = _TRAILING_NOISE_PATTERN.sub("", query)
+    if not _ROW_SOURCE_PATTERN.match(_LEADING_COMMENTS_PATTERN.sub("", body, count=1)):
+        return None
+    return f"SELECT * FROM (\n{body}\n) AS capped_result LIMIT {row_limit}"
+
+
+def _result_metadata(table: pa.Table) -> Dict[str, Any]:
+    """Read the truncation details stored on a cached Arrow result"""
+    metadata = table.schema.metadata or {}
+    total_rows = metadata.get(b'total_rows', b'').decode()
+    return {
+        'truncated': metadata.get(b'truncated') == b'True',
+        'total_rows': int(total_rows) if total_rows else None,
+        'rollup': metadata.get(b'rollup', b'').decode() or None,
+        'sample_fraction': float(metadata[b'sample_fraction']) if metadata.get(b'sample_fraction') else None,
+    }
+
+
+@dataclass
+class QueryResult:
+    """Result of a query run through DatabaseManager.run_query"""
+    data: pd.DataFrame
+    error: Optional[str] = None
+    error_type: Optional[str] = None  # 'blocked', 'rejected', 'timeout', 'cancelled' or 'execution'
+    query_id: Optional[str] = None
+    elapsed: float = 0.0
+    from_cache: bool = False
+    truncated: bool = False
+    total_rows: Optional[int] = None  # Exact row count, None if truncated and not counted
+    rollup: Optional[str] = None  # Rollup table that answered the query
+    sample_fraction: Optional[float] = None  # Share of rows read when the answer was estimated from a sample
+    confidence: Optional[float] = None  # Confidence level of the *_ci_low / *_ci_high columns
+    profile: Optional[Dict[str, Any]] = None  # DuckDB operator profile, when the query was profiled
+    cost: Optional[CostEstimate] = None  # Planner cost estimate and the action the governor took
+    result_id: Optional[str] = None  # Full result kept server-side, read with get_result_page
+    
+    @property
+    def approximate(self) -> bool:
+        return self.sample_fraction is not None
+    
+    @property
+    def success(self) -> bool:
+        return self.error is None
+
+
 class DatabaseManager:
     """Manages database operations for e-commerce data"""
     
     def __init__(self, db_path: Optional[Path] = None):
         self.db_path = db_path or config.database.database_path
+        self.session_id = uuid.uuid4().hex[:12]
+        self.engine: Optional[DuckDBEngine] = None
         self.conn = None
-        self.schema_info: Dict[str, Any] = {}
+        self.load_timings: Dict[str, float] = {}
+        self.load_sources: Dict[str, str] = {}
+        self._initialize_replicas()
         self._initialize_connection()
+    
+    def _initialize_replicas(self):
+        """
+        Set up the replica role: writers publish snapshots, readers open the latest one
+        
+        A reader's db_path names the writer's database; the session opens
+        the latest snapshot published for it instead, read-only.
+        """
+        self.replica_role = config.database.replica_role
+        if self.replica_role not in REPLICA_ROLES:
+            raise ValueError(f"Unknown replica role: {self.replica_role}")
+        self.replicas: Optional[ReplicaStore] = None
+        self._retired_engines: List[Tuple[DuckDBEngine, weakref.finalize]] = []
+        self._replica_checked = time.monotonic()
+        if self.replica_role not in (READER, WRITER):
+            return
         
+        replica_dir = config.database.replica_dir or Path(self.db_path).parent / f"{Path(self.db_path).stem}_replicas"
+        self.replicas = ReplicaStore(replica_dir, config.database.replica_keep_versions)
+        if self.replica_role == READER:
+            latest = self.replicas.latest()
+            if latest is None:
+                raise FileNotFoundError(f"No database snapshot has been published in {replica_dir}")
+            self.db_path = self.replicas.snapshot_path(latest)
+    
     def _initialize_connection(self):
-        """Initialize database connection"""
+        """Attach to the process-wide engine and open this session's cursor"""
         try:
-            self.conn = duckdb.connect(str(self.db_path))
+            self.engine = get_engine(Path(self.db_path), read_only=True if self.replica_role == READER else None)
+            self.conn = self.engine.cursor()
+            self._release = weakref.finalize(self, release_engine, self.engine, self.conn)
+            self._release.atexit = False
             logger.info(f"Database connection established: {self.db_path}")
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
             raise
+        
+        # The first session on an engine sets up the state every session shares
+        with self.engine.write_lock:
+            if self.engine.catalog is None:
+                self._initialize_shared_state()
+    
+    def _initialize_shared_state(self):
+        """Create the engine-wide caches and load the persisted schema catalog"""
+        if config.database.enable_query_cache:
+            self.engine.query_cache = QueryResultCache(config.database.query_cache_max_bytes)
+        
+        # Readers never load, so they keep no CSV snapshots or partitions beside the published files
+        reader = self.replica_role == READER
+        if config.database.enable_snapshots and not reader:
+            snapshot_dir = config.database.snapshot_dir or Path(self.db_path).parent / f"{Path(self.db_path).stem}_snapshots"
+            self.engine.snapshots = SnapshotCache(snapshot_dir)
+        
+        if config.database.partitioned_storage and not reader:
+            partition_dir = config.database.partition_dir or Path(self.db_path).parent / f"{Path(self.db_path).stem}_partitions"
+            self.engine.partitions = PartitionStore(partition_dir)
+        
+        if config.database.enable_rollups:
+            self.engine.rollups = RollupManager()
+        
+        if config.database.enable_sampling:
+            self.engine.samples = SampleManager(config.database.approx_sample_rate,
+                                                config.database.approx_min_table_rows,
+                                                config.database.approx_confidence)
+        
+        if config.database.enable_cost_governor:
+            self.engine.governor = CostGovernor(config.database.heavy_query_rows, config.database.reject_query_rows,
+                                                config.database.heavy_query_policy,
+                                                config.database.heavy_query_concurrency)
+        
+        if config.database.enable_result_store:
+            self.engine.results = ResultStore(config.database.max_stored_results, config.database.result_dir)
+        
+        on_disk = str(self.db_path) != ':memory:'
+        if config.database.enable_query_log:
+            # Reader processes cannot share one log file, so each keeps its log in memory
+            log_path = Path(self.db_path).with_suffix('.querylog.duckdb') if on_disk and not reader else None
+            self.engine.query_log = QueryLog(log_path, config.database.slow_query_ms)
+        
+        self.engine.catalog = SchemaCatalog(Path(self.db_path).with_suffix('.catalog.json') if on_disk else None)
+        self.engine.stats_catalog = StatisticsCatalog(Path(self.db_path).with_suffix('.stats.json') if on_disk else None)
+        self._load_schema_catalog()
+    
+    @property
+    def schema_info(self) -> Dict[str, Any]:
+        """Schema information shared by every session on this database"""
+        return self.engine.schema_info
+    
+    @schema_info.setter
+    def schema_info(self, value: Dict[str, Any]):
+        self.engine.schema_info = value
+    
+    @property
+    def data_version(self) -> str:
+        """Version of the loaded data, changed by every load or ingest that alters it"""
+        return self.engine.data_version
+    
+    @data_version.setter
+    def data_version(self, value: str):
+        self.engine.data_version = value
+    
+    @property
+    def catalog(self) -> SchemaCatalog:
+        return self.engine.catalog
+    
+    @property
+    def statistics(self) -> Dict[str, Dict[str, Any]]:
+        """Column statistics by table, for the current data version"""
+        return self.engine.statistics
+    
+    @statistics.setter
+    def statistics(self, value: Dict[str, Dict[str, Any]]):
+        self.engine.statistics = value
+    
+    @property
+    def snapshots(self) -> Optional[SnapshotCache]:
+        return self.engine.snapshots
     
-    def load_csv_data(self, data_dir: Path) -> Dict[str, int]:
+    @snapshots.setter
+    def snapshots(self, value: Optional[SnapshotCache]):
+        self.engine.snapshots = value
+    
+    @property
+    def partitions(self) -> Optional[PartitionStore]:
+        return self.engine.partitions
+    
+    @partitions.setter
+    def partitions(self, value: Optional[PartitionStore]):
+        self.engine.partitions = value
+    
+    @property
+    def query_cache(self) -> Optional[QueryResultCache]:
+        return self.engine.query_cache
+    
+    @property
+    def rollups(self) -> Optional[RollupManager]:
+        return self.engine.rollups
+    
+    @property
+    def samples(self) -> Optional[SampleManager]:
+        return self.engine.samples
+    
+    @property
+    def results(self) -> Optional[ResultStore]:
+        return self.engine.results
+    
+    @property
+    def governor(self) -> Optional[CostGovernor]:
+        return self.engine.governor
+    
+    def load_csv_data(self, data_dir: Path, parallel: Optional[bool] = None,
+                      force_reload: bool = False) -> Dict[str, int]:
         """
         Load CSV files from the Brazilian E-Commerce dataset
         
+        Files are parsed by DuckDB's multi-threaded CSV reader with the
+        explicit column types from OLIST_TABLES, so rows never pass
+        through pandas. With parallel loading every table is ingested
+        at the same time on its own cursor.
+        
+        When snapshots are enabled, tables whose source CSV is unchanged
+        since the last load are kept as-is (or restored from their Parquet
+        snapshot), and only changed files are re-ingested.
+        
         Args:
             data_dir: Directory containing CSV files
-            
+            parallel: Load all tables concurrently (defaults to config)
+            force_reload: Ignore snapshots and rebuild every table from CSV
+        
         Returns:
             Dictionary with table names and row counts
         """
+        self._check_writable()
+        with self.engine.write_lock:
+            loaded = self._load_csv_data(data_dir, parallel, force_reload)
+            self._publish_replica()
+            return loaded
+    
+    def _load_csv_data(self, data_dir: Path, parallel: Optional[bool], force_reload: bool) -> Dict[str, int]:
+        """Load CSV files while holding the engine's write lock"""
         logger.info(f"Loading CSV data from: {data_dir}")
         loaded_tables = {}
+        self.load_timings = {}
+        self.load_sources = {}
         
-        # Expected CSV files from the Brazilian E-Commerce dataset
-        csv_files = {
-            'olist_customers_dataset.csv': 'customers',
-            'olist_geolocation_dataset.csv': 'geolocation',
-            'olist_order_items_dataset.csv': 'order_items',
-            'olist_order_payments_dataset.csv': 'order_payments',
-            'olist_order_reviews_dataset.csv': 'order_reviews',
-            'olist_orders_dataset.csv': 'orders',
-            'olist_products_dataset.csv': 'products',
-            'olist_sellers_dataset.csv': 'sellers',
-            'product_category_name_translation.csv': 'product_category_translation'
-        }
+        if force_reload and self.snapshots:
+            self.snapshots.invalidate()
         
-        for csv_file, table_name in csv_files.items():
-            csv_path = data_dir / csv_file
-            if csv_path.exists():
-                try:
-                    df = pd.read_csv(csv_path)
-                    self.conn.execute(f"DROP TABLE IF EXISTS {table_name}")
-                    self.conn.execute(f"CREATE TABLE {table_name} AS SELECT * FROM df")
-                    row_count = len(df)
-                    loaded_tables[table_name] = row_count
-                    logger.info(f"Loaded {table_name}: {row_count} rows")
-                except Exception as e:
-                    logger.error(f"Error loading {csv_file}: {e}")
+        if parallel is None:
+            parallel = config.database.parallel_ingest
+        
+        specs = []
+        for spec in OLIST_TABLES.values():
+            if (data_dir / spec.csv_file).exists():
+                specs.append(spec)
             else:
-                logger.warning(f"CSV file not found: {csv_file}")
+                logger.warning(f"CSV file not found: {spec.csv_file}")
+        
+        if parallel and len(specs) > 1:
+            with ThreadPoolExecutor(max_workers=len(specs), thread_name_prefix="ingest") as executor:
+                futures = {executor.submit(self._load_table, spec, data_dir / spec.csv_file): spec for spec in specs}
+                row_counts = {futures[future].table_name: future.result() for future in as_completed(futures)}
+        else:
+            row_counts = {spec.table_name: self._load_table(spec, data_dir / spec.csv_file) for spec in specs}
+        
+        # Report in the canonical table order regardless of completion order
+        for spec in specs:
+            if row_counts.get(spec.table_name) is not None:
+                loaded_tables[spec.table_name] = row_counts[spec.table_name]
         
-        # Build schema information
-        self._build_schema_info()
+        if self.snapshots:
+            self.snapshots.save()
+        
+        if self.partitions:
+            self._partition_tables()
+        
+        # Derived tables and schema information are rebuilt only when a table actually changed
+        changed = {table for table, source in self.load_sources.items() if source != 'unchanged'}
+        tables = self.get_table_list()
+        facts_built = centroids_built = False
+        if changed & set(SOURCE_TABLES) or ORDER_FACTS_TABLE not in tables:
+            facts_built = self._build_order_facts()
+        if GEOLOCATION_TABLE in changed or (GEOLOCATION_TABLE in tables and ZIP_CENTROIDS_TABLE not in tables):
+            centroids_built = self._build_zip_centroids()
+        
+        if changed or facts_built or centroids_built or not self.schema_info:
+            self._build_schema_info()
         
         return loaded_tables
     
-    def _build_schema_info(self):
-        """Build comprehensive schema information for all tables"""
+    def _load_table(self, spec: TableSpec, csv_path: Path) -> Optional[int]:
+        """Load one table on a dedicated cursor, returning the row count"""
+        start = time.perf_counter()
+        cursor = self.conn.cursor()
         try:
-            tables = self.get_table_list()
+            fingerprint, entry = self.snapshots.lookup(spec.table_name, csv_path) if self.snapshots else (None, None)
             
-            for table in tables:
-                # Get column information
-                columns_query = f"""
-                    SELECT column_name, data_type, is_nullable
-                    FROM information_schema.columns
-                    WHERE table_name = '{table}'
-                    ORDER BY ordinal_position
-                """
-                columns_df = self.conn.execute(columns_query).fetchdf()
-                
-                # Get row count
-                count_query = f"SELECT COUNT(*) as count FROM {table}"
-                row_count = self.conn.execute(count_query).fetchone()[0]
-                
-                # Get sample data
-                sample_query = f"SELECT * FROM {table} LIMIT 3"
-                sample_df = self.conn.execute(sample_query).fetchdf()
-                
-                self.schema_info[table] = {
-                    'columns': columns_df.to_dict('records'),
-                    'row_count': row_count,
-                    'sample_data': sample_df.to_dict('records')
-                }
+            # Tables and snapshots written under an older type map are re-ingested with the current types
+            if fingerprint is not None:
+                if entry and entry.get('type_map_version') != TYPE_MAP_VERSION:
+                    entry = None
+                fingerprint['type_map_version'] = TYPE_MAP_VERSION
             
-            logger.info(f"Schema information built for {len(tables)} tables")
+            if entry:
+                row_count, source = self._reuse_snapshot(cursor, spec, entry)
+                if row_count is not None:
+                    self.snapshots.touch(spec.table_name, fingerprint)
+            else:
+                row_count = None
+            
+            if row_count is None:
+                row_count = self._ingest_csv(cursor, spec, csv_path)
+                source = 'csv'
+                # Rows ingested after the CSV are appended again, so a rebuild never loses them
+                delta_files = (self.snapshots.manifest.get(spec.table_name) or {}).get('delta_files', []) \
+                    if self.snapshots and spec.natural_key else []
+                row_count += self._reapply_deltas(cursor, spec, delta_files)
+                if self.snapshots:
+                    self._write_snapshot(cursor, spec.table_name, fingerprint, row_count, delta_files)
+            
+            # Reloading replaces the table, and with it the index incremental ingest dedups on
+            if source != 'unchanged' and spec.natural_key:
+                self._ensure_natural_key_index(cursor, spec)
+            
+            elapsed = time.perf_counter() - start
+            self.load_timings[spec.table_name] = elapsed
+            self.load_sources[spec.table_name] = source
+            logger.info(f"Loaded {spec.table_name}: {row_count} rows from {source} in {elapsed:.2f}s")
+            return row_count
+        except Exception as e:
+            logger.error(f"Error loading {spec.csv_file}: {e}")
+            return None
+        finally:
+            cursor.close()
+    
+    def _ingest_csv(self, cursor: duckdb.DuckDBPyConnection, spec: TableSpec, csv_path: Path) -> int:
+        """Replace a table with the contents of its source CSV"""
+        self._drop_partitioned_view(cursor, spec.table_name)
+        source = self._read_csv_sql(spec, csv_path)
+        order_by = f" ORDER BY {', '.join(spec.sort_key)}" if spec.sort_key else ""
+        try:
+            try:
+                return cursor.execute(
+                    f"CREATE OR REPLACE TABLE {spec.table_name} AS SELECT {spec.select_list()} FROM {source}{order_by}"
+                ).fetchone()[0]
+            except duckdb.ConversionException as e:
+                if not spec.enum_columns:
+                    raise
+                # Values outside a column's ENUM keep the column as text rather than failing the load
+                logger.warning(f"{spec.csv_file} has values outside its ENUM types ({e}), keeping them as VARCHAR")
+                return cursor.execute(
+                    f"CREATE OR REPLACE TABLE {spec.table_name} AS SELECT * FROM {source}{order_by}"
+                ).fetchone()[0]
+        except duckdb.Error as e:
+            # Fall back to type sniffing when a file does not match its declared layout
+            logger.warning(f"Typed load of {spec.csv_file} failed ({e}), retrying with auto-detected types")
+            return cursor.execute(
+                f"CREATE OR REPLACE TABLE {spec.table_name} AS SELECT * FROM read_csv_auto({sql_literal(csv_path)}, header=true)"
+            ).fetchone()[0]
+    
+    def _reuse_snapshot(self, cursor: duckdb.DuckDBPyConnection, spec: TableSpec,
+                        entry: Dict[str, Any]) -> Tuple[Optional[int], str]:
+        """
+        Keep or restore a table whose source CSV is unchanged
+        
+        Returns:
+            Tuple of (row count or None if the table must be re-ingested, load source)
+        """
+        table_name = spec.table_name
+        existing = None
+        if cursor.execute(
+            "SELECT 1 FROM duckdb_tables() WHERE table_name = ? AND schema_name = 'main'", [table_name]
+        ).fetchone():
+            # estimated_size is only an estimate; an exact count is answered from DuckDB's row group metadata
+            existing = cursor.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()
+        elif self.partitions and table_name in self.partitions.partitioned_views(cursor):
+            try:
+                existing = cursor.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()
+            except duckdb.Error as e:
+                logger.warning(f"Partitioned dataset of {table_name} is unreadable ({e}), reloading")
+        if existing and existing[0] == entry['row_count']:
+            return entry['row_count'], 'unchanged'
+        self._drop_partitioned_view(cursor, table_name)
+        
+        snapshot_path = self.snapshots.snapshot_dir / entry['snapshot_file']
+        if snapshot_path.exists():
+            # Parquet stores ENUM columns as text, so they are cast back on restore
+            try:
+                row_count = cursor.execute(
+                    f"CREATE OR REPLACE TABLE {table_name} AS "
+                    f"SELECT {spec.select_list()} FROM read_parquet({sql_literal(snapshot_path)})"
+                ).fetchone()[0]
+            except duckdb.Error as e:
+                logger.warning(f"Snapshot of {table_name} does not match its column types ({e}), re-ingesting")
+                return None, 'csv'
+            # The snapshot holds the CSV rows; rows ingested since are appended from their delta files
+            row_count += self._reapply_deltas(cursor, spec, entry.get('delta_files', []))
+            return row_count, 'snapshot'
+        
+        return None, 'csv'
+    
+    def _drop_partitioned_view(self, cursor: duckdb.DuckDBPyConnection, table_name: str):
+        """Drop the view over a table's partitions so the table can be loaded in its place"""
+        if self.partitions and table_name in self.partitions.partitioned_views(cursor):
+            cursor.execute(f"DROP VIEW {table_name}")
+    
+    def _partition_tables(self):
+        """Move freshly loaded order tables into the partitioned Parquet store"""
+        loaded = set(SchemaCatalog.table_row_counts(self.conn))
+        if 'orders' not in loaded | set(self.partitions.partitioned_views(self.conn)):
+            logger.warning("Order tables not partitioned, orders is not loaded")
+            return
+        
+        for table_name in PARTITIONED_TABLES:
+            if table_name not in loaded:
+                continue
+            try:
+                start = time.perf_counter()
+                self.partitions.write(self.conn, OLIST_TABLES[table_name])
+                self.load_timings[table_name] = self.load_timings.get(table_name, 0.0) + time.perf_counter() - start
+            except Exception as e:
+                logger.error(f"Error partitioning {table_name}, keeping it in the database: {e}")
+        self._prune_partitions()
+    
+    def _prune_partitions(self):
+        """Delete partition versions that neither this database nor a kept replica snapshot reads"""
+        referenced = self.partitions.referenced_dirs(self.conn)
+        if self.replicas:
+            referenced += self.replicas.references()
+        self.partitions.prune(referenced)
+    
+    def _write_snapshot(self, cursor: duckdb.DuckDBPyConnection, table_name: str,
+                        fingerprint: Dict[str, Any], row_count: int, delta_files: Optional[List[str]] = None):
+        """Write a table's Parquet snapshot and record it in the manifest, with the delta files it includes"""
+        snapshot_path = self.snapshots.snapshot_path(table_name)
+        tmp_path = snapshot_path.with_suffix('.parquet.tmp')
+        try:
+            cursor.execute(f"COPY {table_name} TO {sql_literal(tmp_path)} (FORMAT PARQUET)")
+            tmp_path.replace(snapshot_path)
+            self.snapshots.record(table_name, fingerprint, row_count, delta_files)
+        except Exception as e:
+            logger.warning(f"Could not write snapshot for {table_name}: {e}")
+            self.snapshots.invalidate(table_name)
+    
+    def ingest_incremental(self, table_name: str, csv_paths: Union[Path, List[Path]]) -> int:
+        """
+        Append delta CSV files to an append-only table
+        
+        Rows are deduplicated on the table's natural key, both within the
+        delta and against rows already loaded, so overlapping or repeated
+        files are safe to ingest. Dedup goes through a unique index on the
+        key, so the cost follows the size of the delta rather than the
+        table. Only this table's schema_info row count is updated.
+        
+        Args:
+            table_name: Append-only table (orders, order_items, order_payments, order_reviews)
+            csv_paths: Delta CSV file or files with the same layout as the source CSV
+        
+        Returns:
+            Number of new rows inserted
+        """
+        spec = OLIST_TABLES.get(table_name)
+        if spec is None or not spec.natural_key:
+            raise ValueError(f"Table {table_name} does not support incremental ingest")
+        
+        paths = [csv_paths] if isinstance(csv_paths, Path) else list(csv_paths)
+        self._check_writable()
+        with self.engine.write_lock:
+            inserted = self._ingest_incremental(spec, paths)
+            self._publish_replica()
+            return inserted
+    
+    def _check_writable(self):
+        """Refuse loads on reader replicas, whose data only changes by switching snapshots"""
+        if self.replica_role == READER:
+            raise RuntimeError("Reader replicas cannot load data; run ingest on the writer process")
+    
+    def _publish_replica(self):
+        """On a writer, publish the loaded data as a new snapshot if its version changed"""
+        if self.replica_role != WRITER or not self.data_version:
+            return
+        latest = self.replicas.latest()
+        if latest and latest['data_version'] == self.data_version:
+            return
+        self.replicas.publish(self.conn, self.data_version,
+                              [self.catalog.catalog_path, self.engine.stats_catalog.stats_path],
+                              self.partitions.referenced_dirs(self.conn) if self.partitions else None)
+        if self.partitions:
+            self._prune_partitions()
+    
+    def refresh_replica(self) -> bool:
+        """
+        Switch a reader to the latest published snapshot
+        
+        The session moves to the new snapshot's engine while queries already
+        running finish on the old one, which is released once it is idle.
+        
+        Returns:
+            True if the session switched to a newer snapshot
+        """
+        self._replica_checked = time.monotonic()
+        self._release_retired_engines()
+        if self.replica_role != READER:
+            return False
+        latest = self.replicas.latest()
+        if latest is None or self.replicas.snapshot_path(latest) == Path(self.db_path):
+            return False
+        
+        old_engine, old_conn, old_release, old_path = self.engine, self.conn, self._release, self.db_path
+        self.db_path = self.replicas.snapshot_path(latest)
+        try:
+            self._initialize_connection()
+        except Exception as e:
+            logger.warning(f"Staying on the current snapshot, could not open snapshot {latest['sequence']}: {e}")
+            self.engine, self.conn, self._release, self.db_path = old_engine, old_conn, old_release, old_path
+            return False
+        self._retired_engines.append((old_engine, old_release))
+        self._release_retired_engines()
+        logger.info(f"Reader switched to snapshot {latest['sequence']} (data version {latest['data_version']})")
+        return True
+    
+    def _release_retired_engines(self, force: bool = False):
+        """Release engines of earlier snapshots once no query is using them"""
+        for engine, release in list(self._retired_engines):
+            if force or (not engine.active_queries and engine.stats()['pool_busy'] == 0):
+                release()
+                self._retired_engines.remove((engine, release))
+    
+    def _ingest_incremental(self, spec: TableSpec, paths: List[Path]) -> int:
+        """Append delta files while holding the engine's write lock"""
+        table_name = spec.table_name
+        start = time.perf_counter()
+        cursor = self.conn.cursor()
+        try:
+            if table_name not in self.get_table_list():
+                columns = ", ".join(f"{col} {col_type}" for col, col_type in spec.column_types.items())
+                cursor.execute(f"CREATE TABLE {table_name} ({columns})")
+            
+            delta_sql = self._delta_sql(spec, paths)
+            if self.partitions and table_name in self.partitions.partitioned_views(cursor):
+                # Partitioned tables take new rows as extra files in their month partitions
+                added = fetch_arrow(cursor.execute(
+                    self.partitions.with_partition_sql(table_name, self._new_rows_sql(spec, delta_sql))
+                ))
+                with TableDelta(table_name, added).rows_sql(cursor) as rows_sql:
+                    self.partitions.append(cursor, spec, rows_sql)
+            else:
+                added = self._insert_delta(cursor, spec, delta_sql)
+            inserted = added.num_rows
+            deltas = [TableDelta(table_name, added)]
+            
+            # Fact rows of the touched orders are rebuilt so order_facts matches its sources
+            if inserted and table_name in INCREMENTAL_SOURCES and ORDER_FACTS_TABLE in self.schema_info:
+                deltas.append(refresh_order_facts(cursor, f"SELECT DISTINCT order_id FROM ({delta_sql})"))
+        finally:
+            cursor.close()
+        
+        if table_name in self.schema_info:
+            if inserted:
+                for delta in deltas:
+                    self.schema_info[delta.table]['row_count'] += delta.row_change
+                self._merge_statistics(deltas)
+                self._bump_data_version(deltas)
+        else:
+            self._build_schema_info()
+        
+        if self.snapshots:
+            self.snapshots.record_delta(table_name, paths, inserted)
+            self.snapshots.save()
+        
+        logger.info(f"Ingested {inserted} new rows into {table_name} from {len(paths)} file(s) "
+                    f"in {time.perf_counter() - start:.2f}s")
+        return inserted
+    
+    def _delta_sql(self, spec: TableSpec, paths: List[Path]) -> str:
+        """Rows of delta files, deduplicated on the natural key"""
+        delta_sql = " UNION ALL BY NAME ".join(f"SELECT * FROM {self._read_csv_sql(spec, path)}" for path in paths)
+        return f"SELECT * FROM ({delta_sql}) QUALIFY row_number() OVER (PARTITION BY {', '.join(spec.natural_key)}) = 1"
+    
+    @staticmethod
+    def _new_rows_sql(spec: TableSpec, delta_sql: str) -> str:
+        """Delta rows whose natural key is not loaded yet"""
+        key_match = " AND ".join(f"existing.{col} = delta.{col}" for col in spec.natural_key)
+        return (f"SELECT * FROM ({delta_sql}) delta "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {spec.table_name} existing WHERE {key_match})")
+    
+    def _insert_delta(self, cursor: duckdb.DuckDBPyConnection, spec: TableSpec, delta_sql: str) -> pa.Table:
+        """Insert delta rows into a stored table, skipping keys it already has, and return the rows inserted"""
+        if self._ensure_natural_key_index(cursor, spec):
+            insert_sql = f"INSERT OR IGNORE INTO {spec.table_name} BY NAME {delta_sql}"
+        else:
+            insert_sql = f"INSERT INTO {spec.table_name} BY NAME {self._new_rows_sql(spec, delta_sql)}"
+        return fetch_arrow(cursor.execute(f"{insert_sql} RETURNING *"))
+    
+    def _reapply_deltas(self, cursor: duckdb.DuckDBPyConnection, spec: TableSpec, delta_files: List[str]) -> int:
+        """Append recorded delta files to a freshly reloaded table, returning the rows added"""
+        paths = [Path(path) for path in delta_files]
+        missing = [path for path in paths if not path.exists()]
+        if missing:
+            logger.warning(f"Delta files of {spec.table_name} are gone, their rows are not restored: {missing}")
+        paths = [path for path in paths if path.exists()]
+        if not paths:
+            return 0
+        inserted = self._insert_delta(cursor, spec, self._delta_sql(spec, paths)).num_rows
+        logger.info(f"Re-applied {inserted} rows to {spec.table_name} from {len(paths)} delta file(s)")
+        return inserted
+    
+    def _ensure_natural_key_index(self, cursor: duckdb.DuckDBPyConnection, spec: TableSpec) -> bool:
+        """Create the unique natural-key index used for dedup, returning False if the data has duplicates"""
+        index_name = f"{spec.table_name}_natural_key"
+        try:
+            cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {spec.table_name} ({', '.join(spec.natural_key)})")
+            return True
+        except duckdb.ConstraintException as e:
+            logger.warning(f"Existing {spec.table_name} rows repeat the natural key ({e}), deduplicating with an anti-join")
+            return False
+    
+    def _build_order_facts(self) -> bool:
+        """Rebuild the denormalized order_facts table, returning False if its sources are missing"""
+        missing = set(SOURCE_TABLES) - set(self.get_table_list())
+        if missing:
+            logger.warning(f"{ORDER_FACTS_TABLE} not built, missing tables: {sorted(missing)}")
+            return False
+        
+        try:
+            start = time.perf_counter()
+            row_count = build_order_facts(self.conn)
+            logger.info(f"Built {ORDER_FACTS_TABLE} with {row_count} rows in {time.perf_counter() - start:.2f}s")
+            return True
+        except Exception as e:
+            logger.error(f"Error building {ORDER_FACTS_TABLE}: {e}")
+            return False
+    
+    def _build_zip_centroids(self) -> bool:
+        """Rebuild the per-prefix zip_centroids table, returning False if geolocation is missing"""
+        if GEOLOCATION_TABLE not in self.get_table_list():
+            logger.warning(f"{ZIP_CENTROIDS_TABLE} not built, missing table: {GEOLOCATION_TABLE}")
+            return False
+        
+        try:
+            start = time.perf_counter()
+            row_count = build_zip_centroids(self.conn)
+            logger.info(f"Built {ZIP_CENTROIDS_TABLE} with {row_count} rows in {time.perf_counter() - start:.2f}s")
+            return True
+        except Exception as e:
+            logger.error(f"Error building {ZIP_CENTROIDS_TABLE}: {e}")
+            return False
+    
+    @staticmethod
+    def _read_csv_sql(spec: TableSpec, csv_path: Path) -> str:
+        """Build the read_csv table function call for a table spec"""
+        types = ", ".join(f"{sql_literal(col)}: {sql_literal(col_type)}" for col, col_type in spec.csv_types.items())
+        return (
+            f"read_csv({sql_literal(csv_path)}, header=true, types={{{types}}}, "
+            f"timestampformat={sql_literal(OLIST_TIMESTAMP_FORMAT)})"
+        )
+    
+    def _build_schema_info(self):
+        """Build schema information for all tables and start a new data version"""
+        try:
+            self.schema_info = self.catalog.build(self.conn)
+            self._build_statistics()
+            self._bump_data_version()
+            logger.info(f"Schema information built for {len(self.schema_info)} tables")
         except Exception as e:
             logger.error(f"Error building schema info: {e}")
     
+    def _load_schema_catalog(self):
+        """Reuse the persisted schema catalog on warm start, rebuilding it if stale"""
+        try:
+            cached = self.catalog.load(self.conn)
+            if cached:
+                self.data_version, self.schema_info = cached
+                logger.info(f"Schema catalog loaded for {len(self.schema_info)} tables (version {self.data_version})")
+                self._load_statistics()
+                self._refresh_rollups()
+                self._refresh_samples()
+            elif self.get_table_list():
+                self._build_schema_info()
+        except Exception as e:
+            logger.warning(f"Could not load schema catalog: {e}")
+    
+    def _bump_data_version(self, deltas: Optional[List[TableDelta]] = None):
+        """
+        Mark the data as changed and persist the catalog under the new version
+        
+        Args:
+            deltas: Rows an incremental load changed, so rollups and samples
+                are maintained from them instead of rebuilt
+        """
+        previous_version = self.data_version
+        self.data_version = uuid.uuid4().hex[:12]
+        self.catalog.save(self.data_version, self.schema_info)
+        self.engine.stats_catalog.save(self.data_version, self.statistics)
+        if deltas is not None:
+            self._refresh_rollups(previous_version, deltas)
+            self._refresh_samples(previous_version, deltas)
+        else:
+            self._refresh_rollups()
+            self._refresh_samples()
+    
+    def _build_statistics(self, tables: Optional[List[str]] = None):
+        """Compute column statistics for the given tables (defaults to all)"""
+        if not config.database.enable_column_stats:
+            return
+        try:
+            start = time.perf_counter()
+            built = self.engine.stats_catalog.build(self.conn, self.schema_info, tables)
+            statistics = {**self.statistics, **built} if tables is not None else built
+            self.statistics = {table: stats for table, stats in statistics.items() if table in self.schema_info}
+            logger.info(f"Column statistics computed for {len(built)} tables in {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            logger.error(f"Error computing column statistics: {e}")
+    
+    def _merge_statistics(self, deltas: List[TableDelta]):
+        """Fold the rows an incremental load changed into the column statistics"""
+        if not config.database.enable_column_stats:
+            return
+        try:
+            merged = self.engine.stats_catalog.merge(self.conn, self.schema_info, self.statistics, deltas)
+            self.statistics = {**self.statistics, **merged}
+        except Exception as e:
+            logger.error(f"Error merging column statistics: {e}")
+            self._build_statistics([delta.table for delta in deltas])
+    
+    def _load_statistics(self):
+        """Reuse persisted statistics on warm start, recomputing them if stale"""
+        statistics = self.engine.stats_catalog.load(self.data_version)
+        if statistics is not None and set(statistics) == set(self.schema_info):
+            self.statistics = statistics
+        elif config.database.enable_column_stats:
+            self._build_statistics()
+            self.engine.stats_catalog.save(self.data_version, self.statistics)
+    
+    def _refresh_rollups(self, previous_version: Optional[str] = None, deltas: Optional[List[TableDelta]] = None):
+        """Rebuild rollup tables that were not built from the current data version, or maintain them from deltas"""
+        if not self.rollups or not self.data_version:
+            return
+        try:
+            self.rollups.refresh(self.conn, self.data_version, self._table_columns(), read_only=self.engine.read_only,
+                                 previous_version=previous_version, deltas=deltas)
+        except Exception as e:
+            logger.error(f"Error building rollup tables: {e}")
+    
+    def _rebuild_stale_rollups(self, cursor: duckdb.DuckDBPyConnection, query: str):
+        """Rebuild the stale rollups a query could read, deferred from the ingest that changed their sources"""
+        if self.engine.read_only or not self.rollups.stale(self.data_version):
+            return
+        names = self.rollups.stale_for(cursor, query, self.data_version, self._table_columns())
+        if not names:
+            return
+        with self.engine.write_lock:
+            try:
+                self.rollups.rebuild(self.conn, self.data_version, names)
+            except Exception as e:
+                logger.error(f"Error rebuilding rollup tables {names}: {e}")
+    
+    def _refresh_samples(self, previous_version: Optional[str] = None, deltas: Optional[List[TableDelta]] = None):
+        """Redraw samples of large tables that were not drawn from the current data version, or extend them from deltas"""
+        if not self.samples or not self.data_version:
+            return
+        try:
+            row_counts = {table: info['row_count'] for table, info in self.schema_info.items()}
+            self.samples.refresh(self.conn, self.data_version, row_counts, read_only=self.engine.read_only,
+                                 previous_version=previous_version, deltas=deltas)
+        except Exception as e:
+            logger.error(f"Error drawing table samples: {e}")
+    
+    def _table_columns(self) -> Dict[str, set]:
+        """Column names of every table, used to resolve unqualified column references"""
+        return {
+            table: {col['column_name'].lower() for col in info['columns']}
+            for table, info in self.schema_info.items()
+        }
+    
+    def refresh_schema(self) -> Dict[str, Any]:
+        """Rebuild schema information and statistics after tables changed outside the loaders"""
+        with self.engine.write_lock:
+            self._build_schema_info()
+        return self.schema_info
+    
     def get_table_list(self) -> List[str]:
         """Get list of all tables in the database"""
         try:
@@ -120,36 +856,166 @@ class DatabaseManager:
             logger.error(f"Error getting table list: {e}")
             return []
     
-    def get_schema_description(self) -> str:
-        """Get a human-readable schema description for LLM context"""
+    def get_schema_description(self, tables: Optional[List[str]] = None,
+                               columns: Optional[Dict[str, List[str]]] = None) -> str:
+        """
+        Get a human-readable schema description for LLM context
+        
+        Args:
+            tables: Only describe these tables (defaults to every table)
+            columns: Per table, the only columns to list; the rest are counted as not listed
+        """
         description_parts = ["# E-Commerce Database Schema\n"]
         
-        for table_name, info in self.schema_info.items():
+        # Derived tables are listed first so queries start from them rather than the raw tables
+        table_notes = {
+            ORDER_FACTS_TABLE: ORDER_FACTS_DESCRIPTION,
+            ZIP_CENTROIDS_TABLE: ZIP_CENTROIDS_DESCRIPTION,
+            GEOLOCATION_TABLE: GEOLOCATION_NOTE,
+        }
+        if self.partitions:
+            table_notes.update({table: PARTITION_NOTE for table in self.partitions.partitioned_views(self.conn)})
+        preferred = [ORDER_FACTS_TABLE, ZIP_CENTROIDS_TABLE]
+        described = [table for table in self.schema_info if tables is None or table in tables]
+        described.sort(key=lambda table: preferred.index(table) if table in preferred else len(preferred))
+        for table_name in described:
+            info = self.schema_info[table_name]
             description_parts.append(f"\n## Table: {table_name}")
+            if table_name in table_notes:
+                description_parts.append(table_notes[table_name])
             description_parts.append(f"Row count: {info['row_count']}")
             description_parts.append("\nColumns:")
             
+            table_stats = self.statistics.get(table_name, {})
+            listed = (columns or {}).get(table_name)
             for col in info['columns']:
+                if listed is not None and col['column_name'] not in listed:
+                    continue
                 nullable = "NULL" if col['is_nullable'] == 'YES' else "NOT NULL"
-                description_parts.append(f"  - {col['column_name']} ({col['data_type']}) {nullable}")
+                line = f"  - {col['column_name']} ({col['data_type']}) {nullable}"
+                if col['column_name'] in table_stats:
+                    line += f" | {self._summarize_column_stats(table_stats[col['column_name']])}"
+                description_parts.append(line)
+            if listed is not None and len(listed) < len(info['columns']):
+                description_parts.append(f"  ({len(info['columns']) - len(listed)} more columns not listed)")
             
             if info['sample_data']:
+                sample = info['sample_data'][0]
+                if listed is not None:
+                    sample = {name: value for name, value in sample.items() if name in listed}
                 description_parts.append("\nSample data:")
-                description_parts.append(f"  {info['sample_data'][0]}")
+                description_parts.append(f"  {sample}")
         
         return "\n".join(description_parts)
     
-    def execute_query(self, query: str, params: Optional[Dict] = None) -> Tuple[pd.DataFrame, Optional[str]]:
+    @staticmethod
+    def _summarize_column_stats(stats: Dict[str, Any]) -> str:
+        """One-line statistics summary for the schema description"""
+        parts = [f"~{stats['distinct_count']} distinct"]
+        if stats['null_fraction']:
+            parts.append(f"{stats['null_fraction']:.0%} null")
+        if stats['kind'] in ('integer', 'numeric', 'temporal') and stats.get('min') is not None:
+            parts.append(f"range {stats['min']} to {stats['max']}")
+        if stats.get('top_values') and stats['distinct_count'] <= 50:
+            parts.append(f"common values: {', '.join(str(value) for value in stats['top_values'])}")
+        return "; ".join(parts)
+    
+    def get_column_stats(self, table_name: str, column_name: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Get precomputed statistics for a table's columns
+        
+        Args:
+            table_name: Table to look up
+            column_name: Single column to return (defaults to all columns)
+        
+        Returns:
+            Column -> statistics, or one column's statistics; empty if unknown
+        """
+        table_stats = self.statistics.get(table_name, {})
+        if column_name is not None:
+            return table_stats.get(column_name, {})
+        return table_stats
+    
+    def get_result_column_stats(self, columns: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Match result columns to table column statistics by name, preferring order_facts"""
+        tables = sorted(self.statistics, key=lambda table: table != ORDER_FACTS_TABLE)
+        matched = {}
+        for column in columns:
+            for table in tables:
+                if column in self.statistics[table]:
+                    matched[column] = {'table': table, **self.statistics[table][column]}
+                    break
+        return matched
+    
+    def execute_query(self, query: str, params: Optional[Dict] = None,
+                      approximate: bool = False) -> Tuple[pd.DataFrame, Optional[str]]:
         """
         Execute a SQL query safely
         
         Args:
             query: SQL query to execute
             params: Optional query parameters
-            
+            approximate: Estimate aggregates from table samples when possible
+        
         Returns:
             Tuple of (DataFrame with results, error message if any)
         """
+        result = self.run_query(query, params, approximate=approximate)
+        return result.data, result.error
+    
+    def validate_query(self, query: str) -> Optional[str]:
+        """
+        Check that a query still binds against the current schema without running it
+        
+        Returns:
+            The planner's error message, or None if the query is valid
+        """
+        try:
+            with self.engine.pooled_cursor(timeout=config.database.query_timeout) as cursor:
+                cursor.execute(f"EXPLAIN {query}")
+            return None
+        except duckdb.Error as e:
+            return str(e)
+    
+    def run_query(self, query: str, params: Optional[Dict] = None, timeout: Optional[float] = None,
+                  handle: Optional[QueryHandle] = None, count_total: Optional[bool] = None,
+                  approximate: bool = False, profile: Optional[bool] = None, keep_result: bool = False) -> QueryResult:
+        """
+        Execute a SQL query safely, with a deadline and cancellation support
+        
+        The max_query_results cap is pushed into the executed plan and the
+        result is streamed as Arrow batches that stop at the cap, so memory
+        is bounded by the cap rather than by the size of the result. Before
+        it runs, the query's plan estimates decide whether it runs normally,
+        from a sample, behind the heavy-query queue, or not at all.
+        
+        Args:
+            query: SQL query to execute
+            params: Optional query parameters
+            timeout: Seconds before the query is interrupted (defaults to config)
+            handle: Cancellation handle, created if not given
+            count_total: Count all rows of a truncated result (defaults to config)
+            approximate: Estimate aggregates from table samples, adding confidence interval
+                columns; queries a sample cannot answer run exactly
+            profile: Capture DuckDB's operator profile (defaults to config)
+            keep_result: Keep the full result server-side under result_id for get_result_page;
+                a truncated result is written out whole, which also gives its exact row count
+        
+        Returns:
+            QueryResult with the data and, on failure, a structured error type
+        """
+        start = time.perf_counter()
+        if self.replica_role == READER and time.monotonic() - self._replica_checked >= config.database.replica_poll_seconds:
+            self.refresh_replica()
+        timeout = timeout or config.database.query_timeout
+        handle = handle or QueryHandle(self.session_id)
+        row_cap = config.database.max_query_results
+        if count_total is None:
+            count_total = config.database.count_truncated_results
+        if profile is None:
+            profile = config.database.profile_queries
+        executed_query, query_profile, cost = query, None, None
+        
         try:
             # Basic SQL injection prevention
             dangerous_keywords = ['DROP', 'DELETE', 'TRUNCATE', 'ALTER', 'CREATE', 'INSERT', 'UPDATE']
@@ -158,23 +1024,413 @@ class DatabaseManager:
             for keyword in dangerous_keywords:
                 if keyword in query_upper and 'CREATE' not in query_upper.split(keyword)[0]:
                     logger.warning(f"Potentially dangerous query blocked: {query[:100]}")
-                    return pd.DataFrame(), f"Query contains potentially dangerous keyword: {keyword}"
+                    return QueryResult(pd.DataFrame(), f"Query contains potentially dangerous keyword: {keyword}",
+                                       error_type='blocked', query_id=handle.query_id)
             
-            # Execute query with timeout
-            result = self.conn.execute(query).fetchdf()
+            # Identical SQL against the same data version is answered from the cache
+            cache_key = None
+            if self.query_cache and is_cacheable(query):
+                cache_key = (self.data_version, normalize_sql(query), row_cap, count_total, approximate)
+                cached = self.query_cache.get(cache_key)
+                cached_metadata = _result_metadata(cached) if cached is not None else {}
+                # A truncated result to keep has to run again to write out all of its rows
+                if cached is not None and not (keep_result and self.results and cached_metadata['truncated']):
+                    logger.info(f"Query served from cache: {cached.num_rows} rows returned")
+                    result = QueryResult(self._arrow_to_pandas(cached), query_id=handle.query_id,
+                                         elapsed=time.perf_counter() - start, from_cache=True,
+                                         **self._approximation_details(cached_metadata))
+                    if keep_result and self.results:
+                        result.result_id = self.results.put_table(handle.query_id, query, cached).result_id
+                    self._log_query(query, result)
+                    return result
             
-            # Limit results
-            if len(result) > config.database.max_query_results:
-                logger.warning(f"Query returned {len(result)} rows, limiting to {config.database.max_query_results}")
-                result = result.head(config.database.max_query_results)
+            with self.engine.pooled_cursor(timeout=timeout) as cursor:
+                executed_query, rollup, sample_fraction, cost = self._plan_query(cursor, query, approximate, row_cap,
+                                                                                 handle.query_id)
             
-            logger.info(f"Query executed successfully: {len(result)} rows returned")
-            return result, None
+            # Queued heavy queries wait for a heavy slot without holding a pooled cursor
+            queued = cost is not None and cost.action == QUEUE
+            with (self.governor.heavy_slot(timeout) if queued else nullcontext()), \
+                    self.engine.pooled_cursor(timeout=timeout) as cursor:
+                if profile:
+                    enable_profiling(cursor)
+                try:
+                    result, truncated = self._execute_with_deadline(cursor, executed_query, timeout, handle, row_cap)
+                    query_profile = read_profile(cursor) if profile else None
+                finally:
+                    if profile:
+                        disable_profiling(cursor)
+                
+                total_rows = None if truncated else result.num_rows
+                result_id = None
+                if keep_result and self.results:
+                    result_id, stored_rows = self._store_result(cursor, query, executed_query, result, truncated,
+                                                                timeout, handle)
+                    total_rows = stored_rows if stored_rows is not None else total_rows
+                if truncated:
+                    logger.warning(f"Query returned more than {row_cap} rows, limited to {row_cap}")
+                    if count_total and total_rows is None:
+                        count_query = f"SELECT COUNT(*) FROM (\n{_TRAILING_NOISE_PATTERN.sub('', executed_query)}\n) AS counted_result"
+                        count_table, _ = self._execute_with_deadline(cursor, count_query, timeout, handle, 1)
+                        total_rows = count_table.column(0)[0].as_py()
+                
+                result = result.replace_schema_metadata({
+                    'truncated': str(truncated),
+                    'total_rows': '' if total_rows is None else str(total_rows),
+                    'rollup': rollup or '',
+                    'sample_fraction': '' if sample_fraction is None else repr(sample_fraction),
+                })
+                if cache_key:
+                    self.query_cache.put(cache_key, result)
+                
+                data = self._arrow_to_pandas(result, cursor)
             
+            self.engine.record_query_event('executed')
+            result = QueryResult(data, query_id=handle.query_id, elapsed=time.perf_counter() - start,
+                                 truncated=truncated, total_rows=total_rows, profile=query_profile, cost=cost,
+                                 result_id=result_id, **self._approximation_details({'rollup': rollup, 'sample_fraction': sample_fraction}))
+            scanned = f", {query_profile['rows_scanned']} rows scanned" if query_profile else ""
+            estimated = f" (estimated {cost.scanned_rows} rows scanned, {cost.cost_class})" if cost else ""
+            logger.info(f"Query executed successfully: {len(data)} rows returned in {result.elapsed:.3f}s"
+                        f"{scanned}{estimated}")
+            self._log_query(query, result, executed_query)
+            return result
+        
+        except QueryRejectedError as e:
+            self.engine.record_query_event('rejected')
+            logger.warning(f"Query {handle.query_id} rejected: {e.reason}")
+            result = QueryResult(pd.DataFrame(), f"Query rejected before running: {e.reason}", error_type='rejected',
+                                 query_id=handle.query_id, elapsed=time.perf_counter() - start, cost=e.cost)
+            self._log_query(query, result, executed_query)
+            return result
+        except (QueryTimeoutError, QueryCancelledError) as e:
+            error_type = 'timeout' if isinstance(e, QueryTimeoutError) else 'cancelled'
+            self.engine.record_query_event(error_type)
+            logger.warning(f"Query {handle.query_id} {error_type}: {query[:100]}")
+            result = QueryResult(pd.DataFrame(), str(e), error_type=error_type, query_id=handle.query_id,
+                                 elapsed=time.perf_counter() - start, cost=cost)
+            self._log_query(query, result, executed_query)
+            return result
         except Exception as e:
             error_msg = f"Query execution error: {str(e)}"
+            self.engine.record_query_event('failed')
             logger.error(error_msg)
-            return pd.DataFrame(), error_msg
+            result = QueryResult(pd.DataFrame(), error_msg, error_type='execution', query_id=handle.query_id,
+                                 elapsed=time.perf_counter() - start, cost=cost)
+            self._log_query(query, result, executed_query)
+            return result
+    
+    def _store_result(self, cursor: duckdb.DuckDBPyConnection, query: str, executed_query: str, table: pa.Table,
+                      truncated: bool, timeout: float, handle: QueryHandle) -> Tuple[Optional[str], Optional[int]]:
+        """
+        Keep a query's full result in the result store
+        
+        A complete result is written from the fetched table; a truncated one
+        runs again as a COPY under the same deadline. A result that cannot be
+        stored is still returned to the caller, just without a result id.
+        
+        Returns:
+            Tuple of (result id, stored row count), both None if the result was not stored
+        """
+        if not truncated:
+            stored = self.results.put_table(handle.query_id, query, table)
+            return stored.result_id, stored.row_count
+        return self._copy_result(cursor, query, executed_query, timeout, handle)
+    
+    def _copy_result(self, cursor: duckdb.DuckDBPyConnection, query: str, executed_query: str, timeout: float,
+                     handle: QueryHandle) -> Tuple[Optional[str], Optional[int]]:
+        """Write every row of a query to the result store with a COPY, returning its id and row count"""
+        path = self.results.path_for(handle.query_id)
+        copy_query = self.results.copy_sql(_TRAILING_NOISE_PATTERN.sub('', executed_query), path)
+        try:
+            copied, _ = self._execute_with_deadline(cursor, copy_query, timeout, handle, 1)
+        except (QueryTimeoutError, QueryCancelledError, duckdb.Error) as e:
+            path.unlink(missing_ok=True)
+            logger.warning(f"Full result of query {handle.query_id} not stored: {e}")
+            return None, None
+        row_count = copied.column(0)[0].as_py()
+        stored = self.results.register(handle.query_id, query, path, row_count)
+        logger.info(f"Stored full result {stored.result_id}: {row_count} rows")
+        return stored.result_id, row_count
+    
+    def store_result(self, query: str, timeout: Optional[float] = None,
+                     handle: Optional[QueryHandle] = None) -> Optional[str]:
+        """
+        Write the full result of a query to the result store
+        
+        Answers only hold the first max_query_results rows; this is called
+        when the user opens a truncated result, so only results someone
+        browses are ever written out. The query runs once, as a COPY, under
+        the same routing and cost checks as run_query.
+        
+        Args:
+            query: SQL query whose rows to keep
+            timeout: Seconds before the COPY is interrupted (defaults to config)
+            handle: Cancellation handle, created if not given
+        
+        Returns:
+            Result id for get_result_page, or None if the result could not be stored
+        """
+        if not self.results:
+            return None
+        timeout = timeout or config.database.query_timeout
+        handle = handle or QueryHandle(self.session_id)
+        try:
+            with self.engine.pooled_cursor(timeout=timeout) as cursor:
+                executed_query, _, _, cost = self._plan_query(cursor, query, False, config.database.max_query_results,
+                                                              handle.query_id)
+            queued = cost is not None and cost.action == QUEUE
+            with (self.governor.heavy_slot(timeout) if queued else nullcontext()), \
+                    self.engine.pooled_cursor(timeout=timeout) as cursor:
+                result_id, _ = self._copy_result(cursor, query, executed_query, timeout, handle)
+        except QueryRejectedError as e:
+            logger.warning(f"Full result of query {handle.query_id} not stored: {e.reason}")
+            return None
+        except QueryTimeoutError as e:
+            logger.warning(f"Full result of query {handle.query_id} not stored: {e}")
+            return None
+        return result_id
+    
+    def get_result_page(self, result_id: str, page: int = 0, page_size: Optional[int] = None,
+                        sort_by: Optional[str] = None, descending: bool = False) -> Optional[pd.DataFrame]:
+        """
+        Read one page of a stored result
+        
+        Args:
+            result_id: Id from QueryResult.result_id
+            page: Zero-based page number
+            page_size: Rows per page (defaults to config)
+            sort_by: Column to sort the whole result by before paging
+            descending: Sort in descending order
+        
+        Returns:
+            DataFrame with the page's rows, or None if the result is no longer stored
+        """
+        stored = self.results.get(result_id) if self.results else None
+        if stored is None:
+            return None
+        page_size = page_size or config.database.result_page_size
+        page_query = self.results.page_sql(stored, max(page, 0), page_size, sort_by, descending)
+        with self.engine.pooled_cursor(timeout=config.database.query_timeout) as cursor:
+            return self._arrow_to_pandas(fetch_arrow(cursor.execute(page_query)), cursor)
+    
+    def get_result_info(self, result_id: str) -> Optional[Dict[str, Any]]:
+        """Row count and columns of a stored result, or None if it is no longer stored"""
+        stored = self.results.get(result_id) if self.results else None
+        if stored is None:
+            return None
+        return {'result_id': stored.result_id, 'query': stored.query, 'row_count': stored.row_count,
+                'columns': list(stored.columns), 'created_at': stored.created_at}
+    
+    def release_result(self, result_id: str) -> bool:
+        """Delete a stored result before it is evicted"""
+        return self.results.release(result_id) if self.results else False
+    
+    def get_result_store_stats(self) -> Dict[str, Any]:
+        """Get the number and size of stored results"""
+        return self.results.stats() if self.results else {}
+    
+    def _log_query(self, query: str, result: QueryResult, executed_query: Optional[str] = None):
+        """Record a finished query's timing in the query log"""
+        if not self.engine.query_log:
+            return
+        status = 'executed' if result.success else ('failed' if result.error_type == 'execution' else result.error_type)
+        self.engine.query_log.record(
+            query, status, result.elapsed, query_id=result.query_id, session_id=self.session_id,
+            rows_returned=len(result.data), from_cache=result.from_cache, rollup=result.rollup,
+            sample_fraction=result.sample_fraction, profile=result.profile,
+            executed_query=executed_query, error=result.error, cost=result.cost,
+        )
+    
+    def _plan_query(self, cursor: duckdb.DuckDBPyConnection, query: str, approximate: bool, row_cap: int,
+                    query_id: str) -> Tuple[str, Optional[str], Optional[float], Optional[CostEstimate]]:
+        """
+        Choose the SQL to run for a query and check its estimated cost
+        
+        Returns:
+            Tuple of (SQL to execute, rollup used, sample fraction if estimated, cost estimate)
+        
+        Raises:
+            QueryRejectedError: If the governor rejects the query
+        """
+        executed_query = query
+        
+        # Aggregates that a rollup answers exactly read the rollup instead
+        rollup = None
+        if self.rollups:
+            self._rebuild_stale_rollups(cursor, query)
+            routed = self.rollups.route(cursor, query, self.data_version, self._table_columns())
+            if routed:
+                rollup, executed_query = routed
+                logger.info(f"Query routed to rollup {rollup}")
+        
+        # Exploratory aggregates may be estimated from a sample when no rollup answers them
+        sample_fraction = None
+        if approximate and not rollup and self.samples:
+            estimated = self.samples.rewrite(cursor, query, self.data_version)
+            if estimated:
+                executed_query, sample_fraction = estimated.sql, estimated.fraction
+                logger.info(f"Query estimated from a {sample_fraction:.1%} sample of {estimated.table}")
+        
+        if not self.governor:
+            return executed_query, rollup, sample_fraction, None
+        
+        try:
+            row_counts = {table: info['row_count'] for table, info in self.schema_info.items()}
+            cost = self.governor.estimate(cursor, _cap_query(executed_query, row_cap + 1) or executed_query, row_counts)
+        except duckdb.Error as e:
+            # Statements EXPLAIN cannot plan run ungoverned; invalid SQL fails the same way when executed
+            logger.debug(f"No cost estimate for query {query_id}: {e}")
+            return executed_query, rollup, sample_fraction, None
+        
+        estimated = None
+        if cost.cost_class == HEAVY and self.governor.heavy_policy == APPROXIMATE and sample_fraction is None \
+                and not rollup and self.samples:
+            estimated = self.samples.rewrite(cursor, query, self.data_version)
+        action = self.governor.decide(cost, can_approximate=estimated is not None)
+        if cost.cost_class != CHEAP:
+            logger.warning(f"Query {query_id} is {cost.cost_class}, action {action}: {cost.reason()}")
+        
+        if action == REJECT:
+            raise QueryRejectedError(cost.reason(), cost)
+        if estimated:
+            executed_query, sample_fraction = estimated.sql, estimated.fraction
+            logger.info(f"Heavy query estimated from a {sample_fraction:.1%} sample of {estimated.table}")
+        return executed_query, rollup, sample_fraction, cost
+    
+    def _approximation_details(self, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """Add the confidence level to result metadata of estimated answers"""
+        if metadata.get('sample_fraction') is not None:
+            metadata['confidence'] = self.samples.confidence if self.samples else config.database.approx_confidence
+        return metadata
+    
+    def _execute_with_deadline(self, cursor: duckdb.DuckDBPyConnection, query: str, timeout: float,
+                               handle: QueryHandle, row_cap: int) -> Tuple[pa.Table, bool]:
+        """
+        Run a query on a cursor, interrupting it at the deadline or on cancel
+        
+        Returns:
+            Tuple of (at most row_cap rows as an Arrow table, whether rows were cut off)
+        """
+        if handle.reason:
+            handle.raise_for_interrupt(timeout)
+        
+        deadline = threading.Timer(timeout, handle.cancel, kwargs={'reason': 'timeout'})
+        deadline.daemon = True
+        self.engine.register_query(handle)
+        handle.attach(cursor)
+        deadline.start()
+        try:
+            # Ask for one row past the cap so truncation can be detected
+            capped_query = _cap_query(query, row_cap + 1)
+            try:
+                executed = cursor.execute(capped_query or query)
+            except duckdb.ParserException:
+                if capped_query is None:
+                    raise
+                executed = cursor.execute(query)
+            
+            batches, row_count = [], 0
+            reader = _arrow_reader(executed, row_cap + 1)
+            for batch in reader:
+                batches.append(batch)
+                row_count += batch.num_rows
+                if row_count > row_cap:
+                    break
+            
+            table = pa.Table.from_batches(batches, schema=reader.schema)
+            if row_count > row_cap:
+                return table.slice(0, row_cap), True
+            return table, False
+        except duckdb.InterruptException:
+            handle.raise_for_interrupt(timeout)
+        finally:
+            deadline.cancel()
+            handle.detach()
+            self.engine.unregister_query(handle)
+    
+    def cancel_query(self, query_id: str) -> bool:
+        """Cancel a running query by id, from any session"""
+        handle = self.engine.active_queries.get(query_id)
+        return handle.cancel() if handle else False
+    
+    def cancel_session_queries(self) -> int:
+        """Cancel every query this session is running, returning how many were interrupted"""
+        handles = [h for h in list(self.engine.active_queries.values()) if h.session_id == self.session_id]
+        return sum(1 for handle in handles if handle.cancel())
+    
+    async def _run_async(self, func, *args, handle: Optional[QueryHandle] = None, **kwargs):
+        """
+        Await a blocking call on the engine's bounded executor
+        
+        Cancelling the awaiting task interrupts the query behind the handle,
+        so the worker thread and its pooled cursor are freed promptly.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.engine.executor(), functools.partial(func, *args, **kwargs))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if handle:
+                handle.cancel()
+            raise
+    
+    async def arun_query(self, query: str, params: Optional[Dict] = None, timeout: Optional[float] = None,
+                         handle: Optional[QueryHandle] = None, count_total: Optional[bool] = None,
+                         approximate: bool = False, profile: Optional[bool] = None,
+                         keep_result: bool = False) -> QueryResult:
+        """
+        Async run_query: several independent queries can be awaited together with asyncio.gather
+        
+        Cancelling the task cancels the query, which then ends as a
+        'cancelled' query in the stats and the query log.
+        """
+        handle = handle or QueryHandle(self.session_id)
+        return await self._run_async(self.run_query, query, params, timeout, handle, count_total,
+                                     approximate, profile, keep_result, handle=handle)
+    
+    async def aexecute_query(self, query: str, params: Optional[Dict] = None,
+                             approximate: bool = False) -> Tuple[pd.DataFrame, Optional[str]]:
+        """Async execute_query, returning (DataFrame, error message if any)"""
+        result = await self.arun_query(query, params, approximate=approximate)
+        return result.data, result.error
+    
+    async def aload_csv_data(self, data_dir: Path, parallel: Optional[bool] = None,
+                             force_reload: bool = False) -> Dict[str, int]:
+        """
+        Async load_csv_data
+        
+        Loading runs to completion once started: cancelling the task only
+        stops waiting for it.
+        """
+        return await self._run_async(self.load_csv_data, data_dir, parallel, force_reload)
+    
+    async def arefresh_schema(self) -> Dict[str, Any]:
+        """Async refresh_schema"""
+        return await self._run_async(self.refresh_schema)
+    
+    def get_query_stats(self) -> Dict[str, int]:
+        """Get counts of executed, failed, timed out and cancelled queries"""
+        return dict(self.engine.query_events)
+    
+    def _arrow_to_pandas(self, table: pa.Table, cursor: Optional[duckdb.DuckDBPyConnection] = None) -> pd.DataFrame:
+        """Convert an Arrow result with the same dtypes fetchdf() would produce"""
+        df = (cursor or self.conn).from_arrow(table).df()
+        # ENUM columns arrive as Arrow dictionaries, which DuckDB reads back as text
+        for position, column in enumerate(table.columns):
+            if pa.types.is_dictionary(column.type) and column.num_chunks:
+                categories = column.chunk(0).dictionary.to_pylist()
+                df.isetitem(position, pd.Categorical(df.iloc[:, position], categories=categories, ordered=True))
+        return df
+    
+    def get_query_cache_stats(self) -> Dict[str, Any]:
+        """Get query result cache counters"""
+        return self.query_cache.stats() if self.query_cache else {}
+    
+    def clear_query_cache(self):
+        """Drop all cached query results"""
+        if self.query_cache:
+            self.query_cache.clear()
     
     def get_table_stats(self, table_name: str) -> Dict[str, Any]:
         """Get statistical information about a table"""
@@ -194,8 +1450,76 @@ class DatabaseManager:
             logger.error(f"Error getting table stats: {e}")
             return {}
     
+    def get_slow_queries(self, limit: int = 50) -> pd.DataFrame:
+        """Get recent queries that ran past the slow-query threshold, with their plans"""
+        return self.engine.query_log.slow_queries(limit) if self.engine.query_log else pd.DataFrame()
+    
+    def get_query_shape_stats(self, limit: int = 50) -> pd.DataFrame:
+        """Get p50/p95 latency by normalized query shape, the costliest shapes first"""
+        return self.engine.query_log.shape_stats(limit) if self.engine.query_log else pd.DataFrame()
+    
+    def get_type_savings_report(self) -> pd.DataFrame:
+        """
+        Compare each table's in-memory size under its typed columns with untyped loading
+        
+        The baseline reads strings and dates as text and numbers as 64-bit,
+        as type sniffing would. Sizes are Arrow buffer bytes of the full
+        table, streamed in batches so only one batch is held at a time.
+        
+        Returns:
+            DataFrame with table, rows, typed_bytes, baseline_bytes, saved_bytes and saved_pct
+        """
+        def arrow_bytes(cursor: duckdb.DuckDBPyConnection, query: str) -> Tuple[int, int]:
+            rows = size = 0
+            for batch in _arrow_reader(cursor.execute(query), 100_000):
+                rows += batch.num_rows
+                size += batch.nbytes
+            return rows, size
+        
+        report = []
+        with self.engine.pooled_cursor() as cursor:
+            for table_name, spec in OLIST_TABLES.items():
+                if table_name not in self.schema_info:
+                    continue
+                baseline = ", ".join(f"CAST({col} AS {baseline_type(col_type)}) AS {col}"
+                                     for col, col_type in spec.column_types.items())
+                rows, typed_bytes = arrow_bytes(cursor, f"SELECT {', '.join(spec.column_types)} FROM {table_name}")
+                _, baseline_bytes = arrow_bytes(cursor, f"SELECT {baseline} FROM {table_name}")
+                report.append({
+                    'table': table_name,
+                    'rows': rows,
+                    'typed_bytes': typed_bytes,
+                    'baseline_bytes': baseline_bytes,
+                    'saved_bytes': baseline_bytes - typed_bytes,
+                    'saved_pct': round(100 * (baseline_bytes - typed_bytes) / baseline_bytes, 1) if baseline_bytes else 0.0,
+                })
+        return pd.DataFrame(report)
+    
+    def get_cost_governor_stats(self) -> Dict[str, int]:
+        """Get how many queries the cost governor ran, approximated, queued or rejected"""
+        return self.governor.stats() if self.governor else {}
+    
+    def get_rollup_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get build version, size and routed query count for each rollup"""
+        return self.rollups.stats() if self.rollups else {}
+    
+    def get_sample_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get size, sampled fraction and estimated query count for each table sample"""
+        return self.samples.stats() if self.samples else {}
+    
+    def get_snapshot_manifest(self) -> Dict[str, Dict[str, Any]]:
+        """Get the snapshot manifest keyed by table name"""
+        if not self.snapshots:
+            return {}
+        return {table: dict(entry) for table, entry in self.snapshots.manifest.items()}
+    
+    def get_engine_stats(self) -> Dict[str, Any]:
+        """Get usage of the shared engine's cursor pool"""
+        return self.engine.stats()
+    
     def close(self):
-        """Close database connection"""
-        if self.conn:
-            self.conn.close()
+        """Close this session's cursor and release the shared engine"""
+        self._release_retired_engines(force=True)
+        if self.conn and self._release.alive:
+            self._release()
             logger.info("Database connection closed")
@@ -0,0 +1,208 @@
+"""
+Shared DuckDB Engine
+One database instance per file for the whole process, handing out cursors to sessions
+"""
+
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Any, Iterator, Optional
+import duckdb
+from src.config import config
+from src.database.query_control import QueryTimeoutError
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+_engines: Dict[str, "DuckDBEngine"] = {}
+_engines_lock = threading.Lock()
+
+
+class DuckDBEngine:
+    """
+    A DuckDB database shared by every DatabaseManager in the process
+    
+    Sessions get their own cursor on the shared database, so they share
+    one buffer pool, and queries run on cursors borrowed from a bounded
+    pool. Loads and ingests write through the session cursors; pooled
+    cursors only ever hold read-only transactions. State that must agree
+    across sessions (schema catalog, data version, result cache, snapshots,
+    stored results) is held here rather than per session.
+    """
+    
+    def __init__(self, db_path: Path, read_only: bool = False):
+        self.db_path = db_path
+        self.read_only = read_only
+        self.pool_size = config.database.connection_pool_size
+        self.refcount = 0
+        
+        settings = {}
+        if config.database.threads:
+            settings['threads'] = config.database.threads
+        if config.database.memory_limit:
+            settings['memory_limit'] = config.database.memory_limit
+        self.database = duckdb.connect(str(db_path), read_only=read_only, config=settings)
+        
+        self._pool: "queue.LifoQueue[duckdb.DuckDBPyConnection]" = queue.LifoQueue()
+        self._pool_created = 0
+        self._pool_lock = threading.Lock()
+        
+        # Shared per-database state, populated by DatabaseManager
+        self.schema_info: Dict[str, Any] = {}
+        self.data_version: str = ""
+        self.catalog = None
+        self.snapshots = None
+        self.partitions = None
+        self.query_cache = None
+        self.rollups = None
+        self.samples = None
+        self.query_log = None
+        self.governor = None
+        self.results = None
+        self.statistics: Dict[str, Any] = {}
+        self.stats_catalog = None
+        self.write_lock = threading.RLock()
+        
+        # Running queries by id, and counters of how queries ended
+        self.active_queries: Dict[str, Any] = {}
+        self.query_events: Counter = Counter()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self._events_lock = threading.Lock()
+        
+        logger.info(f"DuckDB engine opened: {db_path} (read_only={read_only}, settings={settings})")
+    
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        """Open a dedicated cursor for a session or thread"""
+        return self.database.cursor()
+    
+    @contextmanager
+    def pooled_cursor(self, timeout: Optional[float] = None) -> Iterator[duckdb.DuckDBPyConnection]:
+        """
+        Borrow a cursor from the bounded query pool
+        
+        At most pool_size queries run at once across all sessions; further
+        callers wait for a cursor to be returned, until their deadline. The
+        cursor is lent inside a read-only transaction, so nothing run on it
+        can change the database even when the engine is opened read-write
+        for loading (DuckDB cannot open one file both read-only and
+        read-write in a process). Temporary objects and COPY ... TO still work.
+        
+        Raises:
+            QueryTimeoutError: If no cursor is returned within timeout seconds
+        """
+        try:
+            cursor = self._pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                create = self._pool_created < self.pool_size
+                if create:
+                    self._pool_created += 1
+            if create:
+                cursor = self.database.cursor()
+            else:
+                try:
+                    cursor = self._pool.get(timeout=timeout)
+                except queue.Empty:
+                    raise QueryTimeoutError(timeout)
+        
+        try:
+            cursor.execute("BEGIN TRANSACTION READ ONLY")
+            yield cursor
+        finally:
+            try:
+                cursor.execute("ROLLBACK")
+            except duckdb.Error:
+                pass  # An interrupted query may already have ended the transaction
+            self._pool.put(cursor)
+    
+    def register_query(self, handle: Any):
+        """Track a running query so it can be cancelled from any session"""
+        self.active_queries[handle.query_id] = handle
+    
+    def unregister_query(self, handle: Any):
+        """Stop tracking a finished query"""
+        self.active_queries.pop(handle.query_id, None)
+    
+    def executor(self) -> ThreadPoolExecutor:
+        """
+        Worker threads running the async API's blocking calls
+        
+        Sized like the cursor pool, so awaiting more queries than the pool
+        holds queues them here rather than in threads blocked on the pool.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="duckdb-async")
+            return self._executor
+    
+    def record_query_event(self, event: str):
+        """Count how a query ended ('executed', 'failed', 'timeout', 'cancelled', 'rejected')"""
+        with self._events_lock:
+            self.query_events[event] += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get pool usage for monitoring"""
+        idle = self._pool.qsize()
+        return {
+            'db_path': str(self.db_path),
+            'read_only': self.read_only,
+            'sessions': self.refcount,
+            'pool_size': self.pool_size,
+            'pool_open': self._pool_created,
+            'pool_busy': self._pool_created - idle,
+            'active_queries': len(self.active_queries),
+        }
+    
+    def close(self):
+        """Close pooled cursors and the database"""
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        while not self._pool.empty():
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        if self.query_log:
+            self.query_log.close()
+        if self.results:
+            self.results.clear()
+        self.database.close()
+        logger.info(f"DuckDB engine closed: {self.db_path}")
+
+
+def get_engine(db_path: Path, read_only: Optional[bool] = None) -> DuckDBEngine:
+    """Get the process-wide engine for a database file, opening it on first use"""
+    if read_only is None:
+        read_only = config.database.read_only
+    key = str(Path(db_path).resolve()) if str(db_path) != ':memory:' else str(db_path)
+    
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = DuckDBEngine(db_path, read_only=read_only)
+            _engines[key] = engine
+        elif engine.read_only and not read_only:
+            raise RuntimeError(f"Database {db_path} is already open read-only in this process")
+        engine.refcount += 1
+        return engine
+
+
+def release_engine(engine: DuckDBEngine, cursor: Optional[duckdb.DuckDBPyConnection] = None):
+    """Release a session's hold on an engine, closing it when no sessions remain"""
+    if cursor is not None:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+    
+    with _engines_lock:
+        engine.refcount -= 1
+        if engine.refcount <= 0:
+            for key, registered in list(_engines.items()):
+                if registered is engine:
+                    del _engines[key]
+            engine.close()
@@ -0,0 +1,167 @@
+"""
+Olist Dataset Table Definitions
+Maps the Brazilian E-Commerce CSV files to tables with explicit column types
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+from src.database.sql_ast import sql_literal
+
+# Timestamp layout used by every date column in the Olist exports
+OLIST_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Bumped whenever a column type below changes, so tables and snapshots written with older types are re-ingested
+TYPE_MAP_VERSION = 2
+
+BRAZILIAN_STATES = (
+    'AC', 'AL', 'AM', 'AP', 'BA', 'CE', 'DF', 'ES', 'GO', 'MA', 'MG', 'MS', 'MT', 'PA',
+    'PB', 'PE', 'PI', 'PR', 'RJ', 'RN', 'RO', 'RR', 'RS', 'SC', 'SE', 'SP', 'TO',
+)
+ORDER_STATUSES = ('approved', 'canceled', 'created', 'delivered', 'invoiced', 'processing', 'shipped', 'unavailable')
+PAYMENT_TYPES = ('boleto', 'credit_card', 'debit_card', 'not_defined', 'voucher')
+
+# Money columns carry at most two decimals in the exports
+MONEY = 'DECIMAL(10,2)'
+
+
+def enum_type(values: Tuple[str, ...]) -> str:
+    """Dictionary-encoded type for a closed set of string values"""
+    return "ENUM(" + ", ".join(sql_literal(value) for value in values) + ")"
+
+
+STATE = enum_type(BRAZILIAN_STATES)
+
+
+def baseline_type(col_type: str) -> str:
+    """Type the column would get from untyped loading: text for strings and dates, 64-bit numbers"""
+    col_type = col_type.upper()
+    if col_type.startswith(('ENUM', 'VARCHAR', 'TIMESTAMP', 'DATE')):
+        return 'VARCHAR'
+    if col_type.startswith(('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT')):
+        return 'BIGINT'
+    return 'DOUBLE'
+
+
+@dataclass(frozen=True)
+class TableSpec:
+    """Source file and column types for one dataset table"""
+    table_name: str
+    csv_file: str
+    column_types: Dict[str, str] = field(default_factory=dict)
+    natural_key: Tuple[str, ...] = ()  # Set for append-only tables that accept incremental ingest
+    sort_key: Tuple[str, ...] = ()  # Rows are stored in this order so range filters skip row groups
+    
+    @property
+    def timestamp_columns(self) -> List[str]:
+        """Columns parsed as timestamps at ingest"""
+        return [col for col, col_type in self.column_types.items() if col_type == 'TIMESTAMP']
+    
+    @property
+    def enum_columns(self) -> List[str]:
+        """Low-cardinality string columns stored dictionary-encoded"""
+        return [col for col, col_type in self.column_types.items() if col_type.startswith('ENUM')]
+    
+    @property
+    def csv_types(self) -> Dict[str, str]:
+        """Types the CSV reader parses each column as; ENUM columns are read as text and cast after"""
+        return {col: 'VARCHAR' if col in self.enum_columns else col_type for col, col_type in self.column_types.items()}
+    
+    def select_list(self, enums: bool = True) -> str:
+        """SELECT list that casts text columns to their ENUM types"""
+        return ", ".join(
+            f"CAST({col} AS {col_type}) AS {col}" if enums and col in self.enum_columns else col
+            for col, col_type in self.column_types.items()
+        )
+
+
+OLIST_TABLES: Dict[str, TableSpec] = {
+    spec.table_name: spec for spec in [
+        TableSpec('customers', 'olist_customers_dataset.csv', {
+            'customer_id': 'VARCHAR',
+            'customer_unique_id': 'VARCHAR',
+            'customer_zip_code_prefix': 'INTEGER',
+            'customer_city': 'VARCHAR',
+            'customer_state': STATE,
+        }),
+        TableSpec('geolocation', 'olist_geolocation_dataset.csv', {
+            'geolocation_zip_code_prefix': 'INTEGER',
+            'geolocation_lat': 'DOUBLE',
+            'geolocation_lng': 'DOUBLE',
+            'geolocation_city': 'VARCHAR',
+            'geolocation_state': STATE,
+        }),
+        TableSpec('order_items', 'olist_order_items_dataset.csv', {
+            'order_id': 'VARCHAR',
+            'order_item_id': 'SMALLINT',
+            'product_id': 'VARCHAR',
+            'seller_id': 'VARCHAR',
+            'shipping_limit_date': 'TIMESTAMP',
+            'price': MONEY,
+            'freight_value': MONEY,
+        }, natural_key=('order_id', 'order_item_id')),
+        TableSpec('order_payments', 'olist_order_payments_dataset.csv', {
+            'order_id': 'VARCHAR',
+            'payment_sequential': 'SMALLINT',
+            'payment_type': enum_type(PAYMENT_TYPES),
+            'payment_installments': 'SMALLINT',
+            'payment_value': MONEY,
+        }, natural_key=('order_id', 'payment_sequential')),
+        TableSpec('order_reviews', 'olist_order_reviews_dataset.csv', {
+            'review_id': 'VARCHAR',
+            'order_id': 'VARCHAR',
+            'review_score': 'TINYINT',
+            'review_comment_title': 'VARCHAR',
+            'review_comment_message': 'VARCHAR',
+            'review_creation_date': 'TIMESTAMP',
+            'review_answer_timestamp': 'TIMESTAMP',
+        }, natural_key=('review_id',), sort_key=('review_creation_date',)),
+        TableSpec('orders', 'olist_orders_dataset.csv', {
+            'order_id': 'VARCHAR',
+            'customer_id': 'VARCHAR',
+            'order_status': enum_type(ORDER_STATUSES),
+            'order_purchase_timestamp': 'TIMESTAMP',
+            'order_approved_at': 'TIMESTAMP',
+            'order_delivered_carrier_date': 'TIMESTAMP',
+            'order_delivered_customer_date': 'TIMESTAMP',
+            'order_estimated_delivery_date': 'TIMESTAMP',
+        }, natural_key=('order_id',), sort_key=('order_purchase_timestamp',)),
+        TableSpec('products', 'olist_products_dataset.csv', {
+            'product_id': 'VARCHAR',
+            'product_category_name': 'VARCHAR',
+            'product_name_lenght': 'SMALLINT',
+            'product_description_lenght': 'SMALLINT',
+            'product_photos_qty': 'TINYINT',
+            'product_weight_g': 'INTEGER',
+            'product_length_cm': 'SMALLINT',
+            'product_height_cm': 'SMALLINT',
+            'product_width_cm': 'SMALLINT',
+        }),
+        TableSpec('sellers', 'olist_sellers_dataset.csv', {
+            'seller_id': 'VARCHAR',
+            'seller_zip_code_prefix': 'INTEGER',
+            'seller_city': 'VARCHAR',
+            'seller_state': STATE,
+        }),
+        TableSpec('product_category_translation', 'product_category_name_translation.csv', {
+            'product_category_name': 'VARCHAR',
+            'product_category_name_english': 'VARCHAR',
+        }),
+    ]
+}
+
+# Key relationships between the tables, as (table, column, other table, other column)
+OLIST_JOINS: List[Tuple[str, str, str, str]] = [
+    ('orders', 'customer_id', 'customers', 'customer_id'),
+    ('order_items', 'order_id', 'orders', 'order_id'),
+    ('order_payments', 'order_id', 'orders', 'order_id'),
+    ('order_reviews', 'order_id', 'orders', 'order_id'),
+    ('order_items', 'product_id', 'products', 'product_id'),
+    ('order_items', 'seller_id', 'sellers', 'seller_id'),
+    ('products', 'product_category_name', 'product_category_translation', 'product_category_name'),
+]
+
+# Joins on zip code prefix relate places, not rows, so they never connect two other tables
+OLIST_ZIP_JOINS: List[Tuple[str, str, str, str]] = [
+    ('customers', 'customer_zip_code_prefix', 'geolocation', 'geolocation_zip_code_prefix'),
+    ('sellers', 'seller_zip_code_prefix', 'geolocation', 'geolocation_zip_code_prefix'),
+]
@@ -0,0 +1,121 @@
+"""
+Order Facts
+Denormalized table joining orders with their items, products, categories, customers and sellers
+"""
+
+from typing import List, Optional, Tuple
+import duckdb
+from src.database.table_delta import TableDelta, fetch_arrow
+
+ORDER_FACTS_TABLE = "order_facts"
+
+# Tables the fact table is built from, and the ones whose deltas change it
+SOURCE_TABLES = ('orders', 'order_items', 'products', 'product_category_translation', 'customers', 'sellers')
+INCREMENTAL_SOURCES = ('orders', 'order_items')
+
+ORDER_FACTS_DESCRIPTION = (
+    "Denormalized table with one row per order item, already joined to the order, product, "
+    "English category name, customer and seller. Orders without items have a single row with "
+    "NULL item columns. Prefer it over joining the source tables, and count orders with "
+    "COUNT(DISTINCT order_id). delivery_days and delivery_delay_days are NULL until delivery; "
+    "delivery_delay_days is positive when the order arrived after its estimated date. "
+    "Rows are stored in purchase order, so filters on purchase_month or order_purchase_timestamp "
+    "only read the matching months."
+)
+
+# Rows are kept in purchase order so each row group covers few months and its min/max skip the others
+FACTS_ORDER = "order_purchase_timestamp, order_id, order_item_id"
+
+# Tables the fact table joins to for columns it does not carry
+ORDER_FACTS_JOINS: List[Tuple[str, str, str, str]] = [
+    (ORDER_FACTS_TABLE, 'order_id', 'order_payments', 'order_id'),
+    (ORDER_FACTS_TABLE, 'order_id', 'order_reviews', 'order_id'),
+    (ORDER_FACTS_TABLE, 'customer_id', 'customers', 'customer_id'),
+    (ORDER_FACTS_TABLE, 'seller_id', 'sellers', 'seller_id'),
+]
+
+# (column, type or None to keep the source column's type, expression over the joined source tables)
+FACT_COLUMNS: List[Tuple[str, Optional[str], str]] = [
+    ('order_id', 'VARCHAR', 'o.order_id'),
+    ('order_item_id', None, 'oi.order_item_id'),
+    ('order_status', None, 'o.order_status'),
+    ('order_purchase_timestamp', 'TIMESTAMP', 'o.order_purchase_timestamp'),
+    ('order_approved_at', 'TIMESTAMP', 'o.order_approved_at'),
+    ('order_delivered_carrier_date', 'TIMESTAMP', 'o.order_delivered_carrier_date'),
+    ('order_delivered_customer_date', 'TIMESTAMP', 'o.order_delivered_customer_date'),
+    ('order_estimated_delivery_date', 'TIMESTAMP', 'o.order_estimated_delivery_date'),
+    ('purchase_month', 'DATE', "date_trunc('month', o.order_purchase_timestamp)"),
+    ('customer_id', 'VARCHAR', 'o.customer_id'),
+    ('customer_unique_id', 'VARCHAR', 'c.customer_unique_id'),
+    ('customer_city', 'VARCHAR', 'c.customer_city'),
+    ('customer_state', None, 'c.customer_state'),
+    ('product_id', 'VARCHAR', 'oi.product_id'),
+    ('product_category_name', 'VARCHAR', 'p.product_category_name'),
+    ('product_category_name_english', 'VARCHAR', 't.product_category_name_english'),
+    ('seller_id', 'VARCHAR', 'oi.seller_id'),
+    ('seller_city', 'VARCHAR', 's.seller_city'),
+    ('seller_state', None, 's.seller_state'),
+    ('price', None, 'oi.price'),
+    ('freight_value', None, 'oi.freight_value'),
+    ('item_total', None, 'oi.price + oi.freight_value'),
+    ('delivery_days', 'DOUBLE',
+     "date_diff('second', o.order_purchase_timestamp, o.order_delivered_customer_date) / 86400.0"),
+    ('estimated_delivery_days', 'DOUBLE',
+     "date_diff('second', o.order_purchase_timestamp, o.order_estimated_delivery_date) / 86400.0"),
+    # Estimated dates carry no time of day, so lateness is measured in calendar days
+    ('delivery_delay_days', 'INTEGER',
+     "date_diff('day', CAST(o.order_estimated_delivery_date AS DATE), CAST(o.order_delivered_customer_date AS DATE))"),
+    ('is_late', 'BOOLEAN',
+     "CAST(o.order_delivered_customer_date AS DATE) > CAST(o.order_estimated_delivery_date AS DATE)"),
+]
+
+
+def order_facts_sql(order_filter: Optional[str] = None) -> str:
+    """
+    SELECT producing fact rows, optionally only for some orders
+    
+    Args:
+        order_filter: Subquery returning the order_id values to build rows for
+    """
+    columns = ",\n            ".join(f"CAST({expression} AS {col_type}) AS {column}" if col_type else f"{expression} AS {column}"
+                                     for column, col_type, expression in FACT_COLUMNS)
+    where = f"WHERE o.order_id IN ({order_filter})" if order_filter else ""
+    return f"""
+        SELECT
+            {columns}
+        FROM orders o
+        LEFT JOIN order_items oi ON oi.order_id = o.order_id
+        LEFT JOIN products p ON p.product_id = oi.product_id
+        LEFT JOIN product_category_translation t ON t.product_category_name = p.product_category_name
+        LEFT JOIN customers c ON c.customer_id = o.customer_id
+        LEFT JOIN sellers s ON s.seller_id = oi.seller_id
+        {where}
+    """
+
+
+def build_order_facts(cursor: duckdb.DuckDBPyConnection) -> int:
+    """Rebuild the fact table, clustered by purchase time, returning its row count"""
+    return cursor.execute(
+        f"CREATE OR REPLACE TABLE {ORDER_FACTS_TABLE} AS "
+        f"{order_facts_sql()} ORDER BY {FACTS_ORDER}"
+    ).fetchone()[0]
+
+
+def refresh_order_facts(cursor: duckdb.DuckDBPyConnection, order_ids_sql: str) -> TableDelta:
+    """
+    Rebuild the fact rows of the given orders
+    
+    Args:
+        cursor: Cursor inside the caller's write lock
+        order_ids_sql: Subquery returning the order_id values that changed
+    
+    Returns:
+        The fact rows removed and their replacements, keyed by order_id
+    """
+    removed = fetch_arrow(cursor.execute(
+        f"DELETE FROM {ORDER_FACTS_TABLE} WHERE order_id IN ({order_ids_sql}) RETURNING *"
+    ))
+    added = fetch_arrow(cursor.execute(
+        f"INSERT INTO {ORDER_FACTS_TABLE} {order_facts_sql(order_ids_sql)} ORDER BY {FACTS_ORDER} RETURNING *"
+    ))
+    return TableDelta(ORDER_FACTS_TABLE, added, removed, ('order_id',))
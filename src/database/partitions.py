@@ -0,0 +1,171 @@
+"""
+Partitioned Storage
+Month-partitioned Parquet datasets for the order tables, exposed to queries as views
+"""
+
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import Iterable, List
+import duckdb
+from src.database.olist_schema import TableSpec
+from src.database.sql_ast import sql_literal
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+PARTITION_COLUMN = "purchase_month"
+
+# Orders are written first: the other tables take their partition from their order's purchase month
+PARTITIONED_TABLES = ('orders', 'order_items', 'order_payments', 'order_reviews')
+
+# Each write of a table goes to a new version directory under the table's dataset
+_VERSION_PATTERN = re.compile(r"v\d{6}")
+
+PARTITION_NOTE = (
+    f"Stored as Parquet files partitioned by {PARTITION_COLUMN} (first day of the order's purchase month, "
+    f"a DATE). Filter on {PARTITION_COLUMN} so only the matching months are read."
+)
+
+
+class PartitionStore:
+    """
+    Order tables stored as hive-partitioned Parquet outside the DuckDB file
+    
+    Each table is written to <root>/<table>/vNNNNNN/purchase_month=YYYY-MM-01/
+    and replaced by a view over the dataset, so a filter on purchase_month
+    only opens the files of the matching months and the history does not
+    take space in the database file. Rows of an order that is not loaded go
+    to the NULL partition.
+    
+    Views list the files they read, and rewrites go to a new version
+    directory, so a published replica keeps reading the same files however
+    the table changes afterwards. Old versions are deleted by prune once no
+    view references them.
+    """
+    
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+    
+    def dataset_dir(self, table_name: str) -> Path:
+        """Directory holding every version of a table's partitions"""
+        return self.root / table_name
+    
+    def current_dir(self, table_name: str) -> Path:
+        """Latest written version of a table's partitions"""
+        versions = self._versions(table_name)
+        return versions[-1] if versions else self.dataset_dir(table_name)
+    
+    def _versions(self, table_name: str) -> List[Path]:
+        """Version directories of a table's dataset, oldest first"""
+        dataset = self.dataset_dir(table_name)
+        if not dataset.is_dir():
+            return []
+        return sorted(path for path in dataset.iterdir() if path.is_dir() and _VERSION_PATTERN.fullmatch(path.name))
+    
+    @staticmethod
+    def partitioned_views(conn: duckdb.DuckDBPyConnection) -> List[str]:
+        """Order tables currently served from their Parquet dataset"""
+        rows = conn.execute(
+            "SELECT view_name FROM duckdb_views() WHERE schema_name = 'main' AND NOT internal"
+        ).fetchall()
+        return [row[0] for row in rows if row[0] in PARTITIONED_TABLES]
+    
+    @staticmethod
+    def with_partition_sql(table_name: str, source_sql: str) -> str:
+        """Add the purchase_month partition column to rows of an order table"""
+        if table_name == 'orders':
+            return (f"SELECT *, CAST(date_trunc('month', order_purchase_timestamp) AS DATE) AS {PARTITION_COLUMN} "
+                    f"FROM ({source_sql})")
+        return (f"SELECT source.*, months.{PARTITION_COLUMN} FROM ({source_sql}) source "
+                f"LEFT JOIN (SELECT order_id, {PARTITION_COLUMN} FROM orders) months USING (order_id)")
+    
+    def view_sql(self, spec: TableSpec, enums: bool = True) -> str:
+        """View over the files of a table's current version, with ENUM columns cast back from Parquet text"""
+        files = sorted(self.current_dir(spec.table_name).glob("**/*.parquet"))
+        if not files:
+            raise FileNotFoundError(f"No partition files written for {spec.table_name}")
+        return (
+            f"CREATE OR REPLACE VIEW {spec.table_name} AS SELECT {spec.select_list(enums)}, {PARTITION_COLUMN} "
+            f"FROM read_parquet([{', '.join(sql_literal(path) for path in files)}], hive_partitioning = true, "
+            f"hive_types = {{'{PARTITION_COLUMN}': 'DATE'}})"
+        )
+    
+    @staticmethod
+    def _keeps_enums(cursor: duckdb.DuckDBPyConnection, spec: TableSpec) -> bool:
+        """True unless the table or view was loaded with its ENUM columns kept as text"""
+        column_types = cursor.execute(
+            "SELECT data_type FROM information_schema.columns WHERE table_schema = 'main' AND table_name = ?",
+            [spec.table_name]
+        ).fetchall()
+        return sum(data_type.startswith('ENUM') for data_type, in column_types) == len(spec.enum_columns)
+    
+    def write(self, cursor: duckdb.DuckDBPyConnection, spec: TableSpec) -> int:
+        """
+        Move a loaded table into its Parquet dataset and replace it with a view
+        
+        The dataset is written to a new version directory, so a failed
+        write leaves the previous partitions in place and views published
+        before keep reading their own files.
+        
+        Returns:
+            Number of rows written
+        """
+        table_name = spec.table_name
+        versions = self._versions(table_name)
+        target = self.dataset_dir(table_name) / f"v{int(versions[-1].name[1:]) + 1 if versions else 1:06d}"
+        staging = target.with_name(f"{target.name}.tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        target.parent.mkdir(exist_ok=True)
+        
+        # A table loaded with its ENUM columns kept as text keeps them as text in the view
+        enums = self._keeps_enums(cursor, spec)
+        
+        source = f"SELECT {', '.join(spec.column_types)} FROM {table_name}"
+        row_count = cursor.execute(
+            f"COPY ({self.with_partition_sql(table_name, source)}) TO {sql_literal(staging)} "
+            f"(FORMAT PARQUET, PARTITION_BY ({PARTITION_COLUMN}), OVERWRITE true)"
+        ).fetchone()[0]
+        
+        staging.rename(target)
+        view_sql = self.view_sql(spec, enums)
+        cursor.execute(f"DROP TABLE {table_name}")
+        cursor.execute(view_sql)
+        logger.info(f"Partitioned {table_name}: {row_count} rows by {PARTITION_COLUMN}")
+        return row_count
+    
+    def append(self, cursor: duckdb.DuckDBPyConnection, spec: TableSpec, rows_sql: str) -> int:
+        """
+        Write new rows of a partitioned table, with their purchase_month, as additional files in their month partitions
+        
+        Only the recreated view lists the new files; views published
+        before keep reading the files they had.
+        """
+        row_count = cursor.execute(
+            f"COPY ({rows_sql}) "
+            f"TO {sql_literal(self.current_dir(spec.table_name))} "
+            f"(FORMAT PARQUET, PARTITION_BY ({PARTITION_COLUMN}), APPEND)"
+        ).fetchone()[0]
+        cursor.execute(self.view_sql(spec, self._keeps_enums(cursor, spec)))
+        return row_count
+    
+    def referenced_dirs(self, conn: duckdb.DuckDBPyConnection) -> List[str]:
+        """Version directories that a database's views read"""
+        view_sql = "\n".join(row[0] for row in conn.execute(
+            "SELECT sql FROM duckdb_views() WHERE schema_name = 'main' AND NOT internal"
+        ).fetchall())
+        return [
+            str(path) for table_name in PARTITIONED_TABLES for path in self._versions(table_name)
+            if sql_literal(path)[1:-1] + os.sep in view_sql
+        ]
+    
+    def prune(self, referenced: Iterable[str]):
+        """Delete old version directories that no database or published replica reads"""
+        referenced = set(referenced)
+        for table_name in PARTITIONED_TABLES:
+            for path in self._versions(table_name)[:-1]:
+                if str(path) not in referenced:
+                    shutil.rmtree(path, ignore_errors=True)
+                    logger.info(f"Deleted unreferenced partitions {path}")
@@ -0,0 +1,111 @@
+"""
+Query Result Cache
+Byte-budgeted LRU cache of Arrow query results keyed on normalized SQL and data version
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+import pyarrow as pa
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+# String literals and quoted identifiers are kept verbatim during normalization
+_QUOTED_PATTERN = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+_COMMENT_PATTERN = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_VOLATILE_PATTERN = re.compile(
+    r"\b(random|setseed|uuid|gen_random_uuid|now|current_date|current_time|current_timestamp|today|get_current_time|nextval)\b",
+    re.IGNORECASE,
+)
+
+
+def normalize_sql(query: str) -> str:
+    """
+    Normalize SQL text so trivially different spellings share a cache key
+    
+    Comments are removed, whitespace is collapsed, trailing semicolons are
+    dropped and everything outside quotes is lower-cased.
+    """
+    parts = _QUOTED_PATTERN.split(query.strip())
+    normalized = []
+    for index, part in enumerate(parts):
+        if index % 2:
+            normalized.append(part)
+        else:
+            part = _COMMENT_PATTERN.sub(" ", part)
+            normalized.append(re.sub(r"\s+", " ", part).lower())
+    return "".join(normalized).strip().rstrip(";").strip()
+
+
+def is_cacheable(query: str) -> bool:
+    """Check that a query has no volatile functions whose result changes between runs"""
+    unquoted = _QUOTED_PATTERN.sub("''", query)
+    return not _VOLATILE_PATTERN.search(unquoted)
+
+
+class QueryResultCache:
+    """LRU cache of Arrow tables bounded by their total size in bytes"""
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple, Tuple[pa.Table, int]]" = OrderedDict()  # Result and bytes charged for it
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: Tuple) -> Optional[pa.Table]:
+        """Look up a cached result, marking it most recently used"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key: Tuple, table: pa.Table):
+        """Cache a result, evicting least recently used entries to stay within budget"""
+        # A slice of a larger fetch keeps the whole fetch's buffers alive, so it is copied down to its own rows
+        if table.get_total_buffer_size() > table.nbytes:
+            table = table.take(pa.array(range(table.num_rows), type=pa.int64()))
+        size = table.get_total_buffer_size()
+        if size > self.max_bytes:
+            logger.debug(f"Result of {size} bytes exceeds the query cache budget, not cached")
+            return
+        
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            
+            while self._entries and self.current_bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+            
+            self._entries[key] = (table, size)
+            self.current_bytes += size
+    
+    def clear(self):
+        """Drop every cached result"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get hit/miss/eviction counters and current usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,69 @@
+"""
+Query Control
+Deadlines and cancellation handles for running DuckDB queries
+"""
+
+import threading
+import uuid
+from typing import Optional
+import duckdb
+
+
+class QueryTimeoutError(Exception):
+    """Raised when a query runs past its deadline"""
+    
+    def __init__(self, timeout: float):
+        super().__init__(f"Query exceeded the {timeout:g}s time limit and was cancelled")
+        self.timeout = timeout
+
+
+class QueryCancelledError(Exception):
+    """Raised when a query is cancelled through its handle"""
+    
+    def __init__(self):
+        super().__init__("Query was cancelled")
+
+
+class QueryHandle:
+    """
+    Cancellation handle for one running query
+    
+    The handle interrupts the cursor the query is running on. The cursor
+    is detached before it goes back to the pool, so a late cancel or
+    deadline can never interrupt another session's query.
+    """
+    
+    def __init__(self, session_id: Optional[str] = None):
+        self.query_id = uuid.uuid4().hex[:12]
+        self.session_id = session_id
+        self.reason: Optional[str] = None  # 'timeout' or 'cancelled' once interrupted
+        self._cursor: Optional[duckdb.DuckDBPyConnection] = None
+        self._lock = threading.Lock()
+    
+    def attach(self, cursor: duckdb.DuckDBPyConnection):
+        """Bind the handle to the cursor running the query"""
+        with self._lock:
+            self._cursor = cursor
+            if self.reason:
+                cursor.interrupt()
+    
+    def detach(self):
+        """Unbind the cursor once the query has finished"""
+        with self._lock:
+            self._cursor = None
+    
+    def cancel(self, reason: str = 'cancelled') -> bool:
+        """Interrupt the query, returning False if it is no longer running"""
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+            if self._cursor is None:
+                return False
+            self._cursor.interrupt()
+            return True
+    
+    def raise_for_interrupt(self, timeout: float):
+        """Translate an interrupt into the matching structured error"""
+        if self.reason == 'timeout':
+            raise QueryTimeoutError(timeout)
+        raise QueryCancelledError()
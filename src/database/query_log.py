@@ -0,0 +1,247 @@
+"""
+Query Log
+DuckDB operator profiles, a persistent log of query timings and slow queries, and latency percentiles by query shape
+"""
+
+import hashlib
+import json
+import re
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+import duckdb
+import pandas as pd
+from src.database.cost_governor import CostEstimate
+from src.database.query_cache import normalize_sql
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Metrics DuckDB collects for a profiled query and each of its operators
+PROFILE_METRICS = {
+    'LATENCY': 'true',
+    'ROWS_RETURNED': 'true',
+    'CUMULATIVE_ROWS_SCANNED': 'true',
+    'SYSTEM_PEAK_BUFFER_MEMORY': 'true',
+    'OPERATOR_TYPE': 'true',
+    'OPERATOR_TIMING': 'true',
+    'OPERATOR_CARDINALITY': 'true',
+    'OPERATOR_ROWS_SCANNED': 'true',
+    'EXTRA_INFO': 'true',
+}
+TOP_OPERATORS = 5
+
+_STRING_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_PATTERN = re.compile(r"(?<![\w.])\d+(\.\d+)?\b")
+_VALUE_LIST_PATTERN = re.compile(r"\(\s*\?(\s*,\s*\?)+\s*\)")
+
+
+def query_shape(query: str) -> str:
+    """
+    Normalized SQL with literal values replaced by placeholders
+    
+    Queries that differ only in the values they filter on share a shape,
+    so their timings can be aggregated together.
+    """
+    shape = _STRING_LITERAL_PATTERN.sub("?", normalize_sql(query))
+    shape = _NUMBER_PATTERN.sub("?", shape)
+    return _VALUE_LIST_PATTERN.sub("(?, ...)", shape)
+
+
+def enable_profiling(cursor: duckdb.DuckDBPyConnection):
+    """Collect an operator profile for the next queries run on a cursor"""
+    cursor.execute("SET enable_profiling = 'no_output'")
+    cursor.execute("SET profiling_coverage = 'SELECT'")
+    cursor.execute(f"SET custom_profiling_settings = '{json.dumps(PROFILE_METRICS)}'")
+
+
+def disable_profiling(cursor: duckdb.DuckDBPyConnection):
+    """Stop profiling queries on a cursor before it returns to the pool"""
+    cursor.execute("RESET enable_profiling")
+
+
+def read_profile(cursor: duckdb.DuckDBPyConnection) -> Dict[str, Any]:
+    """
+    Summarize the profile of the last query run on a cursor
+    
+    Returns:
+        Dictionary with latency, rows scanned and returned, peak buffer
+        memory, the slowest operators, and the full operator tree as JSON
+    """
+    plan = json.loads(cursor.get_profiling_information(format='json'))
+    operators: List[Dict[str, Any]] = []
+    
+    def visit(node: Dict[str, Any], depth: int):
+        for child in node.get('children', []):
+            operators.append({
+                'operator': child.get('operator_name') or child.get('operator_type'),
+                'depth': depth,
+                'seconds': child.get('operator_timing', 0.0),
+                'rows': child.get('operator_cardinality', 0),
+                'rows_scanned': child.get('operator_rows_scanned', 0),
+            })
+            visit(child, depth + 1)
+    
+    visit(plan, 0)
+    return {
+        'latency': plan.get('latency'),
+        'rows_scanned': plan.get('cumulative_rows_scanned'),
+        'rows_returned': plan.get('rows_returned'),
+        'peak_memory_bytes': plan.get('system_peak_buffer_memory'),
+        'top_operators': sorted(operators, key=lambda op: op['seconds'], reverse=True)[:TOP_OPERATORS],
+        'plan': json.dumps(plan),
+    }
+
+
+class QueryLog:
+    """
+    Persistent record of query timings, with full profiles of slow queries
+    
+    Every query gets a row in query_log; those slower than the threshold
+    also get a row in slow_queries with their SQL and operator plan. The
+    log lives in its own DuckDB file so it stays writable when the data
+    database is opened read-only.
+    """
+    
+    def __init__(self, log_path: Optional[Path], slow_query_ms: float):
+        self.log_path = log_path
+        self.slow_query_ms = slow_query_ms
+        self._lock = threading.Lock()
+        try:
+            self.conn = duckdb.connect(str(log_path) if log_path else ':memory:')
+        except duckdb.Error as e:
+            # Another process holds the log file, so this one keeps its log in memory
+            logger.warning(f"Query log {log_path} unavailable, logging in memory: {e}")
+            self.conn = duckdb.connect(':memory:')
+        self._create_tables()
+    
+    def _create_tables(self):
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS query_log (
+                query_id VARCHAR,
+                session_id VARCHAR,
+                logged_at TIMESTAMP,
+                shape_hash VARCHAR,
+                shape VARCHAR,
+                status VARCHAR,
+                elapsed_ms DOUBLE,
+                rows_returned BIGINT,
+                rows_scanned BIGINT,
+                peak_memory_bytes BIGINT,
+                from_cache BOOLEAN,
+                rollup VARCHAR,
+                sample_fraction DOUBLE,
+                cost_class VARCHAR,
+                cost_action VARCHAR,
+                estimated_rows BIGINT
+            )
+        """)
+        # Logs written before the cost governor existed gain its columns
+        for column, column_type in (('cost_class', 'VARCHAR'), ('cost_action', 'VARCHAR'), ('estimated_rows', 'BIGINT')):
+            self.conn.execute(f"ALTER TABLE query_log ADD COLUMN IF NOT EXISTS {column} {column_type}")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS slow_queries (
+                query_id VARCHAR,
+                logged_at TIMESTAMP,
+                shape_hash VARCHAR,
+                elapsed_ms DOUBLE,
+                sql VARCHAR,
+                executed_sql VARCHAR,
+                error VARCHAR,
+                top_operators VARCHAR,
+                plan VARCHAR
+            )
+        """)
+        self.conn.execute("""
+            CREATE OR REPLACE VIEW query_shapes AS
+            SELECT shape_hash,
+                   any_value(shape) AS shape,
+                   COUNT(*) AS executions,
+                   quantile_cont(elapsed_ms, 0.5) AS p50_ms,
+                   quantile_cont(elapsed_ms, 0.95) AS p95_ms,
+                   MAX(elapsed_ms) AS max_ms,
+                   SUM(elapsed_ms) AS total_ms,
+                   AVG(rows_scanned) AS avg_rows_scanned,
+                   COUNT(*) FILTER (WHERE from_cache) AS cache_hits,
+                   COUNT(rollup) AS rollup_hits,
+                   COUNT(*) FILTER (WHERE status <> 'executed') AS failures,
+                   COUNT(*) FILTER (WHERE cost_class IN ('heavy', 'pathological')) AS heavy_runs,
+                   MAX(estimated_rows) AS max_estimated_rows,
+                   MAX(logged_at) AS last_seen
+            FROM query_log
+            GROUP BY shape_hash
+        """)
+    
+    def record(self, query: str, status: str, elapsed: float, query_id: Optional[str] = None,
+               session_id: Optional[str] = None, rows_returned: Optional[int] = None,
+               from_cache: bool = False, rollup: Optional[str] = None, sample_fraction: Optional[float] = None,
+               profile: Optional[Dict[str, Any]] = None, executed_query: Optional[str] = None,
+               error: Optional[str] = None, cost: Optional[CostEstimate] = None) -> bool:
+        """
+        Log one query, and its plan as well if it ran past the slow-query threshold
+        
+        Args:
+            query: SQL as submitted
+            status: 'executed', 'failed', 'timeout' or 'cancelled'
+            elapsed: Wall time in seconds, including fetching the result
+            profile: Operator profile from read_profile, if the query was profiled
+            executed_query: SQL actually run, when a rollup or sample rewrote it
+            cost: CostEstimate from the cost governor, logged next to the actual cost
+        
+        Returns:
+            True if the query was logged as slow
+        """
+        shape = query_shape(query)
+        shape_hash = hashlib.blake2b(shape.encode(), digest_size=8).hexdigest()
+        elapsed_ms = elapsed * 1000
+        profile = profile or {}
+        slow = elapsed_ms >= self.slow_query_ms and not from_cache
+        
+        try:
+            with self._lock:
+                self.conn.execute(
+                    "INSERT INTO query_log VALUES (?, ?, now(), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [query_id, session_id, shape_hash, shape, status, elapsed_ms, rows_returned,
+                     profile.get('rows_scanned'), profile.get('peak_memory_bytes'), from_cache, rollup,
+                     sample_fraction, cost.cost_class if cost else None, cost.action if cost else None,
+                     cost.peak_rows if cost else None]
+                )
+                if slow:
+                    self.conn.execute(
+                        "INSERT INTO slow_queries VALUES (?, now(), ?, ?, ?, ?, ?, ?, ?)",
+                        [query_id, shape_hash, elapsed_ms, query,
+                         executed_query if executed_query != query else None, error,
+                         json.dumps(profile['top_operators']) if profile else None, profile.get('plan')]
+                    )
+        except duckdb.Error as e:
+            logger.warning(f"Could not write to the query log: {e}")
+            return False
+        
+        if slow:
+            logger.warning(f"Slow query {query_id} took {elapsed_ms:.0f}ms: {query[:100]}")
+        return slow
+    
+    def slow_queries(self, limit: int = 50) -> pd.DataFrame:
+        """Most recent slow queries, slowest first within the limit"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT * FROM (SELECT * FROM slow_queries ORDER BY logged_at DESC LIMIT ?) "
+                "ORDER BY elapsed_ms DESC",
+                [limit]
+            ).df()
+    
+    def shape_stats(self, limit: int = 50) -> pd.DataFrame:
+        """Latency percentiles by query shape, the shapes costing the most total time first"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT * FROM query_shapes ORDER BY total_ms DESC LIMIT ?", [limit]
+            ).df()
+    
+    def execute(self, query: str) -> pd.DataFrame:
+        """Run an ad hoc query against the log tables"""
+        with self._lock:
+            return self.conn.execute(query).df()
+    
+    def close(self):
+        with self._lock:
+            self.conn.close()
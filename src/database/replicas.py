@@ -0,0 +1,131 @@
+"""
+Replica Snapshots
+Immutable, versioned copies of the database published by a writer process and served read-only by readers
+"""
+
+import json
+import shutil
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+import duckdb
+from src.database.sql_ast import sql_literal
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+STANDALONE, WRITER, READER = 'standalone', 'writer', 'reader'
+REPLICA_ROLES = (STANDALONE, WRITER, READER)
+
+LATEST_FILE = "latest.json"
+
+# Files published beside each snapshot so readers start from the writer's catalog and statistics
+SIDECAR_SUFFIXES = ('.catalog.json', '.stats.json')
+
+
+class ReplicaStore:
+    """
+    Directory of published database snapshots and the pointer to the latest one
+    
+    The writer copies its database into a new snapshot-NNNNNN.duckdb file
+    and only then replaces latest.json, so readers either see the previous
+    version or the complete new one. Published files are never modified;
+    older versions are deleted once keep_versions newer ones exist. Each
+    snapshot's entry is kept beside it with the external files it reads,
+    which must outlive the snapshot.
+    """
+    
+    def __init__(self, replica_dir: Path, keep_versions: int = 3):
+        self.replica_dir = Path(replica_dir)
+        self.replica_dir.mkdir(parents=True, exist_ok=True)
+        self.keep_versions = max(1, keep_versions)
+        self.latest_path = self.replica_dir / LATEST_FILE
+    
+    def latest(self) -> Optional[Dict[str, Any]]:
+        """Read the pointer to the latest published snapshot, None if nothing is published"""
+        if not self.latest_path.exists():
+            return None
+        try:
+            with open(self.latest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"Could not read replica pointer: {e}")
+            return None
+    
+    def snapshot_path(self, entry: Dict[str, Any]) -> Path:
+        """Database file of a published snapshot"""
+        return self.replica_dir / entry['file']
+    
+    def publish(self, conn: duckdb.DuckDBPyConnection, data_version: str, sidecars: List[Optional[Path]],
+                references: Optional[List[str]] = None) -> Dict[str, Any]:
+        """
+        Copy the database into a new snapshot and point readers at it
+        
+        Args:
+            conn: Cursor on the writer's database
+            data_version: Data version the snapshot holds
+            sidecars: Catalog and statistics files, in SIDECAR_SUFFIXES order
+            references: Directories outside the database that its views read
+        
+        Returns:
+            Pointer entry of the published snapshot
+        """
+        previous = self.latest()
+        sequence = (previous or {}).get('sequence', 0) + 1
+        name = f"snapshot-{sequence:06d}"
+        staging = self.replica_dir / f"{name}.tmp"
+        staging.unlink(missing_ok=True)
+        
+        source = conn.execute("SELECT current_database()").fetchone()[0]
+        conn.execute(f"ATTACH {sql_literal(staging)} AS replica_publish")
+        try:
+            conn.execute(f'COPY FROM DATABASE "{source}" TO replica_publish')
+        finally:
+            conn.execute("DETACH replica_publish")
+        
+        for sidecar, suffix in zip(sidecars, SIDECAR_SUFFIXES):
+            if sidecar and sidecar.exists():
+                shutil.copyfile(sidecar, self.replica_dir / f"{name}{suffix}")
+        staging.replace(self.replica_dir / f"{name}.duckdb")
+        
+        entry = {
+            'sequence': sequence,
+            'file': f"{name}.duckdb",
+            'data_version': data_version,
+            'published_at': datetime.now().isoformat(),
+            'references': references or [],
+        }
+        for path in (self.replica_dir / f"{name}.json", self.latest_path):
+            tmp_path = path.with_suffix('.json.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, indent=2)
+            tmp_path.replace(path)
+        
+        logger.info(f"Published replica snapshot {sequence} (data version {data_version})")
+        self._prune(sequence)
+        return entry
+    
+    def references(self) -> List[str]:
+        """External directories read by any snapshot that is still kept"""
+        references = set()
+        for path in self.replica_dir.glob("snapshot-*.json"):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    references.update(json.load(f).get('references', []))
+            except Exception as e:
+                logger.warning(f"Could not read snapshot entry {path.name}: {e}")
+        return sorted(references)
+    
+    def _prune(self, sequence: int):
+        """Delete snapshots older than the kept versions"""
+        for path in self.replica_dir.glob("snapshot-*"):
+            try:
+                version = int(path.name[len("snapshot-"):].split('.')[0])
+            except ValueError:
+                continue
+            if version <= sequence - self.keep_versions:
+                try:
+                    path.unlink()
+                except OSError as e:
+                    # A reader still has the file open on a platform that cannot delete open files
+                    logger.debug(f"Could not delete old snapshot {path.name}: {e}")
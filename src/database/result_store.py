@@ -0,0 +1,130 @@
+"""
+Result Store
+Query results kept server-side as Parquet files, read back one sorted page at a time
+"""
+
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.database.sql_ast import sql_literal
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class StoredResult:
+    """A full query result held on disk behind its result id"""
+    result_id: str
+    query: str
+    path: Path
+    row_count: int
+    columns: List[str]
+    created_at: float
+
+
+class ResultStore:
+    """
+    Server-side query results addressed by result id
+    
+    A result is written once as Parquet and pages are read back with
+    LIMIT/OFFSET, optionally sorted, so a large result never has to be held
+    by the UI. The least recently used results are deleted past max_results,
+    and every file is removed when the store is cleared.
+    """
+    
+    def __init__(self, max_results: int, root: Optional[Path] = None):
+        if root is not None:
+            root.mkdir(parents=True, exist_ok=True)
+        self.result_dir = Path(tempfile.mkdtemp(prefix="query_results_", dir=root))
+        self.max_results = max_results
+        self._results: "OrderedDict[str, StoredResult]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def path_for(self, result_id: str) -> Path:
+        """Parquet file a result is written to"""
+        return self.result_dir / f"{result_id}.parquet"
+    
+    @staticmethod
+    def copy_sql(query: str, path: Path) -> str:
+        """COPY statement writing every row of a query to a result file"""
+        return f"COPY (\n{query}\n) TO {sql_literal(path)} (FORMAT PARQUET)"
+    
+    def put_table(self, result_id: str, query: str, table: pa.Table) -> StoredResult:
+        """Store a result that was fetched whole"""
+        path = self.path_for(result_id)
+        pq.write_table(table, path)
+        return self.register(result_id, query, path, table.num_rows, table.column_names)
+    
+    def register(self, result_id: str, query: str, path: Path, row_count: int,
+                 columns: Optional[List[str]] = None) -> StoredResult:
+        """Record a written result file, evicting the least recently used results past the limit"""
+        if columns is None:
+            columns = pq.read_schema(path).names
+        stored = StoredResult(result_id, query, path, row_count, columns, time.time())
+        with self._lock:
+            self._results[result_id] = stored
+            self._results.move_to_end(result_id)
+            evicted = []
+            while len(self._results) > self.max_results:
+                evicted.append(self._results.popitem(last=False)[1])
+        for old in evicted:
+            old.path.unlink(missing_ok=True)
+        return stored
+    
+    def get(self, result_id: str) -> Optional[StoredResult]:
+        """Look up a result, marking it recently used"""
+        with self._lock:
+            stored = self._results.get(result_id)
+            if stored is not None:
+                self._results.move_to_end(result_id)
+            return stored
+    
+    @staticmethod
+    def page_sql(stored: StoredResult, page: int, page_size: int, sort_by: Optional[str] = None,
+                 descending: bool = False) -> str:
+        """
+        Query reading one page of a stored result
+        
+        Raises:
+            ValueError: If sort_by is not a column of the result
+        """
+        order = ""
+        if sort_by is not None:
+            if sort_by not in stored.columns:
+                raise ValueError(f"Result has no column {sort_by}")
+            column = '"' + sort_by.replace('"', '""') + '"'
+            order = f" ORDER BY {column} {'DESC' if descending else 'ASC'} NULLS LAST"
+        return f"SELECT * FROM read_parquet({sql_literal(stored.path)}){order} LIMIT {int(page_size)} OFFSET {int(page) * int(page_size)}"
+    
+    def release(self, result_id: str) -> bool:
+        """Delete a result, returning False if it was not stored"""
+        with self._lock:
+            stored = self._results.pop(result_id, None)
+        if stored is None:
+            return False
+        stored.path.unlink(missing_ok=True)
+        return True
+    
+    def clear(self):
+        """Delete every stored result and the store's directory"""
+        with self._lock:
+            self._results.clear()
+        shutil.rmtree(self.result_dir, ignore_errors=True)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Number of stored results and their size on disk"""
+        with self._lock:
+            results = list(self._results.values())
+        return {
+            'results': len(results),
+            'rows': sum(stored.row_count for stored in results),
+            'bytes': sum(stored.path.stat().st_size for stored in results if stored.path.exists()),
+        }
@@ -0,0 +1,715 @@
+"""
+Rollup Tables
+Pre-aggregated tables along the main reporting dimensions, with routing of matching queries to them
+"""
+
+import hashlib
+import json
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Set, Tuple
+import duckdb
+from src.database.sql_ast import (
+    AGGREGATES, UnsupportedQuery, parse_statement, parse_expression, parse_from, deparse_statement,
+    copy_tree, fill_placeholder, has_aggregate,
+)
+from src.database.table_delta import TableDelta
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Rollups live outside the main schema so they never appear in the LLM's schema description
+ROLLUP_SCHEMA = "rollups"
+VERSIONS_TABLE = f"{ROLLUP_SCHEMA}.rollup_versions"
+
+_UNROUTABLE_CLASSES = {'SUBQUERY', 'WINDOW', 'STAR', 'PARAMETER', 'LAMBDA'}
+# Parser output that does not change what an expression computes
+_IGNORED_KEYS = {'query_location', 'alias', 'schema', 'catalog'}
+
+
+def _month_dimensions(column: str) -> Dict[str, Tuple[str, ...]]:
+    """Purchase-month dimensions of a timestamp, with the spellings that compute each"""
+    return {
+        'purchase_month': (f"date_trunc('month', {column})",),
+        'purchase_month_label': (f"strftime({column}, '%Y-%m')",),
+        'purchase_year': (f"year({column})", f"date_part('year', {column})"),
+        'purchase_month_of_year': (f"month({column})", f"date_part('month', {column})"),
+    }
+
+
+@dataclass(frozen=True)
+class RollupSpec:
+    """Definition of one rollup table"""
+    name: str
+    source: str  # FROM clause over base tables, referenced by table name
+    dimensions: Dict[str, Tuple[str, ...]]  # Rollup column -> equivalent spellings, the first defines it
+    measures: Dict[str, str] = field(default_factory=dict)  # Column prefix -> numeric expression
+    
+    def build_sql(self) -> str:
+        """SELECT that materializes the rollup"""
+        columns = [f"{spellings[0]} AS {column}" for column, spellings in self.dimensions.items()]
+        columns.append("COUNT(*) AS row_count")
+        for prefix, expression in self.measures.items():
+            columns += [
+                f"SUM({expression}) AS {prefix}_sum",
+                f"COUNT({expression}) AS {prefix}_count",
+                f"MIN({expression}) AS {prefix}_min",
+                f"MAX({expression}) AS {prefix}_max",
+            ]
+        return f"SELECT {', '.join(columns)} FROM {self.source} GROUP BY ALL"
+    
+    @property
+    def combiners(self) -> Dict[str, str]:
+        """Aggregate that combines each partial aggregate column across rows of the same group"""
+        combiners = {'row_count': 'SUM'}
+        for prefix in self.measures:
+            combiners.update({f"{prefix}_sum": 'SUM', f"{prefix}_count": 'SUM',
+                              f"{prefix}_min": 'MIN', f"{prefix}_max": 'MAX'})
+        return combiners
+    
+    @property
+    def definition(self) -> str:
+        """Hash of the definition, so edited rollups are rebuilt"""
+        return hashlib.blake2b(self.build_sql().encode(), digest_size=8).hexdigest()
+
+
+_ORDER_MONTH = _month_dimensions('orders.order_purchase_timestamp')
+_ORDER_STATUS = {'order_status': ('orders.order_status',)}
+_CATEGORY = {
+    'product_category_name': ('products.product_category_name',),
+    'product_category_name_english': ('product_category_translation.product_category_name_english',),
+}
+_ITEM_MEASURES = {'price': 'order_items.price', 'freight_value': 'order_items.freight_value'}
+_PRODUCT_CATEGORY_JOIN = (
+    "JOIN products ON order_items.product_id = products.product_id "
+    "LEFT JOIN product_category_translation "
+    "ON products.product_category_name = product_category_translation.product_category_name"
+)
+
+ROLLUPS: List[RollupSpec] = [
+    RollupSpec('order_volume', "orders", {**_ORDER_MONTH, **_ORDER_STATUS}),
+    RollupSpec(
+        'category_sales',
+        f"order_items JOIN orders ON order_items.order_id = orders.order_id {_PRODUCT_CATEGORY_JOIN}",
+        {**_ORDER_MONTH, **_ORDER_STATUS, **_CATEGORY},
+        _ITEM_MEASURES,
+    ),
+    RollupSpec(
+        'customer_state_orders',
+        "orders JOIN customers ON orders.customer_id = customers.customer_id",
+        {**_ORDER_MONTH, **_ORDER_STATUS, 'customer_state': ('customers.customer_state',)},
+    ),
+    RollupSpec(
+        'seller_state_sales',
+        "order_items JOIN orders ON order_items.order_id = orders.order_id "
+        "JOIN sellers ON order_items.seller_id = sellers.seller_id",
+        {**_ORDER_MONTH, **_ORDER_STATUS, 'seller_state': ('sellers.seller_state',)},
+        _ITEM_MEASURES,
+    ),
+    RollupSpec(
+        'payment_type_summary',
+        "order_payments JOIN orders ON order_payments.order_id = orders.order_id",
+        {**_ORDER_MONTH, **_ORDER_STATUS, 'payment_type': ('order_payments.payment_type',)},
+        {'payment_value': 'order_payments.payment_value',
+         'payment_installments': 'order_payments.payment_installments'},
+    ),
+    RollupSpec(
+        'category_reviews',
+        f"order_reviews JOIN order_items ON order_reviews.order_id = order_items.order_id {_PRODUCT_CATEGORY_JOIN}",
+        dict(_CATEGORY),
+        {'review_score': 'order_reviews.review_score'},
+    ),
+]
+
+# Rollups of the denormalized order_facts table, tried in this order for single-table queries on it
+_FACTS_MONTH = {
+    **_month_dimensions('order_facts.order_purchase_timestamp'),
+    'purchase_month_date': ('order_facts.purchase_month',),
+    'order_status': ('order_facts.order_status',),
+}
+_FACTS_MEASURES = {
+    'price': 'order_facts.price',
+    'freight_value': 'order_facts.freight_value',
+    'item_total': 'order_facts.item_total',
+    'delivery_days': 'order_facts.delivery_days',
+    'delivery_delay_days': 'order_facts.delivery_delay_days',
+}
+
+ROLLUPS += [
+    RollupSpec(
+        'facts_category_month', "order_facts",
+        {**_FACTS_MONTH,
+         'product_category_name': ('order_facts.product_category_name',),
+         'product_category_name_english': ('order_facts.product_category_name_english',)},
+        _FACTS_MEASURES,
+    ),
+    RollupSpec(
+        'facts_customer_state_month', "order_facts",
+        {**_FACTS_MONTH, 'customer_state': ('order_facts.customer_state',), 'is_late': ('order_facts.is_late',)},
+        _FACTS_MEASURES,
+    ),
+    RollupSpec(
+        'facts_seller_state_month', "order_facts",
+        {**_FACTS_MONTH, 'seller_state': ('order_facts.seller_state',), 'is_late': ('order_facts.is_late',)},
+        _FACTS_MEASURES,
+    ),
+]
+
+
+class _NotRoutable(UnsupportedQuery):
+    """Raised when a query cannot be shown to match a rollup"""
+
+
+class _Resolver:
+    """Resolves column references to (table, column) through the FROM clause's aliases"""
+    
+    def __init__(self, aliases: Dict[str, str], table_columns: Dict[str, Set[str]]):
+        self.aliases = aliases
+        self.table_columns = table_columns
+    
+    def column(self, node: Dict[str, Any]) -> Tuple[str, str]:
+        names = [name.lower() for name in node['column_names']]
+        if len(names) == 2 and names[0] in self.aliases:
+            return self.aliases[names[0]], names[1]
+        if len(names) == 1:
+            owners = {table for table in self.aliases.values() if names[0] in self.table_columns.get(table, ())}
+            if len(owners) == 1:
+                return owners.pop(), names[0]
+        raise _NotRoutable(f"Cannot resolve column {'.'.join(names)}")
+    
+    def canonical(self, node: Any) -> Any:
+        """Expression tree with aliases and parser positions removed and columns resolved"""
+        if isinstance(node, dict):
+            if node.get('class') == 'COLUMN_REF':
+                return {'column': list(self.column(node))}
+            if node.get('class') in _UNROUTABLE_CLASSES:
+                raise _NotRoutable(f"{node['class']} expressions are not routed")
+            return {
+                key: value.lower() if key == 'function_name' else self.canonical(value)
+                for key, value in node.items() if key not in _IGNORED_KEYS
+            }
+        if isinstance(node, list):
+            return [self.canonical(value) for value in node]
+        return node
+    
+    def key(self, node: Dict[str, Any]) -> str:
+        return json.dumps(self.canonical(node), sort_keys=True)
+
+
+def _collect_aliases(node: Dict[str, Any], aliases: Dict[str, str]):
+    """Map every alias in a FROM clause to its base table"""
+    if node['type'] == 'BASE_TABLE':
+        if node.get('sample') or node.get('at_clause') or node.get('column_name_alias') or \
+                node.get('catalog_name') or node.get('schema_name') not in ('', 'main'):
+            raise _NotRoutable("Only plain base tables are routed")
+        table = node['table_name'].lower()
+        alias = (node['alias'] or node['table_name']).lower()
+        if alias in aliases or table in aliases.values():
+            raise _NotRoutable("Tables joined more than once are not routed")
+        aliases[alias] = table
+    elif node['type'] == 'JOIN':
+        if node['join_type'] not in ('INNER', 'LEFT') or node['ref_type'] != 'REGULAR':
+            raise _NotRoutable(f"{node['join_type']} joins are not routed")
+        _collect_aliases(node['left'], aliases)
+        _collect_aliases(node['right'], aliases)
+    else:
+        raise _NotRoutable(f"{node['type']} sources are not routed")
+
+
+def _conjuncts(node: Dict[str, Any]) -> List[Dict[str, Any]]:
+    if node.get('type') == 'CONJUNCTION_AND':
+        return [part for child in node['children'] for part in _conjuncts(child)]
+    return [node]
+
+
+def _source_signature(from_table: Dict[str, Any], resolver: _Resolver) -> Tuple:
+    """
+    Describe a join tree independently of how it was written
+    
+    Inner joins on column equalities commute, so they are reduced to the set
+    of tables and equalities. Left joins of a single table are kept as
+    separate edges; inner join conditions may not reference left-joined
+    tables, which keeps the reordering exact.
+    """
+    inner_tables: Set[str] = set()
+    inner_conditions: Set[frozenset] = set()
+    left_edges: Set[Tuple[str, frozenset]] = set()
+    left_tables: Set[str] = set()
+    
+    def join_conditions(node: Dict[str, Any], left: Set[str], right: Set[str]) -> frozenset:
+        pairs = set()
+        if node.get('using_columns'):
+            for column in node['using_columns']:
+                column = column.lower()
+                owners = [{t for t in side if column in resolver.table_columns.get(t, ())} for side in (left, right)]
+                if any(len(side) != 1 for side in owners):
+                    raise _NotRoutable(f"Ambiguous USING column {column}")
+                pairs.add(frozenset({(owners[0].pop(), column), (owners[1].pop(), column)}))
+        elif node.get('condition'):
+            for comparison in _conjuncts(node['condition']):
+                if comparison.get('type') != 'COMPARE_EQUAL' or \
+                        comparison['left'].get('class') != 'COLUMN_REF' or comparison['right'].get('class') != 'COLUMN_REF':
+                    raise _NotRoutable("Only equi-joins are routed")
+                pairs.add(frozenset({resolver.column(comparison['left']), resolver.column(comparison['right'])}))
+        if not pairs:
+            raise _NotRoutable("Joins without conditions are not routed")
+        return frozenset(pairs)
+    
+    def visit(node: Dict[str, Any]) -> Set[str]:
+        if node['type'] == 'BASE_TABLE':
+            table = resolver.aliases[(node['alias'] or node['table_name']).lower()]
+            inner_tables.add(table)
+            return {table}
+        
+        left = visit(node['left'])
+        if node['join_type'] == 'LEFT':
+            if node['right']['type'] != 'BASE_TABLE':
+                raise _NotRoutable("Only single tables are routed on the right of a left join")
+            table = resolver.aliases[(node['right']['alias'] or node['right']['table_name']).lower()]
+            left_edges.add((table, join_conditions(node, left, {table})))
+            left_tables.add(table)
+            return left | {table}
+        
+        right = visit(node['right'])
+        conditions = join_conditions(node, left, right)
+        if any(column[0] in left_tables for pair in conditions for column in pair):
+            raise _NotRoutable("Inner joins on left-joined tables are not routed")
+        inner_conditions.update(conditions)
+        return left | right
+    
+    visit(from_table)
+    return frozenset(inner_tables), frozenset(inner_conditions), frozenset(left_edges)
+
+
+@dataclass
+class _CompiledRollup:
+    """A rollup's source signature and the canonical forms of its columns"""
+    spec: RollupSpec
+    tables: Set[str]
+    signature: Tuple
+    dimensions: Dict[str, str]  # Canonical expression -> rollup column
+    measures: Dict[str, str]  # Canonical expression -> measure column prefix
+
+
+class RollupManager:
+    """
+    Builds rollup tables and routes aggregate queries to them
+    
+    A query is routed only when its FROM clause is the rollup's source,
+    every grouping and filter expression is a rollup dimension, and every
+    aggregate can be recomputed from the rollup's partial aggregates. The
+    rewritten query must also produce the same column names and types.
+    """
+    
+    def __init__(self, specs: Optional[List[RollupSpec]] = None):
+        self.specs = specs if specs is not None else ROLLUPS
+        self.versions: Dict[str, str] = {}  # Rollup -> data version it was built from
+        self.row_counts: Dict[str, int] = {}
+        self.routed: Counter = Counter()
+        self._compiled: Dict[Tuple, List[_CompiledRollup]] = {}
+        self._templates: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+    
+    def refresh(self, conn: duckdb.DuckDBPyConnection, data_version: str,
+                table_columns: Dict[str, Set[str]], read_only: bool = False,
+                previous_version: Optional[str] = None, deltas: Optional[List[TableDelta]] = None) -> Dict[str, int]:
+        """
+        Build every rollup that was not built from the current data version
+        
+        Given the deltas that led from previous_version, rollups that were
+        current are maintained instead of rebuilt: rollups over unchanged
+        tables are kept, rows appended to one of a rollup's inner-joined
+        tables are aggregated and merged in, and any other rollup is marked
+        stale and rebuilt when a query first needs it.
+        
+        Returns:
+            Dictionary of rebuilt rollups and their row counts
+        """
+        self._compile(conn, table_columns)
+        stored = self._stored_versions(conn)
+        changed = {delta.table: delta for delta in deltas or []}
+        rebuilt, merged, stale = {}, {}, []
+        
+        for compiled in self._all_compiled():
+            spec = compiled.spec
+            version, definition, row_count = stored.get(spec.name, (None, None, None))
+            if (version, definition) == (data_version, spec.definition):
+                self.versions[spec.name] = data_version
+                self.row_counts[spec.name] = row_count
+                continue
+            if read_only:
+                self.versions.pop(spec.name, None)
+                continue
+            
+            if deltas is not None:
+                current = (version, definition) == (previous_version, spec.definition)
+                sources = compiled.tables & set(changed)
+                if current and not sources:
+                    conn.execute(f"UPDATE {VERSIONS_TABLE} SET data_version = ? WHERE rollup_name = ?",
+                                 [data_version, spec.name])
+                    self.versions[spec.name] = data_version
+                elif current and self._mergeable(compiled, [changed[table] for table in sources]):
+                    merged[spec.name] = self._merge(conn, spec, changed[sources.pop()], data_version)
+                else:
+                    self.versions.pop(spec.name, None)
+                    stale.append(spec.name)
+                continue
+            
+            rebuilt[spec.name] = self._build(conn, spec, data_version)
+        
+        if rebuilt:
+            logger.info(f"Rollups rebuilt for data version {data_version}: {rebuilt}")
+        if merged or stale:
+            logger.info(f"Rollups maintained for data version {data_version}: merged {merged}, stale {stale}")
+        return rebuilt
+    
+    def rebuild(self, conn: duckdb.DuckDBPyConnection, data_version: str, names: List[str]) -> Dict[str, int]:
+        """Rebuild the named rollups from the current data"""
+        rebuilt = {
+            compiled.spec.name: self._build(conn, compiled.spec, data_version)
+            for compiled in self._all_compiled() if compiled.spec.name in names
+        }
+        logger.info(f"Stale rollups rebuilt for data version {data_version}: {rebuilt}")
+        return rebuilt
+    
+    def stale(self, data_version: str) -> List[str]:
+        """Rollups not built from the current data version"""
+        return [compiled.spec.name for compiled in self._all_compiled()
+                if self.versions.get(compiled.spec.name) != data_version]
+    
+    def stale_for(self, conn: duckdb.DuckDBPyConnection, query: str, data_version: str,
+                  table_columns: Dict[str, Set[str]]) -> List[str]:
+        """Stale rollups over the same join as a query, which could answer it once rebuilt"""
+        try:
+            matched = self._matching(conn, query, table_columns)
+        except (UnsupportedQuery, duckdb.Error, KeyError, TypeError):
+            return []
+        if matched is None:
+            return []
+        return [compiled.spec.name for compiled in matched[2] if self.versions.get(compiled.spec.name) != data_version]
+    
+    def _build(self, conn: duckdb.DuckDBPyConnection, spec: RollupSpec, data_version: str) -> int:
+        """Materialize a rollup from its source tables and record its version"""
+        row_count = conn.execute(
+            f"CREATE OR REPLACE TABLE {ROLLUP_SCHEMA}.{spec.name} AS {spec.build_sql()}"
+        ).fetchone()[0]
+        self._record(conn, spec, data_version, row_count)
+        return row_count
+    
+    @staticmethod
+    def _mergeable(compiled: _CompiledRollup, deltas: List[TableDelta]) -> bool:
+        """
+        True if a rollup can absorb the deltas by aggregating only the new rows
+        
+        With one changed table, the new join rows are exactly the appended
+        rows joined to the unchanged tables, unless the changed table is on
+        the right of a left join, where new rows can replace NULL matches.
+        """
+        left_joined = {table for table, _ in compiled.signature[2]}
+        return len(deltas) == 1 and deltas[0].append_only and deltas[0].table not in left_joined
+    
+    def _merge(self, conn: duckdb.DuckDBPyConnection, spec: RollupSpec, delta: TableDelta, data_version: str) -> int:
+        """Aggregate the rows appended to one source table and combine them with the rollup's groups"""
+        rollup = f"{ROLLUP_SCHEMA}.{spec.name}"
+        combiners = spec.combiners
+        columns = [
+            f"CAST({combiners[column]}({column}) AS {column_type}) AS {column}" if column in combiners else column
+            for column, column_type in conn.execute(f"SELECT column_name, column_type FROM (DESCRIBE {rollup})").fetchall()
+        ]
+        # The delta's rows stand in for the source table in the rollup's own definition
+        with delta.rows_sql(conn) as rows_sql:
+            row_count = conn.execute(
+                f"CREATE OR REPLACE TABLE {rollup} AS WITH {delta.table} AS ({rows_sql}) "
+                f"SELECT {', '.join(columns)} FROM (FROM {rollup} UNION ALL BY NAME {spec.build_sql()}) "
+                f"GROUP BY {', '.join(spec.dimensions)}"
+            ).fetchone()[0]
+        self._record(conn, spec, data_version, row_count)
+        return row_count
+    
+    def _record(self, conn: duckdb.DuckDBPyConnection, spec: RollupSpec, data_version: str, row_count: int):
+        conn.execute(f"INSERT OR REPLACE INTO {VERSIONS_TABLE} VALUES (?, ?, ?, ?, now())",
+                     [spec.name, data_version, spec.definition, row_count])
+        self.versions[spec.name] = data_version
+        self.row_counts[spec.name] = row_count
+    
+    def _stored_versions(self, conn: duckdb.DuckDBPyConnection) -> Dict[str, Tuple[str, str, int]]:
+        """Read which data version each persisted rollup was built from"""
+        exists = conn.execute(
+            "SELECT COUNT(*) FROM duckdb_tables() WHERE schema_name = ? AND table_name = 'rollup_versions'",
+            [ROLLUP_SCHEMA]
+        ).fetchone()[0]
+        if not exists:
+            try:
+                conn.execute(f"CREATE SCHEMA IF NOT EXISTS {ROLLUP_SCHEMA}")
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (
+                        rollup_name VARCHAR PRIMARY KEY,
+                        data_version VARCHAR,
+                        definition VARCHAR,
+                        row_count BIGINT,
+                        built_at TIMESTAMP
+                    )
+                """)
+            except duckdb.Error:
+                pass  # Read-only database without rollups
+            return {}
+        rows = conn.execute(f"SELECT rollup_name, data_version, definition, row_count FROM {VERSIONS_TABLE}").fetchall()
+        return {name: (version, definition, row_count) for name, version, definition, row_count in rows}
+    
+    def _compile(self, conn: duckdb.DuckDBPyConnection, table_columns: Dict[str, Set[str]]):
+        """Canonicalize each rollup whose source tables exist"""
+        compiled = {}
+        for spec in self.specs:
+            from_table = parse_from(conn, spec.source)
+            aliases: Dict[str, str] = {}
+            _collect_aliases(from_table, aliases)
+            if not set(aliases.values()) <= set(table_columns):
+                logger.debug(f"Rollup {spec.name} skipped, source tables not loaded")
+                continue
+            
+            resolver = _Resolver(aliases, table_columns)
+            dimensions = {
+                resolver.key(parse_expression(conn, spelling)): column
+                for column, spellings in spec.dimensions.items() for spelling in spellings
+            }
+            measures = {resolver.key(parse_expression(conn, expression)): prefix
+                        for prefix, expression in spec.measures.items()}
+            signature = _source_signature(from_table, resolver)
+            compiled.setdefault(signature, []).append(
+                _CompiledRollup(spec, set(aliases.values()), signature, dimensions, measures)
+            )
+        
+        with self._lock:
+            self._compiled = compiled
+    
+    def route(self, conn: duckdb.DuckDBPyConnection, query: str, data_version: str,
+              table_columns: Dict[str, Set[str]]) -> Optional[Tuple[str, str]]:
+        """
+        Rewrite a query to read from a rollup when the answer is provably the same
+        
+        Returns:
+            Tuple of (rollup name, rewritten SQL) or None if no rollup matches
+        """
+        if not self._compiled:
+            return None
+        
+        try:
+            matched = self._matching(conn, query, table_columns)
+            if matched is None:
+                return None
+            statement, resolver, compiled_rollups = matched
+            candidates = [compiled for compiled in compiled_rollups
+                          if self.versions.get(compiled.spec.name) == data_version]
+            if not candidates:
+                return None
+            original = conn.sql(query)
+        except UnsupportedQuery as e:
+            logger.debug(f"Query not routed to a rollup: {e}")
+            return None
+        except (duckdb.Error, KeyError, TypeError) as e:
+            logger.debug(f"Rollup routing skipped: {e}")
+            return None
+        
+        for compiled in candidates:
+            try:
+                rewritten_sql = self._rewrite(conn, compiled, resolver, statement, original)
+            except UnsupportedQuery as e:
+                logger.debug(f"Query not routed to rollup {compiled.spec.name}: {e}")
+                continue
+            except (duckdb.Error, KeyError, TypeError) as e:
+                logger.debug(f"Rollup {compiled.spec.name} rewrite failed: {e}")
+                continue
+            
+            with self._lock:
+                self.routed[compiled.spec.name] += 1
+            return compiled.spec.name, rewritten_sql
+        return None
+    
+    def _matching(self, conn: duckdb.DuckDBPyConnection, query: str, table_columns: Dict[str, Set[str]]
+                  ) -> Optional[Tuple[Dict[str, Any], _Resolver, List[_CompiledRollup]]]:
+        """Parse a SELECT and find the rollups over its FROM clause, or None for other statements"""
+        statement = parse_statement(conn, query)
+        node = statement['node']
+        if node.get('type') != 'SELECT_NODE' or not node.get('from_table'):
+            return None
+        aliases: Dict[str, str] = {}
+        _collect_aliases(node['from_table'], aliases)
+        resolver = _Resolver(aliases, table_columns)
+        return statement, resolver, self._compiled.get(_source_signature(node['from_table'], resolver), [])
+    
+    def _rewrite(self, conn: duckdb.DuckDBPyConnection, compiled: _CompiledRollup, resolver: _Resolver,
+                 statement: Dict[str, Any], original: duckdb.DuckDBPyRelation) -> str:
+        """Rewrite a copy of the parsed query onto one rollup and check its result shape"""
+        statement = copy_tree(statement)
+        rewriter = _Rewriter(self, conn, compiled, resolver, [name.lower() for name in original.columns])
+        rewriter.rewrite_select(statement['node'], original.columns)
+        rewritten_sql = deparse_statement(conn, statement)
+        
+        rewritten = conn.sql(rewritten_sql)
+        if rewritten.columns != original.columns or \
+                [str(t) for t in rewritten.types] != [str(t) for t in original.types]:
+            raise _NotRoutable("Rewritten query changes the result shape")
+        return rewritten_sql
+    
+    def _all_compiled(self) -> List[_CompiledRollup]:
+        return [compiled for group in self._compiled.values() for compiled in group]
+    
+    def template(self, conn: duckdb.DuckDBPyConnection, sql: str) -> Dict[str, Any]:
+        """Parse a replacement expression, caching the parsed form"""
+        with self._lock:
+            cached = self._templates.get(sql)
+        if cached is None:
+            cached = parse_expression(conn, sql)
+            with self._lock:
+                self._templates[sql] = cached
+        return copy_tree(cached)
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get build version, size and routed query count for each rollup"""
+        with self._lock:
+            return {
+                compiled.spec.name: {
+                    'data_version': self.versions.get(compiled.spec.name),
+                    'row_count': self.row_counts.get(compiled.spec.name),
+                    'routed_queries': self.routed[compiled.spec.name],
+                }
+                for compiled in self._all_compiled()
+            }
+
+
+class _Rewriter:
+    """Rewrites a parsed SELECT over a rollup's source into one over the rollup"""
+    
+    def __init__(self, manager: RollupManager, conn: duckdb.DuckDBPyConnection, compiled: _CompiledRollup,
+                 resolver: _Resolver, output_names: List[str]):
+        self.manager = manager
+        self.conn = conn
+        self.compiled = compiled
+        self.resolver = resolver
+        self.output_names = output_names
+    
+    def rewrite_select(self, node: Dict[str, Any], output_columns: List[str]):
+        if node['cte_map']['map'] or node.get('sample') or node.get('qualify'):
+            raise _NotRoutable("CTEs, sampling and QUALIFY are not routed")
+        
+        # GROUP BY ALL keeps its meaning, since non-aggregate outputs are rewritten to dimensions
+        group_all = node.get('aggregate_handling') == 'FORCE_AGGREGATES'
+        if node.get('aggregate_handling') not in ('STANDARD_HANDLING', 'FORCE_AGGREGATES'):
+            raise _NotRoutable(f"{node.get('aggregate_handling')} is not routed")
+        
+        groups = node['group_expressions']
+        if node['group_sets'] != ([list(range(len(groups)))] if groups else []):
+            raise _NotRoutable("Grouping sets are not routed")
+        if not groups and not group_all and not any(has_aggregate(item) for item in node['select_list']):
+            raise _NotRoutable("Only aggregate queries are routed")
+        
+        # Every output keeps the name it had over the base tables
+        node['select_list'] = [
+            self._set_alias(self.expression(item, aggregates=True), name)
+            for item, name in zip(node['select_list'], output_columns)
+        ]
+        if node.get('where_clause'):
+            node['where_clause'] = self.expression(node['where_clause'], aggregates=False)
+        node['group_expressions'] = [self._group_expression(item) for item in groups]
+        if node.get('having'):
+            node['having'] = self.expression(node['having'], aggregates=True)
+        
+        for modifier in node['modifiers']:
+            if modifier['type'] == 'ORDER_MODIFIER':
+                for order in modifier['orders']:
+                    # A bare output name orders by the select list, which keeps its names
+                    if not self._is_output_reference(order['expression']):
+                        order['expression'] = self.expression(order['expression'], aggregates=True)
+            elif modifier['type'] == 'LIMIT_MODIFIER':
+                for key in ('limit', 'offset'):
+                    if modifier.get(key) and modifier[key].get('class') != 'CONSTANT':
+                        raise _NotRoutable("Only constant limits are routed")
+            elif modifier['type'] != 'DISTINCT_MODIFIER' or modifier['distinct_on_targets']:
+                raise _NotRoutable(f"{modifier['type']} is not routed")
+        
+        node['from_table'] = parse_from(self.conn, f"{ROLLUP_SCHEMA}.{self.compiled.spec.name}")
+    
+    def expression(self, node: Dict[str, Any], aggregates: bool) -> Dict[str, Any]:
+        """Replace dimension and aggregate subexpressions with rollup columns"""
+        node_class = node.get('class')
+        if node_class in _UNROUTABLE_CLASSES:
+            raise _NotRoutable(f"{node_class} expressions are not routed")
+        
+        key = self._key(node)
+        if key in self.compiled.dimensions:
+            return self._set_alias(self.manager.template(self.conn, self.compiled.dimensions[key]), node['alias'])
+        if node_class == 'FUNCTION' and node['function_name'].lower() in AGGREGATES:
+            if not aggregates:
+                raise _NotRoutable("Aggregate outside of SELECT, HAVING or ORDER BY")
+            return self._set_alias(self._aggregate(node), node['alias'])
+        if node_class == 'COLUMN_REF':
+            raise _NotRoutable(f"Column {'.'.join(node['column_names'])} is not a rollup dimension")
+        return {key: self._walk(child, aggregates) for key, child in node.items()}
+    
+    def _walk(self, value: Any, aggregates: bool) -> Any:
+        if isinstance(value, dict):
+            if 'class' in value:
+                return self.expression(value, aggregates)
+            return {key: self._walk(child, aggregates) for key, child in value.items()}
+        if isinstance(value, list):
+            return [self._walk(child, aggregates) for child in value]
+        return value
+    
+    def _aggregate(self, node: Dict[str, Any]) -> Dict[str, Any]:
+        """Recompute an aggregate from the rollup's partial aggregates"""
+        name = node['function_name'].lower()
+        children = node['children']
+        if node.get('distinct') or node.get('filter') or node['order_bys']['orders'] or len(children) > 1:
+            raise _NotRoutable("DISTINCT, FILTER and ordered aggregates are not routed")
+        if name == 'count_star' or not children:
+            return self.manager.template(self.conn, "CAST(COALESCE(SUM(row_count), 0) AS BIGINT)")
+        
+        if name == 'count' and children[0].get('class') == 'CONSTANT' and not children[0]['value']['is_null']:
+            return self.manager.template(self.conn, "CAST(COALESCE(SUM(row_count), 0) AS BIGINT)")
+        
+        key = self._key(children[0])
+        if key in self.compiled.measures:
+            prefix = self.compiled.measures[key]
+            replacements = {
+                'sum': f"SUM({prefix}_sum)",
+                'count': f"CAST(COALESCE(SUM({prefix}_count), 0) AS BIGINT)",
+                'avg': f"SUM({prefix}_sum) / NULLIF(SUM({prefix}_count), 0)",
+                'min': f"MIN({prefix}_min)",
+                'max': f"MAX({prefix}_max)",
+            }
+            return self.manager.template(self.conn, replacements[name])
+        
+        # Aggregates of expressions over dimensions are weighted by each group's row count
+        value = self.expression(children[0], aggregates=False)
+        weighted = {
+            'sum': "SUM(__value__ * row_count)",
+            'count': "CAST(COALESCE(SUM(CASE WHEN __value__ IS NOT NULL THEN row_count ELSE 0 END), 0) AS BIGINT)",
+            'avg': "SUM(__value__ * row_count) / NULLIF(SUM(CASE WHEN __value__ IS NOT NULL THEN row_count ELSE 0 END), 0)",
+            'min': "MIN(__value__)",
+            'max': "MAX(__value__)",
+        }
+        return fill_placeholder(self.manager.template(self.conn, weighted[name]), value)
+    
+    def _group_expression(self, node: Dict[str, Any]) -> Dict[str, Any]:
+        # Positions and output aliases refer to the select list, which keeps its names
+        if node.get('class') == 'CONSTANT':
+            return node
+        if node.get('class') == 'COLUMN_REF' and self._key(node) is None and self._is_output_reference(node):
+            return node
+        return self.expression(node, aggregates=False)
+    
+    def _is_output_reference(self, node: Dict[str, Any]) -> bool:
+        return node.get('class') == 'COLUMN_REF' and len(node['column_names']) == 1 \
+            and node['column_names'][0].lower() in self.output_names
+    
+    def _key(self, node: Dict[str, Any]) -> Optional[str]:
+        try:
+            return self.resolver.key(node)
+        except _NotRoutable:
+            return None
+    
+    @staticmethod
+    def _set_alias(node: Dict[str, Any], alias: str) -> Dict[str, Any]:
+        node['alias'] = alias
+        return node
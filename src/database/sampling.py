@@ -0,0 +1,379 @@
+"""
+Table Samples
+Bernoulli samples of large tables, and rewriting of aggregate queries into estimates with confidence intervals
+"""
+
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from statistics import NormalDist
+from typing import Dict, Any, Callable, List, Optional, Tuple
+import duckdb
+from src.database.sql_ast import (
+    AGGREGATES, UnsupportedQuery, parse_statement, parse_expression, deparse_statement,
+    copy_tree, fill_placeholder, has_aggregate,
+)
+from src.database.table_delta import TableDelta
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Samples live outside the main schema so they never appear in the LLM's schema description
+SAMPLE_SCHEMA = "samples"
+VERSIONS_TABLE = f"{SAMPLE_SCHEMA}.sample_versions"
+SAMPLE_SEED = 42
+
+_ESTIMABLE = {'sum', 'count', 'count_star', 'avg'}
+_UNSUPPORTED_CLASSES = {'SUBQUERY', 'WINDOW'}
+
+
+@dataclass
+class TableSample:
+    """A maintained sample of one table"""
+    table: str
+    source_rows: int
+    sample_rows: int
+    
+    @property
+    def fraction(self) -> float:
+        """Realized share of the table's rows in the sample"""
+        return self.sample_rows / self.source_rows if self.source_rows else 1.0
+
+
+@dataclass
+class ApproximateQuery:
+    """A query rewritten to read a sample"""
+    sql: str
+    table: str
+    fraction: float
+    confidence: float
+    intervals: Dict[str, Tuple[str, str]] = field(default_factory=dict)  # Output column -> (low, high) columns
+
+
+class SampleManager:
+    """
+    Maintains Bernoulli samples of large tables and answers aggregates from them
+    
+    Each table row is kept with the same probability, so totals are
+    scaled up by the inverse of the sampled fraction (the Horvitz-Thompson
+    estimator) and averages are read off the sample directly. Only the
+    largest table in a query is sampled; joined tables are read in full,
+    so many-to-one joins keep every sampled row's partners.
+    """
+    
+    def __init__(self, sample_rate: float, min_table_rows: int, confidence: float):
+        self.sample_rate = sample_rate
+        self.min_table_rows = min_table_rows
+        self.confidence = confidence
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.versions: Dict[str, str] = {}  # Table -> data version its sample was drawn from
+        self.samples: Dict[str, TableSample] = {}
+        self.rewritten: Counter = Counter()
+        self._lock = threading.Lock()
+    
+    def refresh(self, conn: duckdb.DuckDBPyConnection, data_version: str,
+                row_counts: Dict[str, int], read_only: bool = False,
+                previous_version: Optional[str] = None, deltas: Optional[List[TableDelta]] = None) -> Dict[str, int]:
+        """
+        Draw a new sample of every large table not sampled from the current data version
+        
+        Given the deltas that led from previous_version, samples that were
+        current are extended instead of redrawn: rows removed from a table
+        leave its sample, and appended rows enter it with the same
+        probability, so every row is still kept independently at the
+        sample rate.
+        
+        Args:
+            conn: Database cursor
+            data_version: Current data version
+            row_counts: Row count of every table
+            read_only: Only reuse persisted samples
+            previous_version: Data version the deltas were applied to
+            deltas: Rows an incremental load changed
+        
+        Returns:
+            Dictionary of resampled tables and their sample sizes
+        """
+        stored = self._stored_versions(conn)
+        changed = {delta.table: delta for delta in deltas or []}
+        samples, versions, resampled, extended = {}, {}, {}, {}
+        
+        for table, row_count in row_counts.items():
+            if row_count < self.min_table_rows:
+                continue
+            version, rate, source_rows, sample_rows = stored.get(table, (None, None, 0, 0))
+            if (version, rate) != (data_version, self.sample_rate):
+                if read_only:
+                    continue
+                if deltas is not None and (version, rate) == (previous_version, self.sample_rate):
+                    if table in changed:
+                        sample_rows = self._apply_delta(conn, changed[table], sample_rows)
+                        extended[table] = sample_rows
+                    source_rows = row_count
+                    conn.execute(
+                        f"UPDATE {VERSIONS_TABLE} SET data_version = ?, source_rows = ?, sample_rows = ? "
+                        f"WHERE table_name = ?",
+                        [data_version, source_rows, sample_rows, table]
+                    )
+                else:
+                    source_rows = row_count
+                    sample_rows = conn.execute(
+                        f"CREATE OR REPLACE TABLE {SAMPLE_SCHEMA}.{table} AS SELECT * FROM {table} "
+                        f"USING SAMPLE {self.sample_rate * 100:g} PERCENT (bernoulli, {SAMPLE_SEED})"
+                    ).fetchone()[0]
+                    conn.execute(f"INSERT OR REPLACE INTO {VERSIONS_TABLE} VALUES (?, ?, ?, ?, ?, now())",
+                                 [table, data_version, self.sample_rate, source_rows, sample_rows])
+                    resampled[table] = sample_rows
+            if sample_rows:
+                samples[table] = TableSample(table, source_rows, sample_rows)
+                versions[table] = data_version
+        
+        with self._lock:
+            self.samples, self.versions = samples, versions
+        if resampled:
+            logger.info(f"Table samples drawn for data version {data_version}: {resampled}")
+        if extended:
+            logger.info(f"Table samples extended for data version {data_version}: {extended}")
+        return resampled
+    
+    def _apply_delta(self, conn: duckdb.DuckDBPyConnection, delta: TableDelta, sample_rows: int) -> int:
+        """Drop a table's removed rows from its sample and sample its added rows into it, returning the new sample size"""
+        sample = f"{SAMPLE_SCHEMA}.{delta.table}"
+        if not delta.append_only:
+            key_match = " AND ".join(f"removed.{column} = {sample}.{column}" for column in delta.key)
+            with delta.rows_sql(conn, removed=True) as removed_sql:
+                sample_rows -= conn.execute(
+                    f"DELETE FROM {sample} WHERE EXISTS (SELECT 1 FROM ({removed_sql}) removed WHERE {key_match})"
+                ).fetchone()[0]
+        # No fixed seed: repeating it would keep the rows at the same positions of every delta
+        with delta.rows_sql(conn) as added_sql:
+            sample_rows += conn.execute(
+                f"INSERT INTO {sample} BY NAME SELECT * FROM ({added_sql}) "
+                f"USING SAMPLE {self.sample_rate * 100:g} PERCENT (bernoulli)"
+            ).fetchone()[0]
+        return sample_rows
+    
+    def _stored_versions(self, conn: duckdb.DuckDBPyConnection) -> Dict[str, Tuple[str, float, int, int]]:
+        """Read which data version and rate each persisted sample was drawn with"""
+        exists = conn.execute(
+            "SELECT COUNT(*) FROM duckdb_tables() WHERE schema_name = ? AND table_name = 'sample_versions'",
+            [SAMPLE_SCHEMA]
+        ).fetchone()[0]
+        if not exists:
+            try:
+                conn.execute(f"CREATE SCHEMA IF NOT EXISTS {SAMPLE_SCHEMA}")
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (
+                        table_name VARCHAR PRIMARY KEY,
+                        data_version VARCHAR,
+                        sample_rate DOUBLE,
+                        source_rows BIGINT,
+                        sample_rows BIGINT,
+                        built_at TIMESTAMP
+                    )
+                """)
+            except duckdb.Error:
+                pass  # Read-only database without samples
+            return {}
+        rows = conn.execute(
+            f"SELECT table_name, data_version, sample_rate, source_rows, sample_rows FROM {VERSIONS_TABLE}"
+        ).fetchall()
+        return {table: (version, rate, source_rows, sample_rows)
+                for table, version, rate, source_rows, sample_rows in rows}
+    
+    def rewrite(self, conn: duckdb.DuckDBPyConnection, query: str, data_version: str) -> Optional[ApproximateQuery]:
+        """
+        Rewrite an aggregate query to estimate its answer from a sample
+        
+        Returns:
+            ApproximateQuery, or None if the query cannot be estimated from a sample
+        """
+        if not self.samples:
+            return None
+        
+        try:
+            statement = parse_statement(conn, query)
+            original = conn.sql(query)
+            approximate = _Estimator(self, conn, data_version).rewrite(statement, original.columns)
+        except UnsupportedQuery as e:
+            logger.debug(f"Query not estimated from a sample: {e}")
+            return None
+        except (duckdb.Error, KeyError, TypeError) as e:
+            logger.debug(f"Sample rewrite skipped: {e}")
+            return None
+        
+        with self._lock:
+            self.rewritten[approximate.table] += 1
+        return approximate
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get size, sampled fraction and estimated query count for each sample"""
+        with self._lock:
+            return {
+                table: {
+                    'data_version': self.versions.get(table),
+                    'source_rows': sample.source_rows,
+                    'sample_rows': sample.sample_rows,
+                    'fraction': round(sample.fraction, 6),
+                    'approximate_queries': self.rewritten[table],
+                }
+                for table, sample in self.samples.items()
+            }
+
+
+class _Estimator:
+    """Rewrites a parsed aggregate SELECT to read one table's sample"""
+    
+    def __init__(self, manager: SampleManager, conn: duckdb.DuckDBPyConnection, data_version: str):
+        self.manager = manager
+        self.conn = conn
+        self.data_version = data_version
+        self.fraction = 1.0
+    
+    def rewrite(self, statement: Dict[str, Any], output_columns: List[str]) -> ApproximateQuery:
+        node = statement['node']
+        if node.get('type') != 'SELECT_NODE' or not node.get('from_table'):
+            raise UnsupportedQuery("Only single SELECT statements are estimated")
+        if node['cte_map']['map'] or node.get('sample') or node.get('qualify'):
+            raise UnsupportedQuery("CTEs, sampling and QUALIFY are not estimated")
+        if not node['group_expressions'] and node.get('aggregate_handling') != 'FORCE_AGGREGATES' \
+                and not any(has_aggregate(item) for item in node['select_list']):
+            raise UnsupportedQuery("Only aggregate queries are estimated")
+        self._check_supported(node)
+        
+        tables: List[Dict[str, Any]] = []
+        self._collect_tables(node['from_table'], tables)
+        sampled = self._choose_sample(tables)
+        self.fraction = sampled.fraction
+        
+        # Confidence intervals for outputs that are a single aggregate, appended after the original columns
+        intervals, bounds = {}, []
+        for item, name in zip(node['select_list'], output_columns):
+            interval = self._interval(item)
+            if interval:
+                low, high = interval
+                intervals[name] = (f"{name}_ci_low", f"{name}_ci_high")
+                bounds += [self._set_alias(low, f"{name}_ci_low"), self._set_alias(high, f"{name}_ci_high")]
+        
+        node['select_list'] = [
+            self._set_alias(self._scale(item), name)
+            for item, name in zip(node['select_list'], output_columns)
+        ] + bounds
+        if node.get('having'):
+            node['having'] = self._scale(node['having'])
+        for modifier in node['modifiers']:
+            if modifier['type'] == 'ORDER_MODIFIER':
+                for order in modifier['orders']:
+                    order['expression'] = self._scale(order['expression'])
+        
+        for table in tables:
+            if table['table_name'].lower() == sampled.table:
+                table['alias'] = table['alias'] or table['table_name']
+                table['schema_name'] = SAMPLE_SCHEMA
+                table['catalog_name'] = ''
+        
+        sql = deparse_statement(self.conn, statement)
+        self.conn.sql(sql)  # Bind the rewrite so a broken one falls back to the exact query
+        return ApproximateQuery(sql, sampled.table, self.fraction, self.manager.confidence, intervals)
+    
+    def _check_supported(self, node: Any):
+        """Reject subqueries, windows and aggregates that a sample cannot estimate"""
+        if isinstance(node, dict):
+            node_class = node.get('class')
+            if node_class in _UNSUPPORTED_CLASSES:
+                raise UnsupportedQuery(f"{node_class} expressions are not estimated")
+            if node_class == 'FUNCTION' and node['function_name'].lower() in AGGREGATES:
+                if node['function_name'].lower() not in _ESTIMABLE:
+                    raise UnsupportedQuery(f"{node['function_name']} cannot be estimated from a sample")
+                if node.get('distinct') or node.get('filter') or node['order_bys']['orders'] or len(node['children']) > 1:
+                    raise UnsupportedQuery("DISTINCT, FILTER and ordered aggregates are not estimated")
+            for value in node.values():
+                self._check_supported(value)
+        elif isinstance(node, list):
+            for value in node:
+                self._check_supported(value)
+    
+    def _collect_tables(self, node: Dict[str, Any], tables: List[Dict[str, Any]]):
+        if node['type'] == 'BASE_TABLE':
+            if node.get('sample') or node.get('at_clause') or node.get('schema_name') not in ('', 'main'):
+                raise UnsupportedQuery("Only plain base tables are sampled")
+            tables.append(node)
+        elif node['type'] == 'JOIN':
+            self._collect_tables(node['left'], tables)
+            self._collect_tables(node['right'], tables)
+        else:
+            raise UnsupportedQuery(f"{node['type']} sources are not estimated")
+    
+    def _choose_sample(self, tables: List[Dict[str, Any]]) -> TableSample:
+        """Pick the largest sampled table, which dominates the query's cost"""
+        names = [table['table_name'].lower() for table in tables]
+        candidates = [
+            self.manager.samples[name] for name in set(names)
+            if name in self.manager.samples and self.manager.versions.get(name) == self.data_version
+        ]
+        if not candidates:
+            raise UnsupportedQuery("No current sample of the queried tables")
+        sampled = max(candidates, key=lambda sample: sample.source_rows)
+        if names.count(sampled.table) > 1:
+            raise UnsupportedQuery("Tables joined to themselves are not sampled")
+        return sampled
+    
+    def _scale(self, node: Any) -> Any:
+        """Scale every total in an expression up to the full table"""
+        if isinstance(node, dict):
+            if node.get('class') == 'FUNCTION' and node['function_name'].lower() in AGGREGATES:
+                return self._estimate(node)
+            return {key: self._scale(child) for key, child in node.items()}
+        if isinstance(node, list):
+            return [self._scale(child) for child in node]
+        return node
+    
+    def _estimate(self, aggregate: Dict[str, Any]) -> Dict[str, Any]:
+        name = aggregate['function_name'].lower()
+        if name == 'avg':
+            return aggregate
+        template = "CAST(ROUND(__value__ / {f}) AS BIGINT)" if name.startswith('count') else "__value__ / {f}"
+        alias, aggregate = aggregate['alias'], self._set_alias(copy_tree(aggregate), '')
+        return self._set_alias(fill_placeholder(self._template(template), aggregate), alias)
+    
+    def _interval(self, item: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """Lower and upper confidence bounds of an output that is one aggregate, possibly rounded"""
+        wrap: Callable[[Dict[str, Any]], Dict[str, Any]] = lambda bound: bound
+        aggregate = item
+        if item.get('class') == 'FUNCTION' and item['function_name'].lower() == 'round' and item['children'] \
+                and all(child.get('class') == 'CONSTANT' for child in item['children'][1:]):
+            aggregate = item['children'][0]
+            
+            def wrap(bound: Dict[str, Any]) -> Dict[str, Any]:
+                rounded = copy_tree(item)
+                rounded['children'][0] = bound
+                return rounded
+        
+        if aggregate.get('class') != 'FUNCTION' or aggregate['function_name'].lower() not in _ESTIMABLE:
+            return None
+        
+        # Standard errors under Bernoulli sampling, with the finite population correction
+        name = aggregate['function_name'].lower()
+        if name == 'count_star' or not aggregate['children']:
+            estimate, error, value = "COUNT(*) / {f}", "sqrt(COUNT(*) * (1 - {f})) / {f}", None
+        else:
+            value = aggregate['children'][0]
+            estimate, error = {
+                'count': ("COUNT(__value__) / {f}", "sqrt(COUNT(__value__) * (1 - {f})) / {f}"),
+                'sum': ("SUM(__value__) / {f}", "sqrt((1 - {f}) * SUM(__value__ * __value__)) / {f}"),
+                'avg': ("AVG(__value__)", "sqrt(1 - {f}) * stddev_samp(__value__) / sqrt(COUNT(__value__))"),
+            }[name]
+        
+        bounds = []
+        for sign in ('-', '+'):
+            bound = self._template(f"{estimate} {sign} {self.manager.z!r} * {error}")
+            bounds.append(wrap(fill_placeholder(bound, value) if value is not None else bound))
+        return bounds[0], bounds[1]
+    
+    def _template(self, sql: str) -> Dict[str, Any]:
+        return parse_expression(self.conn, sql.replace("{f}", repr(self.fraction)))
+    
+    @staticmethod
+    def _set_alias(node: Dict[str, Any], alias: str) -> Dict[str, Any]:
+        node['alias'] = alias
+        return node
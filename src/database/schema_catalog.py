@@ -0,0 +1,137 @@
+"""
+Schema Catalog
+Collects table metadata in a single pass and persists it beside the database file
+"""
+
+import json
+from datetime import datetime
+from decimal import Decimal
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple
+import duckdb
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+SAMPLE_ROWS = 3
+
+
+def json_value(value: Any) -> Any:
+    """Keep JSON-native sample values and render everything else as text"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+class SchemaCatalog:
+    """Column metadata, row counts and sample rows for every table, tied to a data version"""
+    
+    def __init__(self, catalog_path: Optional[Path]):
+        self.catalog_path = catalog_path
+    
+    @staticmethod
+    def table_row_counts(conn: duckdb.DuckDBPyConnection) -> Dict[str, int]:
+        """
+        Count the rows of every table
+        
+        estimated_size in duckdb_tables() still includes deleted rows, so it
+        is not used. DuckDB answers a bare COUNT(*) from row group metadata,
+        and all tables are counted in one statement.
+        """
+        tables = [row[0] for row in conn.execute(
+            "SELECT table_name FROM duckdb_tables() WHERE schema_name = 'main'"
+        ).fetchall()]
+        if not tables:
+            return {}
+        counts = " UNION ALL ".join(f"SELECT ?, COUNT(*) FROM main.{table}" for table in tables)
+        return {table: row_count for table, row_count in conn.execute(counts, tables).fetchall()}
+    
+    def build(self, conn: duckdb.DuckDBPyConnection) -> Dict[str, Any]:
+        """
+        Build schema information for all tables
+        
+        Column metadata for every table comes from one information_schema
+        query and row counts from one COUNT(*) per table. Views are counted
+        on their own.
+        """
+        columns = conn.execute("""
+            SELECT table_name, column_name, data_type, is_nullable
+            FROM information_schema.columns
+            WHERE table_schema = 'main'
+            ORDER BY table_name, ordinal_position
+        """).fetchall()
+        row_counts = self.table_row_counts(conn)
+        
+        tables: Dict[str, Any] = {}
+        for table, column_name, data_type, is_nullable in columns:
+            info = tables.setdefault(table, {'columns': [], 'row_count': row_counts.get(table), 'sample_data': []})
+            info['columns'].append({
+                'column_name': column_name,
+                'data_type': data_type,
+                'is_nullable': is_nullable,
+            })
+        
+        for table, info in tables.items():
+            if info['row_count'] is None:
+                info['row_count'] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            # Samples only read the first vector of each table
+            sample = conn.execute(f"SELECT * FROM {table} LIMIT {SAMPLE_ROWS}")
+            column_names = [column[0] for column in sample.description]
+            info['sample_data'] = [
+                {name: json_value(value) for name, value in zip(column_names, row)}
+                for row in sample.fetchall()
+            ]
+        
+        return tables
+    
+    def load(self, conn: duckdb.DuckDBPyConnection) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        Load the persisted catalog if it still describes the database
+        
+        The catalog is only trusted when its tables and exact row counts
+        match the database.
+        
+        Returns:
+            Tuple of (data version, tables) or None if missing or stale
+        """
+        if not self.catalog_path or not self.catalog_path.exists():
+            return None
+        
+        try:
+            with open(self.catalog_path, 'r', encoding='utf-8') as f:
+                catalog = json.load(f)
+        except Exception as e:
+            logger.warning(f"Could not load schema catalog: {e}")
+            return None
+        
+        tables = catalog.get('tables', {})
+        row_counts = self.table_row_counts(conn)
+        views = {row[0] for row in conn.execute(
+            "SELECT view_name FROM duckdb_views() WHERE schema_name = 'main' AND NOT internal"
+        ).fetchall()}
+        if set(tables) != set(row_counts) | views or \
+                any(tables[table]['row_count'] != row_count for table, row_count in row_counts.items()):
+            logger.info("Schema catalog is stale, rebuilding")
+            return None
+        
+        return catalog['data_version'], tables
+    
+    def save(self, data_version: str, tables: Dict[str, Any]):
+        """Persist the catalog with its data version"""
+        if not self.catalog_path:
+            return
+        
+        try:
+            catalog = {
+                'data_version': data_version,
+                'built_at': datetime.now().isoformat(),
+                'tables': tables,
+            }
+            tmp_path = self.catalog_path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(catalog, f, indent=2, default=str)
+            tmp_path.replace(self.catalog_path)
+        except Exception as e:
+            logger.error(f"Error saving schema catalog: {e}")
@@ -0,0 +1,141 @@
+"""
+Snapshot Cache for Source CSV Files
+Tracks fingerprints of ingested CSVs and keeps a Parquet snapshot per table
+"""
+
+import hashlib
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class SnapshotCache:
+    """Fingerprinted Parquet snapshots of the tables loaded from CSV"""
+    
+    def __init__(self, snapshot_dir: Path):
+        self.snapshot_dir = Path(snapshot_dir)
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.snapshot_dir / MANIFEST_FILE
+        self._lock = threading.Lock()
+        self.manifest: Dict[str, Dict[str, Any]] = self._load_manifest()
+    
+    def fingerprint(self, csv_path: Path, previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Fingerprint a source file by path, size, mtime and content hash
+        
+        When path, size and mtime all match the previous fingerprint the
+        recorded hash is reused instead of re-reading the whole file.
+        """
+        stat = csv_path.stat()
+        fingerprint = {
+            'source_path': str(csv_path.resolve()),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+        }
+        
+        if previous and all(previous.get(key) == value for key, value in fingerprint.items()):
+            fingerprint['content_hash'] = previous['content_hash']
+        else:
+            fingerprint['content_hash'] = self._hash_file(csv_path)
+        
+        return fingerprint
+    
+    def lookup(self, table_name: str, csv_path: Path) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        """
+        Fingerprint a table's source file and find its matching snapshot
+        
+        Returns:
+            Tuple of (current fingerprint, manifest entry if still valid)
+        """
+        entry = self.manifest.get(table_name)
+        fingerprint = self.fingerprint(csv_path, entry)
+        
+        if entry and entry['source_path'] == fingerprint['source_path'] \
+                and entry['content_hash'] == fingerprint['content_hash']:
+            return fingerprint, entry
+        return fingerprint, None
+    
+    def snapshot_path(self, table_name: str) -> Path:
+        """Get the Parquet file holding a table's snapshot"""
+        return self.snapshot_dir / f"{table_name}.parquet"
+    
+    def record(self, table_name: str, fingerprint: Dict[str, Any], row_count: int,
+               delta_files: Optional[List[str]] = None):
+        """Record a freshly written snapshot in the manifest, with the delta files already applied to it"""
+        with self._lock:
+            self.manifest[table_name] = {
+                **fingerprint,
+                'snapshot_file': self.snapshot_path(table_name).name,
+                'row_count': row_count,
+                'created_at': datetime.now().isoformat(),
+            }
+            if delta_files:
+                self.manifest[table_name]['delta_files'] = list(delta_files)
+    
+    def touch(self, table_name: str, fingerprint: Dict[str, Any]):
+        """Refresh the size/mtime of an entry whose content is unchanged"""
+        with self._lock:
+            if table_name in self.manifest:
+                self.manifest[table_name].update(fingerprint)
+    
+    def record_delta(self, table_name: str, delta_paths: List[Path], row_count: int):
+        """
+        Record rows appended to a table after its snapshot was written
+        
+        The Parquet snapshot may predate these rows, so a table restored
+        from it or re-ingested from CSV re-applies the recorded delta files;
+        the natural-key dedup skips rows it already holds.
+        """
+        with self._lock:
+            entry = self.manifest.get(table_name)
+            if entry is None:
+                return
+            entry['row_count'] += row_count
+            delta_files = entry.setdefault('delta_files', [])
+            delta_files.extend(str(path.resolve()) for path in delta_paths if str(path.resolve()) not in delta_files)
+    
+    def invalidate(self, table_name: Optional[str] = None):
+        """Drop one manifest entry, or all of them"""
+        with self._lock:
+            if table_name is None:
+                self.manifest.clear()
+            else:
+                self.manifest.pop(table_name, None)
+    
+    def save(self):
+        """Persist the manifest to disk"""
+        with self._lock:
+            try:
+                tmp_path = self.manifest_path.with_suffix('.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.manifest, f, indent=2)
+                tmp_path.replace(self.manifest_path)
+            except Exception as e:
+                logger.error(f"Error saving snapshot manifest: {e}")
+    
+    def _load_manifest(self) -> Dict[str, Dict[str, Any]]:
+        """Load the manifest from disk"""
+        try:
+            if self.manifest_path.exists():
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.warning(f"Could not load snapshot manifest: {e}")
+        return {}
+    
+    @staticmethod
+    def _hash_file(path: Path) -> str:
+        """Hash a file's contents in fixed-size chunks"""
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
@@ -0,0 +1,71 @@
+"""
+SQL Syntax Trees
+Parsing queries into DuckDB's JSON syntax tree, rendering rewritten trees back to SQL and quoting literals
+"""
+
+import json
+from typing import Dict, Any
+import duckdb
+
+# Aggregates whose partial results can be combined or scaled
+AGGREGATES = {'sum', 'count', 'count_star', 'avg', 'min', 'max'}
+
+
+class UnsupportedQuery(Exception):
+    """Raised when a query's shape is outside what a rewrite can handle"""
+
+
+def sql_literal(value: Any) -> str:
+    """Quote a value, such as a file path, as a SQL string literal"""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def parse_statement(conn: duckdb.DuckDBPyConnection, sql: str) -> Dict[str, Any]:
+    """Parse one SQL statement into DuckDB's JSON syntax tree"""
+    parsed = json.loads(conn.execute("SELECT json_serialize_sql(?)", [sql]).fetchone()[0])
+    if parsed.get('error') or len(parsed.get('statements', [])) != 1:
+        raise UnsupportedQuery("Query is not a single parseable statement")
+    return parsed['statements'][0]
+
+
+def parse_expression(conn: duckdb.DuckDBPyConnection, sql: str) -> Dict[str, Any]:
+    """Parse a single expression"""
+    return parse_statement(conn, f"SELECT {sql}")['node']['select_list'][0]
+
+
+def parse_from(conn: duckdb.DuckDBPyConnection, source: str) -> Dict[str, Any]:
+    """Parse a FROM clause"""
+    return parse_statement(conn, f"SELECT 1 FROM {source}")['node']['from_table']
+
+
+def deparse_statement(conn: duckdb.DuckDBPyConnection, statement: Dict[str, Any]) -> str:
+    """Render a parsed statement back to SQL"""
+    envelope = {'error': False, 'statements': [statement]}
+    return conn.execute("SELECT json_deserialize_sql(?)", [json.dumps(envelope)]).fetchone()[0]
+
+
+def copy_tree(node: Any) -> Any:
+    """Deep copy of a parsed tree"""
+    return json.loads(json.dumps(node))
+
+
+def fill_placeholder(node: Any, value: Dict[str, Any]) -> Any:
+    """Substitute an expression for the __value__ placeholder of a template"""
+    if isinstance(node, dict):
+        if node.get('class') == 'COLUMN_REF' and node['column_names'] == ['__value__']:
+            return copy_tree(value)
+        return {key: fill_placeholder(child, value) for key, child in node.items()}
+    if isinstance(node, list):
+        return [fill_placeholder(child, value) for child in node]
+    return node
+
+
+def has_aggregate(node: Any) -> bool:
+    """Whether an expression contains one of AGGREGATES"""
+    if isinstance(node, dict):
+        if node.get('class') == 'FUNCTION' and node['function_name'].lower() in AGGREGATES:
+            return True
+        return any(has_aggregate(value) for value in node.values())
+    if isinstance(node, list):
+        return any(has_aggregate(value) for value in node)
+    return False
@@ -0,0 +1,219 @@
+"""
+Column Statistics
+Null fraction, range, approximate distinct count, top values and histograms, computed in one scan per table
+and merged with the rows of incremental loads
+"""
+
+import json
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, Iterable, List, Optional
+import duckdb
+from src.database.schema_catalog import json_value
+from src.database.table_delta import TableDelta
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+TOP_K = 5
+HISTOGRAM_BUCKETS = 10
+
+_NUMERIC_TYPES = ('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT', 'UTINYINT', 'USMALLINT',
+                  'UINTEGER', 'UBIGINT', 'FLOAT', 'DOUBLE', 'REAL', 'DECIMAL')
+_INTEGER_TYPES = _NUMERIC_TYPES[:9]
+_TEMPORAL_TYPES = ('DATE', 'TIMESTAMP', 'TIME')
+_TEXT_TYPES = ('VARCHAR', 'ENUM', 'BOOLEAN')
+
+
+def column_kind(data_type: str) -> str:
+    """Classify a DuckDB type as 'integer', 'numeric', 'temporal', 'text' or 'other'"""
+    data_type = data_type.upper()
+    if data_type.startswith(_INTEGER_TYPES):
+        return 'integer'
+    if data_type.startswith(_NUMERIC_TYPES):
+        return 'numeric'
+    if data_type.startswith(_TEMPORAL_TYPES):
+        return 'temporal'
+    if data_type.startswith(_TEXT_TYPES):
+        return 'text'
+    return 'other'
+
+
+class StatisticsCatalog:
+    """Column statistics for every table, persisted with the data version they describe"""
+    
+    def __init__(self, stats_path: Optional[Path]):
+        self.stats_path = stats_path
+    
+    def build(self, conn: duckdb.DuckDBPyConnection, schema_info: Dict[str, Any],
+              tables: Optional[Iterable[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        Compute statistics for tables in schema_info
+        
+        Args:
+            conn: Database cursor
+            schema_info: Schema information with each table's columns
+            tables: Tables to compute (defaults to all)
+        
+        Returns:
+            Dictionary of table -> column -> statistics
+        """
+        tables = list(tables) if tables is not None else list(schema_info)
+        return {
+            table: self.build_table(conn, table, schema_info[table]['columns'])
+            for table in tables if table in schema_info
+        }
+    
+    @staticmethod
+    def build_table(conn: duckdb.DuckDBPyConnection, table: str, columns: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Compute statistics for every column of a table in a single scan
+        
+        All aggregates go into one SELECT, so DuckDB reads each column once
+        and computes them in parallel over the table's row groups.
+        """
+        quantiles = ", ".join(str(step / HISTOGRAM_BUCKETS) for step in range(HISTOGRAM_BUCKETS + 1))
+        aggregates = ["COUNT(*)"]
+        plans = []
+        for col in columns:
+            name = '"' + col['column_name'].replace('"', '""') + '"'
+            kind = column_kind(col['data_type'])
+            stats = ['non_null', 'distinct_count']
+            aggregates += [f"COUNT({name})", f"approx_count_distinct({name})"]
+            if kind != 'other':
+                stats += ['min', 'max']
+                aggregates += [f"MIN({name})", f"MAX({name})"]
+            if kind in ('integer', 'text'):
+                stats.append('top_values')
+                aggregates.append(f"approx_top_k({name}, {TOP_K})")
+            if kind in ('integer', 'numeric', 'temporal'):
+                stats.append('histogram')
+                aggregates.append(f"quantile_disc({name}, [{quantiles}])")
+            plans.append((col, kind, stats))
+        
+        row = conn.execute(f"SELECT {', '.join(aggregates)} FROM {table}").fetchone()
+        row_count, values = row[0], iter(row[1:])
+        
+        statistics = {}
+        for col, kind, stats in plans:
+            computed = dict(zip(stats, values))
+            non_null = computed.pop('non_null')
+            column_stats = {
+                'data_type': col['data_type'],
+                'kind': kind,
+                'non_null': non_null,
+                'null_fraction': round(1 - non_null / row_count, 4) if row_count else 0.0,
+                'distinct_count': computed.pop('distinct_count'),
+            }
+            for stat, value in computed.items():
+                column_stats[stat] = [json_value(v) for v in value] if isinstance(value, list) else json_value(value)
+            statistics[col['column_name']] = column_stats
+        return statistics
+    
+    def merge(self, conn: duckdb.DuckDBPyConnection, schema_info: Dict[str, Any],
+              statistics: Dict[str, Dict[str, Any]], deltas: List[TableDelta]) -> Dict[str, Dict[str, Any]]:
+        """
+        Fold the rows of incremental loads into tables' statistics without scanning the tables
+        
+        Null fractions stay exact through the non-null counts. Ranges widen
+        to cover added rows but are not narrowed by removed ones, so they
+        remain bounds. The distinct-count sketches are not kept, so the
+        delta's distinct values are assumed new in the table's own ratio
+        of distinct to non-null values. Top values and histograms keep the
+        last full computation, which the next full load refreshes.
+        
+        Args:
+            conn: Database cursor
+            schema_info: Schema information with row counts that include the deltas
+            statistics: Current statistics of every table
+            deltas: Rows the loads added and removed
+        
+        Returns:
+            Dictionary of table -> column -> statistics for the changed tables
+        """
+        merged = {}
+        for delta in deltas:
+            if delta.table not in schema_info:
+                continue
+            columns = schema_info[delta.table]['columns']
+            current = statistics.get(delta.table)
+            if current is None or set(current) != {col['column_name'] for col in columns}:
+                merged[delta.table] = self.build_table(conn, delta.table, columns)
+                continue
+            
+            with delta.rows_sql(conn) as added_sql:
+                added = self.build_table(conn, f"({added_sql})", columns)
+            removed = {}
+            if not delta.append_only:
+                with delta.rows_sql(conn, removed=True) as removed_sql:
+                    removed = self.build_table(conn, f"({removed_sql})", columns)
+            
+            row_count = schema_info[delta.table]['row_count']
+            merged[delta.table] = {
+                column: self._merge_column(stats, added[column], removed.get(column), row_count - delta.row_change, row_count)
+                for column, stats in current.items()
+            }
+        return merged
+    
+    @staticmethod
+    def _merge_column(stats: Dict[str, Any], added: Dict[str, Any], removed: Optional[Dict[str, Any]],
+                      previous_rows: int, row_count: int) -> Dict[str, Any]:
+        """Combine a column's statistics with those of the rows added to and removed from its table"""
+        # Statistics persisted before non-null counts were kept derive them from the null fraction
+        previous_non_null = stats.get('non_null', round((1 - stats['null_fraction']) * previous_rows))
+        non_null = previous_non_null + added['non_null'] - (removed['non_null'] if removed else 0)
+        distinct_ratio = min(stats['distinct_count'] / previous_non_null, 1.0) if previous_non_null else 1.0
+        distinct_count = stats['distinct_count'] + round(added['distinct_count'] * distinct_ratio)
+        
+        merged = {
+            **stats,
+            'non_null': non_null,
+            'null_fraction': round(1 - non_null / row_count, 4) if row_count else 0.0,
+            'distinct_count': max(min(distinct_count, non_null), added['distinct_count']),
+        }
+        for bound, pick in (('min', min), ('max', max)):
+            if bound in stats:
+                values = [value for value in (stats[bound], added[bound]) if value is not None]
+                merged[bound] = pick(values) if values else None
+        if stats.get('histogram') and merged.get('min') is not None:
+            merged['histogram'] = [merged['min'], *stats['histogram'][1:-1], merged['max']]
+        if 'top_values' in stats and len(stats['top_values'] or []) < TOP_K:
+            top_values = list(stats['top_values'] or [])
+            top_values += [value for value in added['top_values'] or [] if value not in top_values]
+            merged['top_values'] = top_values[:TOP_K]
+        return merged
+    
+    def load(self, data_version: str) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Load persisted statistics if they were computed for this data version"""
+        if not self.stats_path or not self.stats_path.exists():
+            return None
+        
+        try:
+            with open(self.stats_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except Exception as e:
+            logger.warning(f"Could not load column statistics: {e}")
+            return None
+        
+        if stored.get('data_version') != data_version:
+            logger.info("Column statistics are stale, rebuilding")
+            return None
+        return stored['tables']
+    
+    def save(self, data_version: str, statistics: Dict[str, Dict[str, Any]]):
+        """Persist statistics with the data version they describe"""
+        if not self.stats_path:
+            return
+        
+        try:
+            stored = {
+                'data_version': data_version,
+                'built_at': datetime.now().isoformat(),
+                'tables': statistics,
+            }
+            tmp_path = self.stats_path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(stored, f, indent=2, default=str)
+            tmp_path.replace(self.stats_path)
+        except Exception as e:
+            logger.error(f"Error saving column statistics: {e}")
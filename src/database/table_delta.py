@@ -0,0 +1,63 @@
+"""
+Table Deltas
+Rows an incremental load added to or removed from a table, so derived tables are maintained without a rescan
+"""
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Optional, Tuple
+import duckdb
+import pyarrow as pa
+
+
+def fetch_arrow(result: duckdb.DuckDBPyConnection) -> pa.Table:
+    """Fetch a whole query result as an Arrow table across DuckDB versions"""
+    if hasattr(result, 'to_arrow_table'):
+        return result.to_arrow_table()
+    return result.fetch_arrow_table()
+
+
+@dataclass
+class TableDelta:
+    """
+    Rows one incremental load added to a table, and the rows it replaced
+    
+    Removed rows are identified by key: every row that matched a removed
+    row's key columns was deleted, and the added rows include their
+    replacements.
+    """
+    table: str
+    added: pa.Table
+    removed: Optional[pa.Table] = None
+    key: Tuple[str, ...] = ()  # Columns identifying replaced rows
+    
+    @property
+    def append_only(self) -> bool:
+        """True if the load only added rows"""
+        return self.removed is None or self.removed.num_rows == 0
+    
+    @property
+    def row_change(self) -> int:
+        """Net change in the table's row count"""
+        return self.added.num_rows - (self.removed.num_rows if self.removed is not None else 0)
+    
+    @contextmanager
+    def rows_sql(self, conn: duckdb.DuckDBPyConnection, removed: bool = False) -> Iterator[str]:
+        """
+        Expose the added (or removed) rows to SQL on a connection
+        
+        Arrow keeps ENUM columns as plain text, so the yielded SELECT casts
+        every column back to the table's type.
+        """
+        rows = self.removed if removed else self.added
+        name = f"__{self.table}_{'removed' if removed else 'added'}"
+        conn.register(name, rows)
+        try:
+            types = dict(conn.execute(
+                f"SELECT column_name, column_type FROM (DESCRIBE SELECT * FROM {self.table})"
+            ).fetchall())
+            columns = [f"CAST({column} AS {types[column]}) AS {column}" if column in types else column
+                       for column in rows.column_names]
+            yield f"SELECT {', '.join(columns)} FROM {name}"
+        finally:
+            conn.unregister(name)
@@ -0,0 +1,55 @@
+"""
+Zip Centroids
+Compact table with one location per zip code prefix, aggregated from the raw geolocation points
+"""
+
+import duckdb
+
+ZIP_CENTROIDS_TABLE = "zip_centroids"
+GEOLOCATION_TABLE = "geolocation"
+
+# Points outside Brazil's bounding box are data-entry errors in the export and are left out of the centroids
+BRAZIL_LAT_RANGE = (-34.0, 5.5)
+BRAZIL_LNG_RANGE = (-74.0, -34.5)
+
+ZIP_CENTROIDS_DESCRIPTION = (
+    "One row per zip code prefix with the mean latitude/longitude of its geolocation points, "
+    "their bounding box, the point count and the most common city and state. Join it on "
+    "customer_zip_code_prefix or seller_zip_code_prefix = zip_code_prefix for locations and "
+    "distances instead of joining the raw geolocation table, which repeats each prefix many times."
+)
+GEOLOCATION_NOTE = f"Raw points with many rows per zip code prefix; prefer {ZIP_CENTROIDS_TABLE} for joins."
+
+# Location joins, like the zip code joins of the source tables
+ZIP_CENTROIDS_JOINS = [
+    ('customers', 'customer_zip_code_prefix', ZIP_CENTROIDS_TABLE, 'zip_code_prefix'),
+    ('sellers', 'seller_zip_code_prefix', ZIP_CENTROIDS_TABLE, 'zip_code_prefix'),
+]
+
+
+def zip_centroids_sql() -> str:
+    """SELECT aggregating geolocation points into one row per zip code prefix"""
+    return f"""
+        SELECT
+            geolocation_zip_code_prefix AS zip_code_prefix,
+            AVG(geolocation_lat) AS lat,
+            AVG(geolocation_lng) AS lng,
+            MIN(geolocation_lat) AS min_lat,
+            MAX(geolocation_lat) AS max_lat,
+            MIN(geolocation_lng) AS min_lng,
+            MAX(geolocation_lng) AS max_lng,
+            COUNT(*) AS point_count,
+            mode(geolocation_city) AS city,
+            mode(geolocation_state) AS state
+        FROM {GEOLOCATION_TABLE}
+        WHERE geolocation_lat BETWEEN {BRAZIL_LAT_RANGE[0]} AND {BRAZIL_LAT_RANGE[1]}
+          AND geolocation_lng BETWEEN {BRAZIL_LNG_RANGE[0]} AND {BRAZIL_LNG_RANGE[1]}
+        GROUP BY geolocation_zip_code_prefix
+    """
+
+
+def build_zip_centroids(cursor: duckdb.DuckDBPyConnection) -> int:
+    """Rebuild the centroid table, ordered by prefix for point lookups, returning its row count"""
+    return cursor.execute(
+        f"CREATE OR REPLACE TABLE {ZIP_CENTROIDS_TABLE} AS {zip_centroids_sql()} ORDER BY zip_code_prefix"
+    ).fetchone()[0]
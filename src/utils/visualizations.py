@@ -32,7 +32,7 @@ class VisualizationGenerator:
         
         try:
             # Determine best visualization based on data shape and types
-            numeric_cols = df.select_dtypes(include=['float64', 'int64']).columns
+            numeric_cols = df.select_dtypes(include='number').columns
             categorical_cols = df.select_dtypes(include=['object', 'category']).columns
             
             # Bar chart for categorical + numeric
@@ -2,17 +2,116 @@
 Test suite for the E-Commerce Insights Agent
 """
 
+import asyncio
+import json
+import duckdb
+import re
 import pytest
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 from pathlib import Path
 import sys
+import threading
+import time
+import zlib
 
 # Add src to path
 sys.path.insert(0, str(Path(__file__).parent.parent))
+from src.config import config
 
-from src.database import DatabaseManager
+from src.database import DatabaseManager, QueryHandle
+from src.database.query_cache import QueryResultCache, normalize_sql
+from src.database.query_log import query_shape
+from src.database.olist_schema import TYPE_MAP_VERSION
+from src.database.partitions import PartitionStore
+from src.database.snapshot_cache import SnapshotCache
+from src.database.statistics import StatisticsCatalog
 from src.memory import MemoryManager
-from src.agents import AgentSystem, SQLAnalystAgent
+from src.agents import AgentSystem, AgentType, SQLAnalystAgent, TranslatorAgent
+from src.agents import llm_cache, semantic_cache
+from src.agents.llm_cache import LLMResponseCache
+from src.agents.semantic_cache import SemanticSQLCache
+from src.agents.schema_linker import SchemaLinker
+from src.agents.token_usage import TokenUsageTracker, usage_scope
+
+
+# Miniature Olist export used by the ingestion tests
+OLIST_SAMPLE_CSVS = {
+    'olist_customers_dataset.csv': """customer_id,customer_unique_id,customer_zip_code_prefix,customer_city,customer_state
+C1,U1,01001,sao paulo,SP
+C2,U2,20000,rio de janeiro,RJ
+C3,U3,01002,sao paulo,SP
+""",
+    'olist_geolocation_dataset.csv': """geolocation_zip_code_prefix,geolocation_lat,geolocation_lng,geolocation_city,geolocation_state
+01001,-23.55,-46.63,sao paulo,SP
+01001,-23.56,-46.64,sao paulo,SP
+20000,-22.90,-43.20,rio de janeiro,RJ
+""",
+    'olist_order_items_dataset.csv': """order_id,order_item_id,product_id,seller_id,shipping_limit_date,price,freight_value
+O1,1,P1,S1,2017-01-07 10:00:00,100.0,10.0
+O1,2,P2,S2,2017-01-07 10:00:00,50.0,5.0
+O2,1,P1,S1,2017-02-12 09:30:00,100.0,12.0
+O3,1,P3,S2,2017-02-22 18:00:00,30.0,3.0
+""",
+    'olist_order_payments_dataset.csv': """order_id,payment_sequential,payment_type,payment_installments,payment_value
+O1,1,credit_card,2,165.0
+O2,1,boleto,1,112.0
+O3,1,credit_card,1,33.0
+""",
+    'olist_order_reviews_dataset.csv': """review_id,order_id,review_score,review_comment_title,review_comment_message,review_creation_date,review_answer_timestamp
+R1,O1,5,,otimo,2017-01-11 00:00:00,2017-01-12 08:00:00
+R2,O2,3,,,2017-02-20 00:00:00,2017-02-21 10:00:00
+R3,O3,4,,bom,2017-03-01 00:00:00,2017-03-02 11:00:00
+""",
+    'olist_orders_dataset.csv': """order_id,customer_id,order_status,order_purchase_timestamp,order_approved_at,order_delivered_carrier_date,order_delivered_customer_date,order_estimated_delivery_date
+O1,C1,delivered,2017-01-05 10:00:00,2017-01-05 11:00:00,2017-01-06 09:00:00,2017-01-10 15:00:00,2017-01-15 00:00:00
+O2,C2,delivered,2017-02-10 09:00:00,2017-02-10 09:30:00,2017-02-11 08:00:00,2017-02-19 12:00:00,2017-02-15 00:00:00
+O3,C3,shipped,2017-02-20 17:00:00,2017-02-20 17:10:00,2017-02-21 08:00:00,,2017-03-05 00:00:00
+""",
+    'olist_products_dataset.csv': """product_id,product_category_name,product_name_lenght,product_description_lenght,product_photos_qty,product_weight_g,product_length_cm,product_height_cm,product_width_cm
+P1,beleza_saude,40,300,2,500,20,10,15
+P2,informatica_acessorios,35,250,1,800,30,5,20
+P3,,,,,,,,
+""",
+    'olist_sellers_dataset.csv': """seller_id,seller_zip_code_prefix,seller_city,seller_state
+S1,01001,sao paulo,SP
+S2,20000,rio de janeiro,RJ
+""",
+    'product_category_name_translation.csv': """product_category_name,product_category_name_english
+beleza_saude,health_beauty
+informatica_acessorios,computers_accessories
+""",
+}
+
+
+def write_olist_csvs(data_dir: Path) -> Path:
+    """Write the miniature Olist export into a directory"""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    for file_name, content in OLIST_SAMPLE_CSVS.items():
+        (data_dir / file_name).write_text(content, encoding='utf-8')
+    return data_dir
+
+
+@pytest.fixture(autouse=True)
+def isolated_data_dir(tmp_path, monkeypatch):
+    """Keep databases, sessions and LLM caches built from the default config out of data/"""
+    monkeypatch.setattr(config.database, 'database_path', tmp_path / "data" / "ecommerce.db")
+    monkeypatch.setattr(config.memory, 'storage_path', tmp_path / "data" / "memory")
+    monkeypatch.setattr(config.llm, 'response_cache_path', tmp_path / "data" / "llm_cache.sqlite")
+    monkeypatch.setattr(config.llm, 'semantic_cache_dir', tmp_path / "data" / "semantic_sql_cache")
+    monkeypatch.setattr(llm_cache, '_cache', None)
+    monkeypatch.setattr(semantic_cache, '_cache', None)
+    config.memory.storage_path.mkdir(parents=True)
+
+
+@pytest.fixture
+def olist_db(tmp_path):
+    """Database loaded with the miniature Olist export"""
+    db = DatabaseManager(db_path=tmp_path / "olist.db")
+    db.load_csv_data(write_olist_csvs(tmp_path / "csv"))
+    yield db
+    db.close()
 
 
 class TestDatabaseManager:
@@ -58,6 +157,1163 @@ class TestDatabaseManager:
         db.close()
 
 
+class TestDataLoading:
+    """Test CSV ingestion"""
+    
+    def test_load_csv_data_parallel(self, tmp_path):
+        """Test native parallel ingestion returns row counts and timings"""
+        db = DatabaseManager(db_path=tmp_path / "olist.db")
+        loaded = db.load_csv_data(write_olist_csvs(tmp_path / "csv"), parallel=True)
+        
+        assert loaded['orders'] == 3
+        assert loaded['order_items'] == 4
+        assert len(loaded) == 9
+        assert set(db.load_timings) == set(loaded)
+        assert db.schema_info['orders']['row_count'] == 3
+        db.close()
+    
+    def test_load_csv_data_column_types(self, olist_db):
+        """Test declared column types and date parsing are applied"""
+        columns = {col['column_name']: col['data_type'] for col in olist_db.schema_info['orders']['columns']}
+        assert columns['order_purchase_timestamp'] == 'TIMESTAMP'
+        
+        result, error = olist_db.execute_query(
+            "SELECT COUNT(*) AS n FROM orders WHERE order_delivered_customer_date IS NULL"
+        )
+        assert error is None
+        assert result['n'].iloc[0] == 1
+    
+    def test_reload_skips_unchanged_files(self, tmp_path):
+        """Test snapshots skip unchanged CSVs and re-ingest only changed ones"""
+        csv_dir = write_olist_csvs(tmp_path / "csv")
+        db = DatabaseManager(db_path=tmp_path / "olist.db")
+        db.load_csv_data(csv_dir)
+        assert set(db.load_sources.values()) == {'csv'}
+        
+        sellers_csv = csv_dir / 'olist_sellers_dataset.csv'
+        sellers_csv.write_text(sellers_csv.read_text() + "S3,30000,belo horizonte,MG\n")
+        loaded = db.load_csv_data(csv_dir)
+        
+        assert loaded['sellers'] == 3
+        assert db.load_sources['sellers'] == 'csv'
+        assert db.load_sources['orders'] == 'unchanged'
+        assert db.get_snapshot_manifest()['sellers']['row_count'] == 3
+        
+        db.load_csv_data(csv_dir, force_reload=True)
+        assert set(db.load_sources.values()) == {'csv'}
+        db.close()
+    
+    def test_restore_from_snapshot(self, tmp_path):
+        """Test a fresh database is restored from Parquet snapshots"""
+        csv_dir = write_olist_csvs(tmp_path / "csv")
+        snapshot_dir = tmp_path / "snapshots"
+        
+        first = DatabaseManager(db_path=tmp_path / "first.db")
+        first.snapshots = SnapshotCache(snapshot_dir)
+        first.load_csv_data(csv_dir)
+        first.close()
+        
+        second = DatabaseManager(db_path=tmp_path / "second.db")
+        second.snapshots = SnapshotCache(snapshot_dir)
+        loaded = second.load_csv_data(csv_dir)
+        
+        assert loaded['order_items'] == 4
+        assert set(second.load_sources.values()) == {'snapshot'}
+        second.close()
+    
+    def test_narrow_types_survive_snapshots(self, tmp_path):
+        """Test ENUM, DECIMAL and small integer types are kept through a snapshot restore"""
+        csv_dir = write_olist_csvs(tmp_path / "csv")
+        snapshot_dir = tmp_path / "snapshots"
+        
+        first = DatabaseManager(db_path=tmp_path / "first.db")
+        first.snapshots = SnapshotCache(snapshot_dir)
+        first.load_csv_data(csv_dir)
+        first.close()
+        
+        second = DatabaseManager(db_path=tmp_path / "second.db")
+        second.snapshots = SnapshotCache(snapshot_dir)
+        second.load_csv_data(csv_dir)
+        types = {row[0]: row[1] for row in second.conn.execute(
+            "SELECT column_name, data_type FROM information_schema.columns "
+            "WHERE table_name IN ('orders', 'order_items', 'customers')"
+        ).fetchall()}
+        assert second.load_sources['orders'] == 'snapshot'
+        assert types['order_status'].startswith('ENUM(')
+        assert types['customer_state'].startswith('ENUM(')
+        assert types['price'] == 'DECIMAL(10,2)'
+        assert types['order_item_id'] == 'SMALLINT'
+        
+        # Snapshots written under an older type map are not reused
+        second.snapshots.manifest['orders']['type_map_version'] = 1
+        second.load_csv_data(csv_dir)
+        assert second.load_sources['orders'] == 'csv'
+        assert second.get_snapshot_manifest()['orders']['type_map_version'] == TYPE_MAP_VERSION
+        second.close()
+    
+    def test_type_savings_report(self, tmp_path):
+        """Test typed tables are smaller than untyped ones and unknown ENUM values fall back to text"""
+        csv_dir = write_olist_csvs(tmp_path / "csv")
+        orders_csv = csv_dir / 'olist_orders_dataset.csv'
+        orders_csv.write_text(orders_csv.read_text() + "O4,C1,lost,2017-03-01 10:00:00,,,,2017-03-10 00:00:00\n")
+        db = DatabaseManager(db_path=tmp_path / "olist.db")
+        db.load_csv_data(csv_dir)
+        
+        columns = {col['column_name']: col['data_type'] for col in db.schema_info['orders']['columns']}
+        assert columns['order_status'] == 'VARCHAR'
+        assert db.schema_info['orders']['row_count'] == 4
+        
+        report = db.get_type_savings_report().set_index('table')
+        assert len(report) == 9
+        assert report.loc['order_items', 'saved_bytes'] > 0
+        assert report['saved_bytes'].sum() > 0
+        db.close()
+    
+    def test_ingest_incremental_deduplicates(self, olist_db, tmp_path):
+        """Test delta files append new rows and skip known natural keys"""
+        delta = tmp_path / "order_items_delta.csv"
+        delta.write_text(
+            "order_id,order_item_id,product_id,seller_id,shipping_limit_date,price,freight_value\n"
+            "O1,1,P1,S1,2017-01-07 10:00:00,100.0,10.0\n"
+            "O4,1,P2,S1,2017-03-01 10:00:00,75.0,7.5\n"
+            "O4,1,P2,S1,2017-03-01 10:00:00,75.0,7.5\n"
+            "O4,2,P1,S2,2017-03-01 10:00:00,20.0,2.0\n"
+        )
+        
+        inserted = olist_db.ingest_incremental('order_items', delta)
+        assert inserted == 2
+        assert olist_db.schema_info['order_items']['row_count'] == 6
+        assert olist_db.ingest_incremental('order_items', delta) == 0
+        
+        result, _ = olist_db.execute_query("SELECT COUNT(*) AS n FROM order_items")
+        assert result['n'].iloc[0] == 6
+        
+        with pytest.raises(ValueError):
+            olist_db.ingest_incremental('products', delta)
+    
+    def test_ingested_deltas_survive_reload(self, tmp_path):
+        """Test a table reloaded from its snapshot or CSV gets its delta rows and dedup index back"""
+        csv_dir = write_olist_csvs(tmp_path / "csv")
+        db = DatabaseManager(db_path=tmp_path / "olist.db")
+        db.snapshots = SnapshotCache(tmp_path / "snapshots")
+        db.load_csv_data(csv_dir)
+        delta = tmp_path / "order_items_delta.csv"
+        delta.write_text(
+            "order_id,order_item_id,product_id,seller_id,shipping_limit_date,price,freight_value\n"
+            "O4,1,P2,S1,2017-03-01 10:00:00,75.0,7.5\n"
+        )
+        assert db.ingest_incremental('order_items', delta) == 1
+        
+        db.conn.execute("DROP TABLE order_items")
+        db.load_csv_data(csv_dir)
+        assert db.load_sources['order_items'] == 'snapshot'
+        assert db.conn.execute("SELECT COUNT(*) FROM order_items WHERE order_id = 'O4'").fetchone()[0] == 1
+        assert db.conn.execute(
+            "SELECT COUNT(*) FROM duckdb_indexes() WHERE index_name = 'order_items_natural_key'"
+        ).fetchone()[0] == 1
+        
+        # Without the snapshot the table comes from CSV, still with the delta
+        db.conn.execute("DROP TABLE order_items")
+        db.snapshots.snapshot_path('order_items').unlink()
+        db.load_csv_data(csv_dir)
+        assert db.load_sources['order_items'] == 'csv'
+        assert db.conn.execute("SELECT COUNT(*) FROM order_items").fetchone()[0] == 5
+        assert db.get_snapshot_manifest()['order_items']['delta_files'] == [str(delta.resolve())]
+        
+        # The rewritten snapshot already holds the delta rows; restoring it does not repeat them
+        db.conn.execute("DROP TABLE order_items")
+        db.load_csv_data(csv_dir)
+        assert db.load_sources['order_items'] == 'snapshot'
+        assert db.conn.execute("SELECT COUNT(*) FROM order_items").fetchone()[0] == 5
+        db.close()
+
+
+class TestOrderFacts:
+    """Test the denormalized order_facts table"""
+    
+    def test_order_facts_built_at_load(self, olist_db):
+        """Test fact rows carry joined attributes and delivery metrics"""
+        facts, error = olist_db.execute_query("""
+            SELECT order_id, product_category_name_english, customer_state, seller_state,
+                   item_total, delivery_delay_days, is_late
+            FROM order_facts ORDER BY order_id, order_item_id
+        """)
+        assert error is None
+        assert len(facts) == 4
+        
+        first = facts.iloc[0]
+        assert first['product_category_name_english'] == 'health_beauty'
+        assert first['customer_state'] == 'SP' and first['seller_state'] == 'SP'
+        assert first['item_total'] == 110.0
+        assert first['delivery_delay_days'] == -5 and not first['is_late']
+        
+        late = facts[facts['order_id'] == 'O2'].iloc[0]
+        assert late['delivery_delay_days'] == 4 and late['is_late']
+        assert pd.isna(facts[facts['order_id'] == 'O3'].iloc[0]['is_late'])
+        
+        # Advertised ahead of the source tables
+        description = olist_db.get_schema_description()
+        assert description.index("## Table: order_facts") < description.index("## Table: orders")
+    
+    def test_order_facts_follow_incremental_ingest(self, olist_db, tmp_path):
+        """Test fact rows are rebuilt for orders touched by a delta"""
+        items_delta = tmp_path / "items_delta.csv"
+        items_delta.write_text(
+            OLIST_SAMPLE_CSVS['olist_order_items_dataset.csv'].splitlines()[0] + "\n"
+            "O4,1,P2,S1,2017-03-01 10:00:00,75.0,7.5\n"
+            "O4,2,P1,S2,2017-03-01 10:00:00,20.0,2.0\n"
+        )
+        orders_delta = tmp_path / "orders_delta.csv"
+        orders_delta.write_text(
+            OLIST_SAMPLE_CSVS['olist_orders_dataset.csv'].splitlines()[0] + "\n"
+            "O4,C2,delivered,2017-03-01 09:00:00,,,2017-03-20 10:00:00,2017-03-18 00:00:00\n"
+        )
+        
+        # Items arriving before their order only appear once the order does
+        olist_db.ingest_incremental('order_items', items_delta)
+        olist_db.ingest_incremental('orders', orders_delta)
+        
+        facts, _ = olist_db.execute_query("SELECT * FROM order_facts WHERE order_id = 'O4' ORDER BY order_item_id")
+        assert len(facts) == 2
+        assert facts['customer_state'].tolist() == ['RJ', 'RJ']
+        assert facts['is_late'].all()
+        assert olist_db.schema_info['order_facts']['row_count'] == 6
+    
+    def test_month_filters_skip_other_row_groups(self, olist_db):
+        """Test order_facts is clustered by purchase time, so a month filter reads few of its rows"""
+        olist_db.conn.execute("""
+            INSERT INTO orders (order_id, customer_id, order_status, order_purchase_timestamp)
+            SELECT 'X' || range, 'C1', 'delivered', TIMESTAMP '2016-01-01' + INTERVAL (range * 210) SECOND
+            FROM range(300000) ORDER BY hash(range)
+        """)
+        olist_db.conn.execute("""
+            INSERT INTO order_items (order_id, order_item_id, product_id, seller_id, price, freight_value)
+            SELECT 'X' || range, 1, 'P1', 'S1', 10.0, 1.0 FROM range(300000)
+        """)
+        olist_db._build_order_facts()
+        olist_db.refresh_schema()
+        
+        query = ("SELECT COUNT(DISTINCT customer_unique_id) AS customers, COUNT(*) AS items FROM order_facts "
+                 "WHERE purchase_month = DATE '2017-03-01'")
+        result = olist_db.run_query(query, profile=True)
+        assert result.rollup is None and result.data['items'].iloc[0] > 10000
+        assert result.profile['rows_scanned'] < olist_db.schema_info['order_facts']['row_count'] / 2
+class TestZipCentroids:
+    """Test the per-prefix geolocation centroid table"""
+    
+    def test_centroids_built_at_load(self, olist_db):
+        """Test each zip prefix collapses to one row and is advertised before the raw table"""
+        result, error = olist_db.execute_query(
+            "SELECT zip_code_prefix, lat, point_count, min_lat, max_lat, state FROM zip_centroids ORDER BY zip_code_prefix"
+        )
+        assert error is None
+        assert list(result['zip_code_prefix']) == [1001, 20000]
+        assert list(result['point_count']) == [2, 1]
+        assert result['lat'].iloc[0] == pytest.approx(-23.555)
+        assert (result['min_lat'].iloc[0], result['max_lat'].iloc[0]) == (-23.56, -23.55)
+        assert result['state'].iloc[0] == 'SP'
+        
+        description = olist_db.get_schema_description()
+        assert description.index("## Table: zip_centroids") < description.index("## Table: geolocation")
+        assert "prefer zip_centroids" in description
+    
+    def test_centroids_follow_geolocation_changes(self, tmp_path):
+        """Test a changed geolocation file rebuilds the centroids, leaving out points outside Brazil"""
+        csv_dir = write_olist_csvs(tmp_path / "csv")
+        db = DatabaseManager(db_path=tmp_path / "olist.db")
+        db.load_csv_data(csv_dir)
+        
+        geolocation_csv = csv_dir / 'olist_geolocation_dataset.csv'
+        geolocation_csv.write_text(geolocation_csv.read_text() + "20000,42.18,-8.72,rio de janeiro,RJ\n"
+                                   "30000,-19.92,-43.94,belo horizonte,MG\n")
+        db.load_csv_data(csv_dir)
+        
+        result, _ = db.execute_query("SELECT zip_code_prefix, point_count, max_lat FROM zip_centroids ORDER BY 1")
+        assert list(result['zip_code_prefix']) == [1001, 20000, 30000]
+        assert result['point_count'].iloc[1] == 1
+        assert result['max_lat'].iloc[1] == -22.90
+        assert db.schema_info['zip_centroids']['row_count'] == 3
+        db.close()
+
+
+class TestPartitionedStorage:
+    """Test month-partitioned Parquet storage of the order tables"""
+    
+    @pytest.fixture
+    def partitioned_db(self, tmp_path):
+        db = DatabaseManager(db_path=tmp_path / "olist.db")
+        db.partitions = PartitionStore(tmp_path / "partitions")
+        db.load_csv_data(write_olist_csvs(tmp_path / "csv"))
+        yield db
+        db.close()
+    
+    def test_date_filters_read_matching_partitions(self, partitioned_db, tmp_path):
+        """Test order tables become views whose month filters skip other partitions"""
+        views = {row[0] for row in partitioned_db.conn.execute(
+            "SELECT table_name FROM information_schema.tables WHERE table_type = 'VIEW'"
+        ).fetchall()}
+        assert views == {'orders', 'order_items', 'order_payments', 'order_reviews'}
+        assert (partitioned_db.partitions.current_dir('orders') / "purchase_month=2017-02-01").is_dir()
+        
+        result = partitioned_db.run_query(
+            "SELECT COUNT(*) AS n, MIN(order_status) AS status FROM orders WHERE purchase_month >= DATE '2017-02-01'",
+            profile=True
+        )
+        assert result.data['n'].iloc[0] == 2
+        scans = re.findall(r'"Total Files Read": "(\d+)"', result.profile['plan'])
+        assert scans == ['1']
+        assert "Filter on purchase_month" in partitioned_db.get_schema_description()
+        
+        partitioned_db.load_csv_data(tmp_path / "csv")
+        assert partitioned_db.load_sources['orders'] == 'unchanged'
+    
+    def test_incremental_ingest_appends_partition_files(self, partitioned_db, tmp_path):
+        """Test delta rows land in their order's month partition and reach order_facts"""
+        delta = tmp_path / "order_items_delta.csv"
+        delta.write_text(
+            "order_id,order_item_id,product_id,seller_id,shipping_limit_date,price,freight_value\n"
+            "O1,1,P1,S1,2017-01-07 10:00:00,100.0,10.0\n"
+            "O3,2,P2,S1,2017-03-01 10:00:00,75.0,7.5\n"
+        )
+        
+        assert partitioned_db.ingest_incremental('order_items', delta) == 1
+        result, _ = partitioned_db.execute_query(
+            "SELECT purchase_month, COUNT(*) AS n FROM order_items GROUP BY 1 ORDER BY 1"
+        )
+        assert list(result['n']) == [2, 3]
+        assert len(list((partitioned_db.partitions.current_dir('order_items') / "purchase_month=2017-02-01").glob("*.parquet"))) == 2
+        
+        facts, _ = partitioned_db.execute_query("SELECT COUNT(*) AS n FROM order_facts WHERE order_id = 'O3'")
+        assert facts['n'].iloc[0] == 2
+    
+    def test_published_snapshots_keep_their_partition_files(self, tmp_path, monkeypatch):
+        """Test rewrites and appends after a publish leave the files a replica snapshot reads untouched"""
+        monkeypatch.setattr(config.database, 'replica_dir', tmp_path / "replicas")
+        monkeypatch.setattr(config.database, 'replica_keep_versions', 2)
+        monkeypatch.setattr(config.database, 'replica_poll_seconds', 3600)
+        monkeypatch.setattr(config.database, 'partitioned_storage', True)
+        monkeypatch.setattr(config.database, 'partition_dir', tmp_path / "partitions")
+        monkeypatch.setattr(config.database, 'replica_role', 'writer')
+        writer = DatabaseManager(db_path=tmp_path / "writer.db")
+        csv_dir = write_olist_csvs(tmp_path / "csv")
+        writer.load_csv_data(csv_dir)
+        first_dir = writer.partitions.current_dir('orders')
+        
+        monkeypatch.setattr(config.database, 'replica_role', 'reader')
+        reader = DatabaseManager(db_path=tmp_path / "writer.db")
+        
+        delta = tmp_path / "orders_delta.csv"
+        delta.write_text(
+            OLIST_SAMPLE_CSVS['olist_orders_dataset.csv'].splitlines()[0] + "\n"
+            "O9,C1,canceled,2017-02-25 10:00:00,,,,\n"
+        )
+        writer.ingest_incremental('orders', delta)
+        orders_csv = csv_dir / "olist_orders_dataset.csv"
+        orders_csv.write_text(orders_csv.read_text() + "O8,C2,delivered,2017-02-26 10:00:00,,,,2017-03-10 00:00:00\n")
+        writer.load_csv_data(csv_dir)
+        assert writer.partitions.current_dir('orders') != first_dir and first_dir.is_dir()
+        assert writer.run_query("SELECT COUNT(*) AS n FROM orders").data['n'].iloc[0] == 5
+        assert reader.run_query("SELECT COUNT(*) AS n FROM orders").data['n'].iloc[0] == 3
+        
+        # Once no kept snapshot reads the first version, its files go
+        reader.close()
+        delta.write_text(delta.read_text().replace("O9,", "O10,"))
+        writer.ingest_incremental('orders', delta)
+        assert not first_dir.exists()
+        assert writer.run_query("SELECT COUNT(*) AS n FROM orders").data['n'].iloc[0] == 6
+        writer.close()
+
+
+class TestSchemaCatalog:
+    """Test the persisted schema catalog"""
+    
+    def test_warm_start_reuses_catalog(self, tmp_path):
+        """Test a reopened database reuses the catalog and its data version"""
+        db = DatabaseManager(db_path=tmp_path / "olist.db")
+        db.load_csv_data(write_olist_csvs(tmp_path / "csv"))
+        version = db.data_version
+        description = db.get_schema_description()
+        db.close()
+        
+        reopened = DatabaseManager(db_path=tmp_path / "olist.db")
+        assert reopened.data_version == version
+        assert reopened.schema_info['order_items']['row_count'] == 4
+        assert reopened.get_schema_description() == description
+        reopened.close()
+    
+    def test_warm_start_after_rows_are_replaced(self, tmp_path):
+        """Test the catalog survives a restart after order_facts rows were deleted and reinserted"""
+        db = DatabaseManager(db_path=tmp_path / "olist.db")
+        db.load_csv_data(write_olist_csvs(tmp_path / "csv"))
+        delta = tmp_path / "items_delta.csv"
+        delta.write_text(
+            OLIST_SAMPLE_CSVS['olist_order_items_dataset.csv'].splitlines()[0] + "\n"
+            "O3,2,P1,S1,2017-02-22 18:00:00,20.0,2.0\n"
+        )
+        db.ingest_incremental('order_items', delta)
+        version = db.data_version
+        db.close()
+        
+        # Deleted rows still count towards estimated_size, so only an exact count matches the catalog
+        reopened = DatabaseManager(db_path=tmp_path / "olist.db")
+        assert reopened.data_version == version
+        assert reopened.schema_info['order_facts']['row_count'] == 5
+        reopened.close()
+    
+    def test_data_version_tracks_changes(self, olist_db, tmp_path):
+        """Test unchanged reloads keep the data version and ingests bump it"""
+        version = olist_db.data_version
+        olist_db.load_csv_data(tmp_path / "csv")
+        assert olist_db.data_version == version
+        
+        delta = tmp_path / "orders_delta.csv"
+        delta.write_text(
+            OLIST_SAMPLE_CSVS['olist_orders_dataset.csv'].splitlines()[0] + "\n"
+            "O9,C1,delivered,2017-04-01 10:00:00,,,,\n"
+        )
+        olist_db.ingest_incremental('orders', delta)
+        assert olist_db.data_version != version
+        assert olist_db.catalog.load(olist_db.conn)[0] == olist_db.data_version
+
+
+class TestColumnStatistics:
+    """Test the column statistics catalog"""
+    
+    def test_statistics_computed_at_load(self, olist_db):
+        """Test per-column statistics are available after loading"""
+        status = olist_db.get_column_stats('orders', 'order_status')
+        assert status['kind'] == 'text'
+        assert set(status['top_values']) == {'delivered', 'shipped'}
+        
+        delivered = olist_db.get_column_stats('orders', 'order_delivered_customer_date')
+        assert delivered['null_fraction'] == pytest.approx(1 / 3, abs=1e-3)
+        
+        price = olist_db.get_column_stats('order_items', 'price')
+        assert price['min'] == 30.0 and price['max'] == 100.0
+        assert len(price['histogram']) == 11
+        
+        assert 'order_facts' in olist_db.statistics
+        assert "common values: " in olist_db.get_schema_description()
+        assert olist_db.get_result_column_stats(['customer_state', 'revenue'])['customer_state']['table'] == 'order_facts'
+    
+    def test_statistics_follow_data_version(self, tmp_path):
+        """Test statistics are reused on warm start and refreshed by ingest"""
+        db = DatabaseManager(db_path=tmp_path / "olist.db")
+        db.load_csv_data(write_olist_csvs(tmp_path / "csv"))
+        statistics = db.statistics
+        db.close()
+        
+        reopened = DatabaseManager(db_path=tmp_path / "olist.db")
+        assert reopened.statistics == statistics
+        
+        delta = tmp_path / "orders_delta.csv"
+        delta.write_text(
+            OLIST_SAMPLE_CSVS['olist_orders_dataset.csv'].splitlines()[0] + "\n"
+            "O9,C1,canceled,2017-04-01 10:00:00,,,,\n"
+        )
+        reopened.ingest_incremental('orders', delta)
+        assert 'canceled' in reopened.get_column_stats('orders', 'order_status')['top_values']
+        assert 'canceled' in reopened.get_column_stats('order_facts', 'order_status')['top_values']
+        reopened.close()
+    
+    def test_ingest_merges_statistics_without_rescan(self, olist_db, tmp_path, monkeypatch):
+        """Test an ingest folds its rows into the statistics instead of scanning the tables again"""
+        scanned = []
+        build_table = StatisticsCatalog.build_table
+        monkeypatch.setattr(StatisticsCatalog, 'build_table',
+                            staticmethod(lambda conn, table, columns: scanned.append(table) or build_table(conn, table, columns)))
+        
+        delta = tmp_path / "items_delta.csv"
+        delta.write_text(
+            OLIST_SAMPLE_CSVS['olist_order_items_dataset.csv'].splitlines()[0] + "\n"
+            "O3,2,P1,S1,2017-02-22 18:00:00,180.0,8.0\n"
+            "O4,1,P2,S1,2017-03-01 10:00:00,20.0,\n"
+        )
+        olist_db.ingest_incremental('order_items', delta)
+        assert scanned and not {'order_items', 'order_facts'} & set(scanned)
+        
+        rebuilt = StatisticsCatalog(None).build(olist_db.conn, olist_db.schema_info, ['order_items', 'order_facts'])
+        for table, columns in rebuilt.items():
+            for column, stats in columns.items():
+                merged = olist_db.get_column_stats(table, column)
+                for stat in ('non_null', 'null_fraction', 'min', 'max'):
+                    assert merged.get(stat) == stats.get(stat), (table, column, stat)
+        assert olist_db.get_column_stats('order_items', 'price')['max'] == 180.0
+
+
+class TestQueryCache:
+    """Test the query result cache"""
+    
+    def test_repeated_query_hits_cache(self, olist_db):
+        """Test normalized repeats are served from cache until the data changes"""
+        olist_db.execute_query("SELECT order_status, COUNT(*) AS n FROM orders GROUP BY order_status")
+        result, error = olist_db.execute_query("select order_status,\n  count(*) as n from orders group by order_status;")
+        
+        assert error is None
+        assert len(result) == 2
+        assert olist_db.get_query_cache_stats()['hits'] == 1
+        
+        olist_db._bump_data_version()
+        olist_db.execute_query("SELECT order_status, COUNT(*) AS n FROM orders GROUP BY order_status")
+        assert olist_db.get_query_cache_stats()['misses'] == 2
+    
+    def test_normalize_sql_keeps_literals(self):
+        """Test normalization only folds case outside quoted text"""
+        assert normalize_sql("SELECT * FROM t WHERE s = 'SP' -- state\n;") == "select * from t where s = 'SP'"
+    
+    def test_lru_eviction_respects_budget(self):
+        """Test least recently used results are evicted to fit the byte budget"""
+        tables = [pa.table({'x': list(range(100))}) for _ in range(3)]
+        cache = QueryResultCache(max_bytes=tables[0].nbytes * 2)
+        
+        cache.put(('v', 'a'), tables[0])
+        cache.put(('v', 'b'), tables[1])
+        cache.get(('v', 'a'))
+        cache.put(('v', 'c'), tables[2])
+        
+        assert cache.get(('v', 'b')) is None
+        assert cache.get(('v', 'a')) is not None
+        assert cache.stats()['evictions'] == 1
+        assert cache.stats()['bytes'] <= cache.max_bytes
+    
+    def test_sliced_results_are_charged_their_own_size(self):
+        """Test a slice of a large fetch is compacted so the budget counts the memory it actually holds"""
+        fetched = pa.table({'x': list(range(100_000)), 's': [str(i) for i in range(100_000)]})
+        cache = QueryResultCache(max_bytes=10_000)
+        
+        cache.put(('v', 'page'), fetched.slice(0, 10))
+        cached = cache.get(('v', 'page'))
+        assert cached.num_rows == 10 and cached.column('x').to_pylist() == list(range(10))
+        assert cached.get_total_buffer_size() < 1_000
+        assert cache.stats()['bytes'] == cached.get_total_buffer_size()
+
+
+class TestQueryLog:
+    """Test query profiling and the slow-query log"""
+    
+    def test_slow_queries_are_logged_with_plans(self, tmp_path, monkeypatch):
+        """Test profiled queries past the threshold keep their operator plan"""
+        monkeypatch.setattr(config.database, 'slow_query_ms', 0)
+        db = DatabaseManager(db_path=tmp_path / "profiled.db")
+        db.conn.execute("CREATE TABLE t AS SELECT range AS i, range % 7 AS g FROM range(100000)")
+        
+        result = db.run_query("SELECT g, SUM(i) AS s FROM t WHERE g <> 3 GROUP BY g", profile=True)
+        assert result.profile['rows_scanned'] == 100000
+        assert result.profile['top_operators'][0]['seconds'] >= 0
+        
+        slow = db.get_slow_queries()
+        assert len(slow) == 1
+        assert slow['sql'].iloc[0].startswith("SELECT g, SUM(i)")
+        assert 'children' in json.loads(slow['plan'].iloc[0])
+        
+        # Unprofiled queries are still timed
+        db.run_query("SELECT g, SUM(i) AS s FROM t WHERE g <> 5 GROUP BY g")
+        assert db.get_query_stats()['executed'] == 2
+        db.close()
+    
+    def test_shape_stats_persist(self, tmp_path):
+        """Test latency percentiles group queries by shape and survive a restart"""
+        assert query_shape("SELECT * FROM orders WHERE state = 'SP' AND n IN (1, 2, 3);") == \
+            query_shape("select *  from orders where state = 'RJ' and n in (4,5)")
+        assert query_shape("SELECT col1 FROM t2") == "select col1 from t2"
+        
+        db = DatabaseManager(db_path=tmp_path / "shapes.db")
+        for state in ('SP', 'RJ', 'MG'):
+            db.run_query(f"SELECT '{state}' AS state, COUNT(*) AS n FROM range(10)")
+        db.run_query("SELECT missing_column FROM range(10)")
+        db.close()
+        
+        reopened = DatabaseManager(db_path=tmp_path / "shapes.db")
+        shapes = reopened.get_query_shape_stats().set_index('shape')
+        assert shapes.loc["select ? as state, count(*) as n from range(?)", 'executions'] == 3
+        assert shapes.loc["select missing_column from range(?)", 'failures'] == 1
+        assert (shapes['p95_ms'] >= shapes['p50_ms']).all()
+        reopened.close()
+
+
+class TestSharedEngine:
+    """Test the process-wide DuckDB engine"""
+    
+    def test_sessions_share_engine_and_catalog(self, tmp_path):
+        """Test managers on one file share the engine, catalog and data version"""
+        first = DatabaseManager(db_path=tmp_path / "shared.db")
+        second = DatabaseManager(db_path=tmp_path / "shared.db")
+        assert first.engine is second.engine
+        assert first.conn is not second.conn
+        
+        first.load_csv_data(write_olist_csvs(tmp_path / "csv"))
+        assert second.schema_info['orders']['row_count'] == 3
+        assert second.data_version == first.data_version
+        assert second.get_engine_stats()['sessions'] == 2
+        
+        first.close()
+        result, error = second.execute_query("SELECT COUNT(*) AS n FROM customers")
+        assert error is None and result['n'].iloc[0] == 3
+        second.close()
+    
+    def test_pooled_cursors_are_bounded(self, tmp_path):
+        """Test the cursor pool never opens more than its size"""
+        db = DatabaseManager(db_path=tmp_path / "pool.db")
+        engine = db.engine
+        
+        with engine.pooled_cursor() as first:
+            with engine.pooled_cursor() as second:
+                assert first is not second
+                assert engine.stats()['pool_busy'] == 2
+        
+        with engine.pooled_cursor() as reused:
+            assert reused in (first, second)
+        assert engine.stats()['pool_open'] == 2
+        db.close()
+    
+    def test_queries_cannot_write_on_read_write_engine(self, olist_db):
+        """Test pooled query cursors are read-only while sessions can still load"""
+        assert not olist_db.engine.read_only
+        
+        # Not caught by the keyword check, stopped by the read-only transaction
+        result = olist_db.run_query("COMMENT ON TABLE customers IS 'changed'")
+        assert result.error is not None and 'read-only' in result.error
+        
+        with olist_db.engine.pooled_cursor() as cursor:
+            with pytest.raises(duckdb.Error):
+                cursor.execute("INSERT INTO customers SELECT * FROM customers")
+        with olist_db.engine.pooled_cursor() as cursor:
+            assert cursor.execute("SELECT COUNT(*) FROM customers").fetchone()[0] == 3
+        
+        olist_db.conn.execute("DELETE FROM customers WHERE customer_id = 'C3'")
+        result, error = olist_db.execute_query("SELECT COUNT(*) AS n FROM customers")
+        assert error is None and result['n'].iloc[0] == 2
+    
+    def test_exhausted_pool_reports_a_timeout(self, tmp_path, monkeypatch):
+        """Test a query that never gets a pooled cursor fails as a timeout, not an execution error"""
+        monkeypatch.setattr(config.database, 'connection_pool_size', 1)
+        db = DatabaseManager(db_path=tmp_path / "pool.db")
+        
+        with db.engine.pooled_cursor():
+            result = db.run_query("SELECT 42 AS answer", timeout=0.2)
+        assert result.error_type == 'timeout'
+        assert db.run_query("SELECT 42 AS answer").data['answer'].iloc[0] == 42
+        db.close()
+
+
+class TestReplicas:
+    """Test writer-published snapshots served by read-only readers"""
+    
+    def test_reader_switches_to_new_snapshot(self, tmp_path, monkeypatch):
+        """Test a reader serves the latest snapshot and follows the writer's loads"""
+        monkeypatch.setattr(config.database, 'replica_dir', tmp_path / "replicas")
+        monkeypatch.setattr(config.database, 'replica_poll_seconds', 0)
+        monkeypatch.setattr(config.database, 'replica_role', 'writer')
+        writer = DatabaseManager(db_path=tmp_path / "writer.db")
+        writer.load_csv_data(write_olist_csvs(tmp_path / "csv"))
+        assert writer.replicas.latest()['sequence'] == 1
+        
+        monkeypatch.setattr(config.database, 'replica_role', 'reader')
+        reader = DatabaseManager(db_path=tmp_path / "writer.db")
+        assert reader.engine.read_only and reader.db_path.name == "snapshot-000001.duckdb"
+        assert reader.data_version == writer.data_version
+        assert reader.run_query("SELECT COUNT(*) AS n FROM orders").data['n'].iloc[0] == 3
+        with pytest.raises(RuntimeError):
+            reader.load_csv_data(tmp_path / "csv")
+        
+        delta = tmp_path / "orders_delta.csv"
+        delta.write_text(
+            "order_id,customer_id,order_status,order_purchase_timestamp,order_approved_at,"
+            "order_delivered_carrier_date,order_delivered_customer_date,order_estimated_delivery_date\n"
+            "O4,C1,delivered,2017-03-02 10:00:00,,,,2017-03-10 00:00:00\n"
+        )
+        writer.ingest_incremental('orders', delta)
+        assert writer.replicas.latest()['sequence'] == 2
+        
+        # The next query after the poll interval runs on the new snapshot
+        assert reader.run_query("SELECT COUNT(*) AS n FROM orders").data['n'].iloc[0] == 4
+        assert reader.db_path.name == "snapshot-000002.duckdb"
+        assert reader.data_version == writer.data_version
+        reader.close()
+        writer.close()
+    
+    def test_reader_requires_published_snapshot(self, tmp_path, monkeypatch):
+        """Test a reader refuses to start before anything is published"""
+        monkeypatch.setattr(config.database, 'replica_dir', tmp_path / "replicas")
+        monkeypatch.setattr(config.database, 'replica_role', 'reader')
+        with pytest.raises(FileNotFoundError):
+            DatabaseManager(db_path=tmp_path / "writer.db")
+
+
+class TestQueryControl:
+    """Test query deadlines and cancellation"""
+    
+    SLOW_QUERY = "SELECT SUM(a.range * b.range) AS s FROM range(200000) a, range(200000) b"
+    
+    def test_query_timeout_interrupts(self, tmp_path, monkeypatch):
+        """Test a runaway query is interrupted at its deadline"""
+        # The cost governor would reject the cross join before it starts
+        monkeypatch.setattr(config.database, 'enable_cost_governor', False)
+        db = DatabaseManager(db_path=tmp_path / "timeout.db")
+        result = db.run_query(self.SLOW_QUERY, timeout=0.2)
+        
+        assert result.error_type == 'timeout'
+        assert result.elapsed < 5
+        assert db.get_query_stats()['timeout'] == 1
+        
+        # The pooled cursor is usable again after the interrupt
+        data, error = db.execute_query("SELECT 42 AS answer")
+        assert error is None and data['answer'].iloc[0] == 42
+        db.close()
+    
+    def test_query_cancellation(self, tmp_path, monkeypatch):
+        """Test a running query can be cancelled from another thread"""
+        monkeypatch.setattr(config.database, 'enable_cost_governor', False)
+        db = DatabaseManager(db_path=tmp_path / "cancel.db")
+        handle = QueryHandle(db.session_id)
+        timer = threading.Timer(0.2, db.cancel_session_queries)
+        timer.start()
+        
+        result = db.run_query(self.SLOW_QUERY, timeout=10, handle=handle)
+        timer.join()
+        
+        assert result.error_type == 'cancelled'
+        assert result.query_id == handle.query_id
+        assert db.get_query_stats()['cancelled'] == 1
+        db.close()
+
+
+class TestCostGovernor:
+    """Test queries are classified from their plan estimates before running"""
+    
+    def test_pathological_query_is_rejected(self, tmp_path):
+        """Test a join without a condition is rejected with a reason and logged with its estimate"""
+        db = DatabaseManager(db_path=tmp_path / "governed.db")
+        result = db.run_query(TestQueryControl.SLOW_QUERY)
+        
+        assert result.error_type == 'rejected'
+        assert "without an equality condition" in result.error
+        assert result.cost.cost_class == 'pathological' and result.elapsed < 5
+        
+        cheap = db.run_query("SELECT 42 AS answer")
+        assert cheap.success and cheap.cost.cost_class == 'cheap'
+        assert db.get_cost_governor_stats() == {'reject': 1, 'run': 1}
+        
+        logged = db.engine.query_log.execute(
+            "SELECT status, cost_class, cost_action, estimated_rows FROM query_log ORDER BY logged_at"
+        )
+        assert list(logged['status']) == ['rejected', 'executed']
+        assert logged['estimated_rows'].iloc[0] >= config.database.reject_query_rows
+        db.close()
+    
+    def test_heavy_queries_wait_for_a_slot(self, tmp_path, monkeypatch):
+        """Test heavy queries queue behind running heavy queries while cheap ones do not"""
+        monkeypatch.setattr(config.database, 'heavy_query_rows', 1000)
+        db = DatabaseManager(db_path=tmp_path / "queued.db")
+        heavy_query = "SELECT COUNT(*) AS n FROM range(100000)"
+        
+        with db.governor.heavy_slot(1):
+            blocked = db.run_query(heavy_query, timeout=0.3)
+            cheap = db.run_query("SELECT COUNT(*) AS n FROM range(10)")
+        assert blocked.error_type == 'timeout' and blocked.cost.action == 'queue'
+        assert cheap.success and cheap.cost.action == 'run'
+        
+        result = db.run_query(heavy_query)
+        assert result.success and result.data['n'].iloc[0] == 100000
+        db.close()
+    
+    def test_heavy_aggregates_run_approximately(self, tmp_path, monkeypatch):
+        """Test the approximate policy answers heavy aggregates from a sample"""
+        monkeypatch.setattr(config.database, 'heavy_query_rows', 100_000)
+        monkeypatch.setattr(config.database, 'heavy_query_policy', 'approximate')
+        db = DatabaseManager(db_path=tmp_path / "approximated.db")
+        db.conn.execute("CREATE TABLE order_items AS SELECT range % 4 AS seller, range * 0.5 AS price FROM range(200000)")
+        db._build_schema_info()
+        
+        result = db.run_query("SELECT seller, SUM(price) AS revenue FROM order_items GROUP BY seller ORDER BY seller")
+        assert result.cost.action == 'approximate' and result.approximate
+        assert 'revenue_ci_low' in result.data.columns
+        db.close()
+
+
+class TestAsyncQueries:
+    """Test the asyncio API over the shared engine"""
+    
+    def test_concurrent_queries_are_awaited_together(self, olist_db):
+        """Test independent queries run side by side on the bounded executor"""
+        async def run_all():
+            return await asyncio.gather(
+                olist_db.arun_query("SELECT COUNT(*) AS n FROM orders"),
+                olist_db.arun_query("SELECT COUNT(*) AS n FROM order_items"),
+                olist_db.aexecute_query("SELECT COUNT(*) AS n FROM customers"),
+            )
+        
+        orders, items, (customers, error) = asyncio.run(run_all())
+        assert orders.data['n'].iloc[0] == 3 and items.data['n'].iloc[0] == 4
+        assert error is None and customers['n'].iloc[0] == 3
+    
+    def test_task_cancellation_interrupts_query(self, tmp_path, monkeypatch):
+        """Test cancelling the awaiting task cancels the running query"""
+        monkeypatch.setattr(config.database, 'enable_cost_governor', False)
+        db = DatabaseManager(db_path=tmp_path / "async.db")
+        
+        async def cancel_slow_query():
+            task = asyncio.create_task(db.arun_query(TestQueryControl.SLOW_QUERY, timeout=30))
+            await asyncio.sleep(0.3)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            for _ in range(50):
+                if db.get_query_stats().get('cancelled'):
+                    break
+                await asyncio.sleep(0.1)
+            return await db.aexecute_query("SELECT 42 AS answer")
+        
+        data, error = asyncio.run(cancel_slow_query())
+        assert db.get_query_stats()['cancelled'] == 1
+        assert error is None and data['answer'].iloc[0] == 42
+        db.close()
+    
+    def test_async_load_and_schema_refresh(self, tmp_path):
+        """Test loading and schema refresh can be awaited"""
+        db = DatabaseManager(db_path=tmp_path / "olist.db")
+        loaded = asyncio.run(db.aload_csv_data(write_olist_csvs(tmp_path / "csv")))
+        assert loaded['orders'] == 3
+        
+        db.conn.execute("CREATE TABLE notes AS SELECT 1 AS id")
+        schema = asyncio.run(db.arefresh_schema())
+        assert schema['notes']['row_count'] == 1
+        db.close()
+
+
+class TestResultLimits:
+    """Test row caps are pushed into the query and reported"""
+    
+    def test_oversized_result_is_truncated(self, tmp_path, monkeypatch):
+        """Test results beyond max_query_results are cut off and flagged"""
+        monkeypatch.setattr(config.database, 'max_query_results', 100)
+        db = DatabaseManager(db_path=tmp_path / "limits.db")
+        
+        result = db.run_query("SELECT range AS n FROM range(1000000) ORDER BY n DESC;")
+        assert result.success and result.truncated
+        assert len(result.data) == 100
+        assert result.data['n'].iloc[0] == 999999
+        assert result.total_rows is None
+        
+        counted = db.run_query("SELECT range AS n FROM range(1000) -- all rows", count_total=True)
+        assert counted.truncated and counted.total_rows == 1000
+        
+        # Cached results keep their truncation details
+        cached = db.run_query("SELECT range AS n FROM range(1000) -- all rows", count_total=True)
+        assert cached.from_cache and cached.truncated and cached.total_rows == 1000
+        db.close()
+    
+    def test_small_result_reports_exact_count(self, tmp_path):
+        """Test results under the cap are complete and counted"""
+        db = DatabaseManager(db_path=tmp_path / "limits.db")
+        
+        result = db.run_query("WITH t AS (SELECT range AS n FROM range(10)) SELECT * FROM t")
+        assert not result.truncated and result.total_rows == 10
+        
+        # Statements that cannot be wrapped still run uncapped
+        pragma = db.run_query("PRAGMA database_size")
+        assert pragma.success and not pragma.truncated
+        db.close()
+
+
+class TestResultPaging:
+    """Test full results kept server-side and read back a page at a time"""
+    
+    def test_truncated_result_is_paged_and_sorted(self, tmp_path, monkeypatch):
+        """Test a truncated result is stored whole and pages come back sorted"""
+        monkeypatch.setattr(config.database, 'max_query_results', 100)
+        monkeypatch.setattr(config.database, 'result_dir', tmp_path / "results")
+        db = DatabaseManager(db_path=tmp_path / "paging.db")
+        
+        result = db.run_query("SELECT range AS n, range % 7 AS bucket FROM range(5000);", keep_result=True)
+        assert result.truncated and len(result.data) == 100
+        assert result.result_id and result.total_rows == 5000
+        assert db.get_result_info(result.result_id)['row_count'] == 5000
+        
+        last_page = db.get_result_page(result.result_id, page=49, page_size=100)
+        assert last_page['n'].tolist() == list(range(4900, 5000))
+        
+        top = db.get_result_page(result.result_id, page=0, page_size=10, sort_by='n', descending=True)
+        assert top['n'].tolist() == list(range(4999, 4989, -1))
+        with pytest.raises(ValueError):
+            db.get_result_page(result.result_id, sort_by='missing')
+        
+        # Results are only kept when asked for
+        assert db.run_query("SELECT 1 AS n").result_id is None
+        db.close()
+    
+    def test_results_are_evicted_and_released(self, tmp_path, monkeypatch):
+        """Test the least recently used results are deleted past the limit"""
+        monkeypatch.setattr(config.database, 'max_stored_results', 2)
+        monkeypatch.setattr(config.database, 'result_dir', tmp_path / "results")
+        db = DatabaseManager(db_path=tmp_path / "paging.db")
+        
+        ids = [db.run_query(f"SELECT range AS n FROM range({size})", keep_result=True).result_id
+               for size in (10, 20, 30)]
+        assert db.get_result_page(ids[0]) is None
+        assert len(db.get_result_page(ids[2], page_size=100)) == 30
+        assert db.get_result_store_stats()['results'] == 2
+        
+        assert db.release_result(ids[1])
+        assert db.get_result_info(ids[1]) is None
+        assert not db.release_result(ids[1])
+        
+        # A cached result can still be kept under the new query's id
+        cached = db.run_query("SELECT range AS n FROM range(30)", keep_result=True)
+        assert cached.from_cache and len(db.get_result_page(cached.result_id)) == 30
+        db.close()
+    
+    def test_truncated_result_is_stored_when_opened(self, tmp_path, monkeypatch):
+        """Test answers keep no files and a truncated result is written out only on request"""
+        monkeypatch.setattr(config.database, 'max_query_results', 100)
+        monkeypatch.setattr(config.database, 'result_dir', tmp_path / "results")
+        db = DatabaseManager(db_path=tmp_path / "paging.db")
+        
+        sql = "SELECT range AS n FROM range(5000)"
+        result = db.run_query(sql)
+        assert result.truncated and result.result_id is None
+        assert db.get_result_store_stats()['results'] == 0
+        
+        result_id = db.store_result(sql)
+        assert db.get_result_info(result_id)['row_count'] == 5000
+        assert db.get_result_info(result_id)['columns'] == ['n']
+        assert db.get_result_page(result_id, page=49, page_size=100)['n'].tolist() == list(range(4900, 5000))
+        db.close()
+
+
+class TestRollups:
+    """Test rollup tables and query routing"""
+    
+    CATEGORY_REVENUE = """
+        SELECT t.product_category_name_english AS category,
+               date_trunc('month', o.order_purchase_timestamp) AS month,
+               SUM(oi.price) AS revenue, COUNT(*) AS items, AVG(oi.price) AS avg_price
+        FROM orders o
+        JOIN order_items oi ON o.order_id = oi.order_id
+        JOIN products p ON oi.product_id = p.product_id
+        LEFT JOIN product_category_translation t ON p.product_category_name = t.product_category_name
+        WHERE o.order_status = 'delivered'
+        GROUP BY 1, 2
+        ORDER BY revenue DESC, month, category
+    """
+    
+    def test_matching_aggregates_are_routed(self, olist_db):
+        """Test rollup answers are identical to the base-table answers"""
+        queries = {
+            self.CATEGORY_REVENUE: 'category_sales',
+            "SELECT c.customer_state, COUNT(*) AS orders FROM customers c JOIN orders o USING (customer_id) "
+            "GROUP BY c.customer_state ORDER BY orders DESC, c.customer_state": 'customer_state_orders',
+            "SELECT payment_type, SUM(payment_value) AS total FROM order_payments op "
+            "JOIN orders o ON op.order_id = o.order_id GROUP BY payment_type ORDER BY payment_type": 'payment_type_summary',
+            "SELECT COUNT(*) AS n FROM orders WHERE order_status = 'cancelled'": 'order_volume',
+        }
+        
+        for query, rollup in queries.items():
+            result = olist_db.run_query(query)
+            expected = olist_db.conn.execute(query).df()
+            assert result.rollup == rollup
+            pd.testing.assert_frame_equal(result.data, expected)
+        
+        assert olist_db.get_rollup_stats()['category_sales']['routed_queries'] == 1
+    
+    def test_fact_table_queries_are_routed(self, olist_db):
+        """Test single-table aggregates over order_facts read its rollups"""
+        query = """
+            SELECT customer_state,
+                   AVG(CASE WHEN is_late THEN 1 ELSE 0 END) AS late_share,
+                   AVG(delivery_days) AS avg_delivery_days,
+                   COUNT(*) AS items
+            FROM order_facts
+            WHERE order_status = 'delivered'
+            GROUP BY ALL
+            ORDER BY customer_state
+        """
+        result = olist_db.run_query(query)
+        assert result.rollup == 'facts_customer_state_month'
+        pd.testing.assert_frame_equal(result.data, olist_db.conn.execute(query).df())
+    
+    def test_unprovable_queries_are_not_routed(self, olist_db):
+        """Test queries that a rollup cannot answer exactly read the base tables"""
+        queries = [
+            # Filter on a column the rollup does not keep
+            "SELECT order_status, COUNT(*) FROM orders WHERE order_delivered_customer_date IS NULL GROUP BY 1",
+            # Distinct counts cannot be re-aggregated
+            "SELECT order_status, COUNT(DISTINCT customer_id) FROM orders GROUP BY 1",
+            # Different join type than the rollup source
+            "SELECT c.customer_state, COUNT(*) FROM customers c LEFT JOIN orders o ON c.customer_id = o.customer_id GROUP BY 1",
+            # Row-level results
+            "SELECT order_status FROM orders",
+        ]
+        for query in queries:
+            result = olist_db.run_query(query)
+            assert result.success and result.rollup is None
+    
+    def test_rollups_follow_incremental_ingest(self, olist_db, tmp_path):
+        """Test rollups are rebuilt when the data version changes"""
+        query = "SELECT order_status, COUNT(*) AS n FROM orders GROUP BY order_status ORDER BY order_status"
+        assert olist_db.run_query(query).rollup == 'order_volume'
+        
+        delta = tmp_path / "orders_delta.csv"
+        delta.write_text(
+            OLIST_SAMPLE_CSVS['olist_orders_dataset.csv'].splitlines()[0] + "\n"
+            "O9,C1,canceled,2017-04-01 10:00:00,,,,\n"
+        )
+        olist_db.ingest_incremental('orders', delta)
+        
+        result = olist_db.run_query(query)
+        assert result.rollup == 'order_volume'
+        assert result.data.set_index('order_status')['n'].to_dict() == {'canceled': 1, 'delivered': 2, 'shipped': 1}
+        assert olist_db.get_rollup_stats()['order_volume']['data_version'] == olist_db.data_version
+    
+    def test_unrelated_ingest_keeps_rollups(self, olist_db, tmp_path):
+        """Test an ingest only touches the rollups over the table it changed"""
+        built_at = "SELECT rollup_name, built_at FROM rollups.rollup_versions ORDER BY rollup_name"
+        before = dict(olist_db.conn.execute(built_at).fetchall())
+        
+        delta = tmp_path / "reviews_delta.csv"
+        delta.write_text(
+            OLIST_SAMPLE_CSVS['olist_order_reviews_dataset.csv'].splitlines()[0] + "\n"
+            "R9,O2,1,,ruim,2017-02-25 00:00:00,2017-02-26 00:00:00\n"
+        )
+        olist_db.ingest_incremental('order_reviews', delta)
+        
+        after = dict(olist_db.conn.execute(built_at).fetchall())
+        assert {name for name in before if after[name] != before[name]} == {'category_reviews'}
+        assert all(stats['data_version'] == olist_db.data_version for stats in olist_db.get_rollup_stats().values())
+        
+        query = """
+            SELECT p.product_category_name, AVG(r.review_score) AS score, COUNT(*) AS reviews
+            FROM order_reviews r
+            JOIN order_items oi ON r.order_id = oi.order_id
+            JOIN products p ON oi.product_id = p.product_id
+            LEFT JOIN product_category_translation t ON p.product_category_name = t.product_category_name
+            GROUP BY 1 ORDER BY 1
+        """
+        result = olist_db.run_query(query)
+        assert result.rollup == 'category_reviews'
+        pd.testing.assert_frame_equal(result.data, olist_db.conn.execute(query).df())
+    
+    def test_replaced_fact_rows_rebuild_rollups_lazily(self, olist_db, tmp_path):
+        """Test rollups over rows an ingest replaced are rebuilt by the first query that reads them"""
+        delta = tmp_path / "items_delta.csv"
+        delta.write_text(
+            OLIST_SAMPLE_CSVS['olist_order_items_dataset.csv'].splitlines()[0] + "\n"
+            "O3,2,P1,S1,2017-02-22 18:00:00,80.0,8.0\n"
+        )
+        olist_db.ingest_incremental('order_items', delta)
+        
+        # New items are merged into the item rollups, while O3's fact rows were replaced
+        assert set(olist_db.rollups.stale(olist_db.data_version)) == {
+            'facts_category_month', 'facts_customer_state_month', 'facts_seller_state_month'
+        }
+        result = olist_db.run_query(TestRollups.CATEGORY_REVENUE)
+        assert result.rollup == 'category_sales'
+        pd.testing.assert_frame_equal(result.data, olist_db.conn.execute(TestRollups.CATEGORY_REVENUE).df())
+        
+        query = "SELECT order_status, SUM(price) AS revenue, COUNT(*) AS items FROM order_facts GROUP BY 1 ORDER BY 1"
+        result = olist_db.run_query(query)
+        assert result.rollup == 'facts_category_month'
+        pd.testing.assert_frame_equal(result.data, olist_db.conn.execute(query).df())
+        assert olist_db.rollups.stale(olist_db.data_version) == []
+
+
+class TestApproximateQueries:
+    """Test approximate answers estimated from table samples"""
+    
+    FREIGHT_BY_STATE = """
+        SELECT seller_state, ROUND(AVG(freight_value), 2) AS avg_freight,
+               COUNT(*) AS items, SUM(price) AS revenue
+        FROM order_items
+        GROUP BY seller_state
+        ORDER BY seller_state
+    """
+    
+    @pytest.fixture
+    def sampled_db(self, tmp_path):
+        """Database with an order_items table large enough to be sampled"""
+        db = DatabaseManager(db_path=tmp_path / "sampled.db")
+        db.conn.execute("""
+            CREATE TABLE order_items AS
+            SELECT 'O' || (range // 2) AS order_id, range % 2 + 1 AS order_item_id,
+                   ['SP', 'RJ', 'MG', 'BA'][range % 4 + 1] AS seller_state,
+                   (range % 97) * 1.5 AS price, (range % 13) * 0.7 AS freight_value
+            FROM range(200000)
+        """)
+        db._build_schema_info()
+        yield db
+        db.close()
+    
+    def test_estimates_bound_exact_answer(self, sampled_db):
+        """Test estimates come with intervals that contain the exact values"""
+        approximate = sampled_db.run_query(self.FREIGHT_BY_STATE, approximate=True)
+        exact = sampled_db.run_query(self.FREIGHT_BY_STATE)
+        
+        assert approximate.approximate and not exact.approximate
+        assert approximate.sample_fraction == pytest.approx(config.database.approx_sample_rate, rel=0.1)
+        assert approximate.confidence == config.database.approx_confidence
+        assert list(approximate.data['seller_state']) == list(exact.data['seller_state'])
+        for column in ('avg_freight', 'items', 'revenue'):
+            low, high = approximate.data[f"{column}_ci_low"], approximate.data[f"{column}_ci_high"]
+            assert ((low <= exact.data[column]) & (exact.data[column] <= high)).all()
+        assert approximate.data['items'].dtype == exact.data['items'].dtype
+        assert sampled_db.get_sample_stats()['order_items']['approximate_queries'] == 1
+    
+    def test_unestimable_queries_run_exactly(self, sampled_db):
+        """Test queries a sample cannot answer fall back to the exact result"""
+        queries = [
+            "SELECT MAX(price) AS top FROM order_items",
+            "SELECT COUNT(DISTINCT order_id) AS orders FROM order_items",
+            "SELECT order_id, price FROM order_items LIMIT 5",
+            "SELECT COUNT(*) AS n FROM (SELECT * FROM order_items) t",
+        ]
+        for query in queries:
+            result = sampled_db.run_query(query, approximate=True)
+            assert result.success and not result.approximate
+            pd.testing.assert_frame_equal(result.data, sampled_db.conn.execute(query).df())
+    
+    def test_ingest_extends_sample_without_redrawing(self, tmp_path):
+        """Test a delta is sampled into the existing sample and the population counts follow it"""
+        db = DatabaseManager(db_path=tmp_path / "sampled.db")
+        db.conn.execute("""
+            CREATE TABLE order_items AS
+            SELECT 'O' || range AS order_id, 1 AS order_item_id, 'P1' AS product_id, 'S1' AS seller_id,
+                   TIMESTAMP '2017-01-01 10:00:00' AS shipping_limit_date,
+                   CAST(range % 97 AS DECIMAL(10, 2)) AS price, CAST(range % 13 AS DECIMAL(10, 2)) AS freight_value
+            FROM range(200000)
+        """)
+        db._build_schema_info()
+        drawn = "SELECT sample_rows, built_at FROM samples.sample_versions WHERE table_name = 'order_items'"
+        sample_rows, built_at = db.conn.execute(drawn).fetchone()
+        sampled_orders = set(db.conn.execute("SELECT order_id FROM samples.order_items").df()['order_id'])
+        
+        delta = tmp_path / "items_delta.csv"
+        db.conn.execute(f"""
+            COPY (SELECT 'N' || range AS order_id, 1 AS order_item_id, 'P1' AS product_id, 'S1' AS seller_id,
+                         '2017-06-01 10:00:00' AS shipping_limit_date, 10.0 AS price, 1.0 AS freight_value
+                  FROM range(50000)) TO '{delta}' (HEADER)
+        """)
+        db.ingest_incremental('order_items', delta)
+        
+        grown_rows, grown_built_at = db.conn.execute(drawn).fetchone()
+        assert grown_built_at == built_at
+        assert grown_rows - sample_rows == pytest.approx(50000 * config.database.approx_sample_rate, rel=0.15)
+        kept_orders = set(db.conn.execute("SELECT order_id FROM samples.order_items WHERE order_id LIKE 'O%'").df()['order_id'])
+        assert kept_orders == sampled_orders
+        
+        sample = db.samples.samples['order_items']
+        assert (sample.source_rows, sample.sample_rows) == (250000, grown_rows)
+        assert db.get_sample_stats()['order_items']['data_version'] == db.data_version
+        result = db.run_query("SELECT COUNT(*) AS n FROM order_items", approximate=True)
+        assert result.approximate and result.data['n_ci_low'][0] <= 250000 <= result.data['n_ci_high'][0]
+        db.close()
+    
+    def test_small_tables_are_not_sampled(self, olist_db):
+        """Test tables under the size threshold are always queried exactly"""
+        assert olist_db.get_sample_stats() == {}
+        result = olist_db.run_query("SELECT SUM(price) AS revenue FROM order_items", approximate=True)
+        assert result.success and not result.approximate
+
+
 class TestMemoryManager:
     """Test conversation memory"""
     
@@ -140,6 +1396,280 @@ class TestAgents:
         assert agent.agent_type.value == 'sql_analyst'
 
 
+class TestLLMResponseCache:
+    """Test the disk-backed cache of model responses"""
+    
+    class StubModel:
+        """Stands in for the Gemini model, counting calls"""
+        
+        def __init__(self):
+            self.calls = 0
+        
+        def generate_content(self, prompt):
+            self.calls += 1
+            return type('Response', (), {'text': f"answer {self.calls}"})()
+    
+    def test_repeated_prompts_are_served_from_cache(self, tmp_path):
+        """Test repeats hit the cache, across restarts, until the scope changes or the entry is dropped"""
+        agent = TranslatorAgent()
+        agent.model = self.StubModel()
+        agent.response_cache = LLMResponseCache(tmp_path / "llm.sqlite", 3600, 1024 * 1024)
+        
+        assert agent._call_llm("translate beleza_saude", scope="v1") == "answer 1"
+        assert agent._call_llm("translate beleza_saude", scope="v1") == "answer 1"
+        assert agent.model.calls == 1
+        assert agent._call_llm("translate beleza_saude", scope="v2") == "answer 2"
+        
+        stats = agent.response_cache.stats()
+        assert stats['hits'] == 1 and stats['misses'] == 2 and stats['entries'] == 2
+        
+        # A new process reads the same file
+        agent.response_cache = LLMResponseCache(tmp_path / "llm.sqlite", 3600, 1024 * 1024)
+        assert agent._call_llm("translate beleza_saude", scope="v1") == "answer 1"
+        agent._forget_llm_response("translate beleza_saude", scope="v1")
+        assert agent._call_llm("translate beleza_saude", scope="v1") == "answer 3"
+    
+    def test_expired_and_oversized_entries_are_evicted(self, tmp_path):
+        """Test entries past the TTL miss and the least recently used go past the size limit"""
+        cache = LLMResponseCache(None, 3600, 10)
+        cache.put('first', 'aaaaaa', 'model', '', 0.5)
+        time.sleep(0.01)
+        cache.put('second', 'bbbbbb', 'model', '', 0.5)
+        assert cache.get('first') is None
+        assert cache.get('second') == 'bbbbbb'
+        assert cache.stats()['latency_saved_s'] == 0.5
+        
+        cache.ttl_seconds = -1
+        assert cache.get('second') is None
+
+
+def bag_of_words_embedder(texts):
+    """Deterministic stand-in for the sentence model: hashed word counts, normalized"""
+    vectors = np.zeros((len(texts), 64), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in text.lower().split():
+            vectors[row, zlib.crc32(word.encode()) % 64] += 1
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class TestSemanticSQLCache:
+    """Test reuse of SQL across similarly phrased questions"""
+    
+    class SQLModel:
+        """Stands in for the Gemini model, answering every prompt with one query"""
+        
+        def __init__(self, sql):
+            self.sql = sql
+            self.prompts = []
+        
+        def generate_content(self, prompt):
+            self.prompts.append(prompt)
+            return type('Response', (), {'text': self.sql})()
+    
+    def make_agent(self, db, tmp_path, sql):
+        agent = SQLAnalystAgent(db)
+        agent.model = self.SQLModel(sql)
+        agent.response_cache = None
+        agent.semantic_cache = SemanticSQLCache(tmp_path / "semantic", bag_of_words_embedder, 0.85, 0.5, 100)
+        return agent
+    
+    def test_similar_question_reuses_sql(self, olist_db, tmp_path):
+        """Test a rephrased question runs the cached SQL without asking the model"""
+        agent = self.make_agent(olist_db, tmp_path, "SELECT order_status, COUNT(*) AS n FROM orders GROUP BY 1")
+        
+        first = agent.execute("top order status by count")
+        assert first.success and first.metadata['similar_question'] is None
+        second = agent.execute("top order status by count please")
+        assert second.success and len(agent.model.prompts) == 1
+        assert second.metadata['similar_question'] == "top order status by count"
+        assert second.metadata['similarity'] >= 0.85
+        
+        # The index is on disk for the next process
+        reloaded = SemanticSQLCache(tmp_path / "semantic", bag_of_words_embedder, 0.85, 0.5, 100)
+        assert reloaded.stats()['entries'] == 1
+        
+        # Loosely related questions only get the cached SQL as an example
+        agent.execute("order status count for shipped")
+        assert len(agent.model.prompts) == 2
+        assert "A similar earlier question" in agent.model.prompts[-1]
+    
+    def test_stale_sql_is_revalidated(self, olist_db, tmp_path):
+        """Test cached SQL from an older data version is dropped when it no longer binds"""
+        agent = self.make_agent(olist_db, tmp_path, "SELECT COUNT(*) AS n FROM orders")
+        agent.semantic_cache.add("how many orders", "SELECT COUNT(*) AS n FROM retired_orders", "old-version")
+        
+        response = agent.execute("how many orders")
+        assert response.success and response.metadata['similar_question'] is None
+        assert len(agent.model.prompts) == 1
+        assert agent.semantic_cache.entries[0]['sql'] == "SELECT COUNT(*) AS n FROM orders"
+        assert agent.semantic_cache.entries[0]['data_version'] == olist_db.data_version
+
+
+class TestSchemaLinking:
+    """Test pruning the schema sent with SQL prompts"""
+    
+    def test_question_links_relevant_tables(self, olist_db):
+        """Test a question gets the fact table cut to its matching columns, with the join paths it needs"""
+        linker = SchemaLinker(olist_db, max_tables=4, max_columns=12)
+        
+        revenue = linker.link("revenue by product category")
+        assert revenue.tables[0] == 'order_facts'
+        assert 'products' not in revenue.tables and 'order_items' not in revenue.tables
+        assert 'product_category_name_english' in revenue.columns['order_facts']
+        assert 'delivery_delay_days' not in revenue.columns['order_facts']
+        assert "more columns not listed" in revenue.description
+        
+        reviews = linker.link("average review score by seller state")
+        assert 'order_reviews' in reviews.tables
+        assert "order_facts.order_id = order_reviews.order_id" in reviews.join_paths
+        assert "## Join paths" in reviews.description
+        
+        # Location tables are reached through a customer's zip code, preferring the centroids
+        places = linker.link("customer location distance")
+        assert 'zip_centroids' in places.tables and 'geolocation' not in places.tables
+        assert "customers.customer_zip_code_prefix = zip_centroids.zip_code_prefix" in places.join_paths
+    
+    def test_prompt_size_is_recorded(self, olist_db):
+        """Test linked prompts are smaller than the full schema and unmatched questions get all of it"""
+        linker = SchemaLinker(olist_db)
+        
+        linked = linker.link("payment type distribution")
+        assert linked.tables == ['order_payments']
+        assert linked.linked_tokens < linked.full_tokens / 4
+        
+        unmatched = linker.link("what is the weather")
+        assert unmatched.description == olist_db.get_schema_description()
+        
+        stats = linker.stats()
+        assert stats['questions'] == 2 and stats['pruned'] == 1
+        assert stats['tokens_saved'] == linked.full_tokens - linked.linked_tokens
+        
+        agent = SQLAnalystAgent(olist_db)
+        agent.model = TestSemanticSQLCache.SQLModel("SELECT payment_type, COUNT(*) AS n FROM order_payments GROUP BY 1")
+        agent.response_cache, agent.semantic_cache = None, None
+        response = agent.execute("payment type distribution")
+        assert response.success and response.metadata['schema_tables'] == ['order_payments']
+        assert "## Table: order_facts" not in agent.model.prompts[0]
+
+
+class TestTokenUsage:
+    """Test token accounting of LLM calls"""
+    
+    class MeteredModel:
+        """Stands in for the Gemini model, reporting usage like the API does"""
+        
+        def generate_content(self, prompt):
+            usage = type('Usage', (), {'prompt_token_count': 120, 'candidates_token_count': 30})()
+            return type('Response', (), {'text': "SELECT COUNT(*) AS n FROM orders", 'usage_metadata': usage})()
+    
+    def test_calls_are_attributed_to_agent_session_and_question(self, olist_db):
+        """Test tokens and prompt sections are charged to the active scope, and cached calls are not spent"""
+        agent = SQLAnalystAgent(olist_db)
+        agent.model = TestLLMResponseCache.StubModel()
+        agent.response_cache = LLMResponseCache(None, 3600, 1024 * 1024)
+        agent.semantic_cache = None
+        agent.token_tracker = TokenUsageTracker()
+        
+        with usage_scope('session-1', 'question-1'):
+            agent._call_llm("count orders", sections={'schema': "orders(order_id)", 'question': "count orders"})
+            agent._call_llm("count orders", sections={'schema': "orders(order_id)", 'question': "count orders"})
+        agent.model = self.MeteredModel()
+        with usage_scope('session-2', 'question-2'):
+            agent._call_llm("count customers")
+        
+        first = agent.token_tracker.summary('session-1')
+        assert first['calls'] == 2 and first['cached_calls'] == 1
+        assert first['by_agent']['sql_analyst']['prompt_tokens'] == first['prompt_tokens'] > 0
+        assert set(first['by_section']['sql_analyst']) == {'schema', 'question'}
+        assert first['cached_tokens'] == first['prompt_tokens'] + first['completion_tokens']
+        
+        # Counts reported by the API are used as-is
+        assert agent.token_tracker.question_usage('question-2')['prompt_tokens'] == 120
+        assert agent.token_tracker.recent(1)[0]['source'] == 'api'
+        assert agent.token_tracker.summary()['prompt_tokens'] == first['prompt_tokens'] + 120
+        assert agent.token_tracker.sessions() == ['session-1', 'session-2']
+    
+    def test_answers_report_their_tokens(self, olist_db, monkeypatch, tmp_path):
+        """Test a question's answer carries its token usage and the session summary adds it up"""
+        monkeypatch.setattr(config.memory, 'storage_path', tmp_path)
+        tracker = TokenUsageTracker()
+        monkeypatch.setattr('src.agents.agent_system.get_token_tracker', lambda: tracker)
+        system = AgentSystem(olist_db, MemoryManager(session_id='token-usage-test'))
+        for agent in system.agents.values():
+            agent.model, agent.response_cache, agent.token_tracker = self.MeteredModel(), None, tracker
+        system.agents[AgentType.SQL_ANALYST].semantic_cache = None
+        
+        response = system.process_query("how many orders are there")
+        usage = response['metadata']['token_usage']
+        assert usage['calls'] == 2 and usage['prompt_tokens'] == 240
+        assert set(usage['by_agent']) == {'sql_analyst', 'data_analyst'}
+        
+        summary = system.get_session_token_summary()
+        assert summary['session_id'] == 'token-usage-test' and summary['total_tokens'] == 300
+        assert 'schema' in summary['by_section']['sql_analyst']
+        assert 'sample_rows' in summary['by_section']['data_analyst']
+
+
+class TestStreaming:
+    """Test streaming model output through the agents"""
+    
+    class StreamingModel:
+        """Stands in for the Gemini model, streaming its text in word-sized chunks when asked"""
+        
+        def __init__(self, text):
+            self.text = text
+            self.calls = 0
+        
+        def generate_content(self, prompt, stream=False):
+            self.calls += 1
+            if not stream:
+                return type('Response', (), {'text': self.text})()
+            words = self.text.split(' ')
+            return [type('Chunk', (), {'text': word + (' ' if i < len(words) - 1 else '')})() for i, word in enumerate(words)]
+    
+    def test_stream_yields_chunks_and_caches_the_whole_response(self):
+        """Test chunks arrive separately, the joined text is cached and counted, and a repeat comes whole"""
+        agent = TranslatorAgent()
+        agent.model = self.StreamingModel("a b c")
+        agent.response_cache = LLMResponseCache(None, 3600, 1024 * 1024)
+        agent.token_tracker = TokenUsageTracker()
+        
+        assert list(agent._stream_llm("translate abc")) == ["a ", "b ", "c"]
+        assert list(agent._stream_llm("translate abc")) == ["a b c"]
+        assert agent.model.calls == 1
+        
+        summary = agent.token_tracker.summary()
+        assert summary['calls'] == 2 and summary['cached_calls'] == 1 and summary['completion_tokens'] > 0
+    
+    def test_data_query_events_arrive_in_order(self, olist_db, monkeypatch, tmp_path):
+        """Test the SQL is yielded before it runs and the rows before the analysis, which streams, then the final response"""
+        monkeypatch.setattr(config.memory, 'storage_path', tmp_path)
+        system = AgentSystem(olist_db, MemoryManager(session_id='streaming-test'))
+        for agent in system.agents.values():
+            agent.response_cache = None
+        system.agents[AgentType.SQL_ANALYST].semantic_cache = None
+        system.agents[AgentType.SQL_ANALYST].model = self.StreamingModel("SELECT order_status, COUNT(*) AS n FROM orders GROUP BY 1")
+        system.agents[AgentType.DATA_ANALYST].model = self.StreamingModel("Most orders were delivered")
+        ran = []
+        run_query = olist_db.run_query
+        monkeypatch.setattr(olist_db, 'run_query', lambda sql, **kwargs: ran.append(sql) or run_query(sql, **kwargs))
+        
+        events = []
+        for event in system.stream_query("how many orders per status"):
+            if event['type'] == 'sql':
+                assert not ran
+            events.append(event)
+        kinds = [event['type'] for event in events]
+        assert kinds[:5] == ['status', 'sql', 'status', 'rows', 'status']
+        assert kinds[5:-1] == ['answer_chunk'] * 4 and kinds[-1] == 'done'
+        assert events[3]['row_count'] == 2 and ran == [events[1]['sql_query']]
+        
+        response = events[-1]['response']
+        assert response['success'] and "Most orders were delivered" in response['answer']
+        assert response['sql_query'] == events[1]['sql_query']
+        assert system.memory_manager.get_messages()[-1].content == response['answer']
+
+
 class TestDataProcessing:
     """Test data processing utilities"""
     